@@ -43,7 +43,8 @@ def run(mscoco, cococount, detect_file_pattern, keep_zeros=False):
     pred = []
     labels = []
     with ShardedFileReader(cococount_info_file) as info_reader:
-        with ShardedFileReader(detect_file) as detect_reader:
+        with ShardedFileReader(detect_file,
+                               fields=['categories']) as detect_reader:
             for item in progress_bar.get_iter(info_reader):
                 # Read image ID.
                 image_id = item['image_id']
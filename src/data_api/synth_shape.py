@@ -350,7 +350,7 @@ def _image_to_segmentation(opt, image_data_entry, random=None):
 
 
 def write_segmentation_data(opt, image_data, fname, num_per_shard=16000,
-                            seed=2):
+                            seed=2, block_size=256):
     """Write segmentation network training data to sharded file.
 
     Args:
@@ -359,6 +359,7 @@ def write_segmentation_data(opt, image_data, fname, num_per_shard=16000,
         fname: string, output file basename
         num_per_shard: int, number of training examples per file shard
         seed: rng seed
+        block_size: int, number of examples appended to the file at a time
     """
 
     random = np.random.RandomState(seed)
@@ -376,12 +377,17 @@ def write_segmentation_data(opt, image_data, fname, num_per_shard=16000,
     log.info('Writing to {} in {} shards'.format(fname, num_shards))
 
     fout = ShardedFile(fname, num_shards=num_shards)
-    with ShardedFileWriter(fout, num_ex_final) as writer:
+    with ShardedFileWriter(fout, num_ex_final,
+                           block_size=block_size) as writer:
         for ii in progress_bar.get(num_ex):
             segm_data = _image_to_segmentation(
                 opt, image_data[ii], random=random)
-            for segm_j in segm_data:
-                writer.write(segm_j)
+            if len(segm_data) == 0:
+                continue
+            columns = {}
+            for key in segm_data[0].iterkeys():
+                columns[key] = np.array([segm_j[key] for segm_j in segm_data])
+            writer.write_many(columns)
 
     pass
 
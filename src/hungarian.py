@@ -1,8 +1,22 @@
+import atexit
+import collections
+import multiprocessing
 import numpy as np
+import threading
 from utils import logger
 
 log = logger.get()
 
+# Smallest batch matched in the process pool, smaller batches are matched
+# inline where sending work to the pool costs more than it saves.
+MIN_POOL_BATCH_SIZE = 16
+
+# Number of chunks of a batch given to each worker.
+CHUNKS_PER_WORKER = 4
+
+# Shared arrays of the pool workers.
+_worker_arrays = {}
+
 
 def augment(G, F, R):
     """Finds an augmenting path using BFS.
@@ -94,9 +108,118 @@ def max_flow(G):
     return F
 
 
+def get_bp_csr(G):
+    """Gets the adjacency lists of a bi-partite graph in CSR form.
+
+    Args:
+        G: numpy.ndarray, [n_X, n_Y], nonzero terms represent edges.
+    Returns:
+        indptr: numpy.ndarray, [n_X + 1], neighbours of x are
+        indices[indptr[x]: indptr[x + 1]].
+        indices: numpy.ndarray, [E], neighbours (int) in Y.
+    """
+    rows, indices = G.nonzero()
+    indptr = np.zeros([G.shape[0] + 1], dtype='int64')
+    np.cumsum(np.bincount(rows, minlength=G.shape[0]), out=indptr[1:])
+
+    return indptr, indices
+
+
+def max_bp_match_csr(indptr, indices, n_Y):
+    """Calculates the max matching for bi-partite graphs with Hopcroft-Karp.
+
+    Each phase layers X by a BFS from the free vertices along alternating
+    paths, then augments along vertex disjoint shortest paths with a DFS,
+    in O(E sqrt(V)) overall. Memory grows with the number of edges.
+
+    Args:
+        indptr: numpy.ndarray, [n_X + 1], see get_bp_csr.
+        indices: numpy.ndarray, [E], see get_bp_csr.
+        n_Y: int, number of vertices in Y.
+    Returns:
+        match_x: numpy.ndarray, [n_X], vertex in Y matched to each x, -1 if
+        unmatched.
+        match_y: numpy.ndarray, [n_Y], vertex in X matched to each y, -1 if
+        unmatched.
+    """
+    n_X = len(indptr) - 1
+    # Python lists are faster than numpy arrays element by element.
+    indptr = [int(i) for i in indptr]
+    indices = [int(i) for i in indices]
+    match_x = [-1] * n_X
+    match_y = [-1] * n_Y
+
+    while True:
+        # Layer X by BFS from the free vertices.
+        dist = [-1] * n_X
+        q = collections.deque()
+        for x in xrange(n_X):
+            if match_x[x] == -1:
+                dist[x] = 0
+                q.append(x)
+        found = False
+        while len(q) > 0:
+            x = q.popleft()
+            for k in xrange(indptr[x], indptr[x + 1]):
+                z = match_y[indices[k]]
+                if z == -1:
+                    found = True
+                elif dist[z] == -1:
+                    dist[z] = dist[x] + 1
+                    q.append(z)
+        if not found:
+            break
+
+        # Augment along layered paths with an iterative DFS. Dead ends are
+        # removed from the layers.
+        ptr = list(indptr[:-1])
+        for x0 in xrange(n_X):
+            if match_x[x0] != -1:
+                continue
+            stack = [x0]
+            while len(stack) > 0:
+                x = stack[-1]
+                if ptr[x] == indptr[x + 1]:
+                    dist[x] = -1
+                    stack.pop()
+                    continue
+                y = indices[ptr[x]]
+                ptr[x] += 1
+                z = match_y[y]
+                if z == -1:
+                    # Flip the path, each x takes the y it last tried.
+                    for x in stack:
+                        y = indices[ptr[x] - 1]
+                        match_x[x] = y
+                        match_y[y] = x
+                    break
+                if dist[z] == dist[x] + 1:
+                    stack.append(z)
+
+    return np.array(match_x, dtype='int64'), np.array(match_y, dtype='int64')
+
+
 def max_bp_match(G):
     """Calculates the max matching for bi-partite graphs.
 
+    Args:
+        G: numpy.ndarray, [n_X, n_Y], edge weight matrix.
+    Returns:
+        M: numpy.ndarray, [n_X, n_Y], binary matrix, matched 1, unmatched 0.
+    """
+    indptr, indices = get_bp_csr(G)
+    match_x, match_y = max_bp_match_csr(indptr, indices, G.shape[1])
+    M = np.zeros(G.shape, dtype=G.dtype)
+    matched = match_x != -1
+    M[matched.nonzero()[0], match_x[matched]] = 1
+
+    return M
+
+
+def max_bp_match_flow(G):
+    """Calculates the max matching for bi-partite graphs, as a max flow on
+    the dense source-sink graph.
+
     Args:
         G: numpy.ndarray, [n_X, n_Y], edge weight matrix.
     Returns:
@@ -282,3 +405,595 @@ def min_weighted_bp_cover(W):
             i += 1
 
     pass
+
+
+def augment_shortest_paths(C, u, v, row_match, col_match, rows):
+    """Augments an assignment along shortest paths, one row at a time.
+
+    Each augmentation grows a Dijkstra search from a free row over the
+    reduced costs C - u - v, vectorized over the columns, until it reaches a
+    free column, then flips the matching along the path and updates the duals
+    (Jonker-Volgenant). The duals of the matched rows must be feasible, u[i] +
+    v[j] <= C[i, j], and tight on matched edges, which the updates keep.
+
+    Args:
+        C: numpy.ndarray, [n_r, n_c], cost matrix, n_r <= n_c.
+        u: numpy.ndarray, [n_r], row duals, will be updated.
+        v: numpy.ndarray, [n_c], column duals, will be updated.
+        row_match: numpy.ndarray, [n_r], column of each row, -1 if free, will
+        be updated.
+        col_match: numpy.ndarray, [n_c], row of each column, -1 if free, will
+        be updated.
+        rows: list of free rows to match.
+    Returns:
+        num_steps: int, number of columns scanned by the searches.
+    """
+    n_r = C.shape[0]
+    n_c = C.shape[1]
+    num_steps = 0
+
+    for cur_row in rows:
+        # Shortest path length to each column, and the row it is reached from.
+        dist = np.empty([n_c])
+        dist.fill(np.inf)
+        path = np.zeros([n_c], dtype='int64') - 1
+        scanned_rows = np.zeros([n_r], dtype='bool')
+        scanned_cols = np.zeros([n_c], dtype='bool')
+        min_val = 0.0
+        i = cur_row
+        sink = -1
+
+        while sink == -1:
+            scanned_rows[i] = True
+            r = min_val + C[i] - u[i] - v
+            shorter = np.logical_and(r < dist, np.logical_not(scanned_cols))
+            dist[shorter] = r[shorter]
+            path[shorter] = i
+
+            # Closest column not scanned yet, free columns first on ties.
+            d = np.where(scanned_cols, np.inf, dist)
+            j = d.argmin()
+            min_val = d[j]
+            if min_val == np.inf:
+                raise Exception('No augmenting path from row {}'.format(
+                    cur_row))
+            ties = np.logical_and(d == min_val, col_match == -1)
+            if ties.any():
+                j = ties.argmax()
+            scanned_cols[j] = True
+            num_steps += 1
+
+            if col_match[j] == -1:
+                sink = j
+            else:
+                i = col_match[j]
+
+        # Update duals.
+        u[cur_row] += min_val
+        scanned_rows[cur_row] = False
+        u[scanned_rows] += min_val - dist[row_match[scanned_rows]]
+        v[scanned_cols] -= min_val - dist[scanned_cols]
+
+        # Flip the matching along the path.
+        j = sink
+        while True:
+            i = path[j]
+            col_match[j] = i
+            row_match[i], j = j, row_match[i]
+            if i == cur_row:
+                break
+
+    return num_steps
+
+
+def min_weighted_bp_cover_fast(W):
+    """Calculates the min weighted bi-partite vertex cover or max weighted
+    bi-partite matching, with shortest augmenting paths.
+
+    Same outputs as min_weighted_bp_cover in O(n^3): the matching saturates
+    the smaller side, c_0[x] + c_1[y] >= W[x, y] with equality on matched
+    edges, and the cover of the unmatched vertices of the larger side is 0.
+    The cover and matching can differ from min_weighted_bp_cover when there
+    are ties.
+
+    Args:
+        W: numpy.ndarray, [n_X, n_Y], edge weight matrix.
+    Returns:
+        c_0: numpy.ndarray, [n_X], vertex cover on X.
+        c_1: numpy.ndarray, [n_Y], vertex cover on Y.
+        M: numpy.ndarray, [n_X, n_Y], max matching, 1 matched, 0 unmatched.
+    """
+    transpose, C = _get_cost(W)
+    n_r = C.shape[0]
+    n_c = C.shape[1]
+
+    u = np.zeros([n_r])
+    v = np.zeros([n_c])
+    row_match = np.zeros([n_r], dtype='int64') - 1
+    col_match = np.zeros([n_c], dtype='int64') - 1
+    augment_shortest_paths(C, u, v, row_match, col_match, xrange(n_r))
+
+    return _get_cover(W, transpose, u, v, row_match)
+
+
+def _get_cost(W):
+    """Gets the cost matrix of a weight matrix, with the smaller side as rows.
+
+    Returns:
+        transpose: bool, whether the rows are Y.
+        C: numpy.ndarray, [n_r, n_c], negated weights.
+    """
+    transpose = W.shape[0] > W.shape[1]
+    if transpose:
+        C = -W.T.astype('float64')
+    else:
+        C = -W.astype('float64')
+
+    return transpose, C
+
+
+def _get_cover(W, transpose, u, v, row_match):
+    """Gets the cover and matching of W from the duals and matching of its
+    cost matrix, see min_weighted_bp_cover_fast."""
+    n_r = u.shape[0]
+    n_c = v.shape[0]
+    M = np.zeros([n_r, n_c], dtype='uint8')
+    M[np.arange(n_r), row_match] = 1
+    c_r = (0.0 - u).astype(W.dtype)
+    c_c = (0.0 - v).astype(W.dtype)
+    if transpose:
+        return c_c, c_r, M.T
+    else:
+        return c_r, c_c, M
+
+
+class MatchCache(object):
+    """Warm starts the matching of examples seen before.
+
+    Keeps the duals and matching of the last solve of each key, e.g. the
+    index of a training example. The weights of an example change slowly
+    between nearby training steps, so most of the last matching is still
+    optimal: the old column duals are repaired into feasible duals of the new
+    weights, the matched edges that stay tight are kept, and only the rows
+    left free are augmented, see min_weighted_bp_cover_fast.
+    """
+
+    def __init__(self, max_size=None):
+        """Construct a cache.
+
+        Args:
+            max_size: int, (optional) max number of keys kept, least recently
+            used keys are dropped first. Default keeps all keys.
+        """
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._augmentations = 0
+        self._augmentations_saved = 0
+        self._steps = 0
+
+        pass
+
+    def _get(self, key, shape):
+        """Get the entry of a key, None if missing or of another shape."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is not None and entry[0] != shape:
+                entry = None
+            if entry is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+                self._entries[key] = entry
+
+            return entry
+
+    def _put(self, key, shape, v, row_match, num_augmentations,
+             num_saved, num_steps):
+        """Store the solution of a key and count the work done."""
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (shape, v, row_match)
+            if self.max_size is not None:
+                while len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+            self._augmentations += num_augmentations
+            self._augmentations_saved += num_saved
+            self._steps += num_steps
+
+        pass
+
+    def match(self, key, W):
+        """Calculates the max weighted bi-partite matching and min weighted
+        vertex cover of W, warm started from the last solve of the key.
+
+        Args:
+            key: hashable, identifies the example, e.g. its index.
+            W: numpy.ndarray, [n_X, n_Y], edge weight matrix.
+        Returns:
+            c_0: numpy.ndarray, [n_X], vertex cover on X.
+            c_1: numpy.ndarray, [n_Y], vertex cover on Y.
+            M: numpy.ndarray, [n_X, n_Y], max matching, 1 matched, 0
+            unmatched.
+        """
+        transpose, C = _get_cost(W)
+        n_r = C.shape[0]
+        n_c = C.shape[1]
+        entry = self._get(key, W.shape)
+
+        if entry is None or n_r == 0:
+            v = np.zeros([n_c])
+            row_match = np.zeros([n_r], dtype='int64') - 1
+        else:
+            v = entry[1].copy()
+            row_match = entry[2].copy()
+
+        # Repair the duals: columns left free need v = 0, rows take the
+        # largest feasible u, and only the matched edges that stay tight are
+        # kept. Freeing a column can raise its dual, so repeat until stable.
+        col_match = np.zeros([n_c], dtype='int64') - 1
+        u = np.zeros([n_r])
+        while True:
+            matched = (row_match != -1).nonzero()[0]
+            col_match.fill(-1)
+            col_match[row_match[matched]] = matched
+            v[col_match == -1] = 0.0
+            if n_r > 0:
+                u = (C - v).min(axis=1)
+            tight = C[matched, row_match[matched]] - v[row_match[matched]] == \
+                u[matched]
+            if tight.all():
+                break
+            row_match[matched[np.logical_not(tight)]] = -1
+
+        free_rows = (row_match == -1).nonzero()[0]
+        num_steps = augment_shortest_paths(
+            C, u, v, row_match, col_match, free_rows)
+        num_saved = 0 if entry is None else n_r - free_rows.size
+        self._put(key, W.shape, v.copy(), row_match.copy(), free_rows.size,
+                  num_saved, num_steps)
+
+        return _get_cover(W, transpose, u, v, row_match)
+
+    def get_stats(self):
+        """Get the cache counters.
+
+        Returns:
+            stats: dict, number of hits and misses, augmentations run and
+            saved by warm starts, columns scanned by the searches, and keys
+            kept.
+        """
+        with self._lock:
+            return {
+                'hits': self._hits,
+                'misses': self._misses,
+                'augmentations': self._augmentations,
+                'augmentations_saved': self._augmentations_saved,
+                'steps': self._steps,
+                'items': len(self._entries)
+            }
+
+    def clear(self):
+        """Drop all keys, counters are kept."""
+        with self._lock:
+            self._entries.clear()
+
+        pass
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def _init_worker(weights, covers, matches):
+    """Keep the shared arrays in a pool worker."""
+    _worker_arrays['weights'] = weights
+    _worker_arrays['covers'] = covers
+    _worker_arrays['matches'] = matches
+
+    pass
+
+
+def _get_batch_views(weights, covers, matches, shape):
+    """Get numpy views of shared arrays for a batch.
+
+    Args:
+        weights: multiprocessing.RawArray, float64 weights.
+        covers: multiprocessing.RawArray, float64 covers.
+        matches: multiprocessing.RawArray, uint8 matchings.
+        shape: tuple, [B, N, M], shape of the batch.
+    Returns:
+        W: numpy.ndarray, [B, N, M], weights.
+        C: numpy.ndarray, [B, N + M], covers of X then Y.
+        M: numpy.ndarray, [B, N, M], matchings.
+    """
+    B, N, M = shape
+    W = np.frombuffer(weights, dtype='float64', count=B * N * M)
+    C = np.frombuffer(covers, dtype='float64', count=B * (N + M))
+    M = np.frombuffer(matches, dtype='uint8', count=B * N * M)
+
+    return W.reshape(shape), C.reshape([B, -1]), M.reshape(shape)
+
+
+def _match_chunk(args):
+    """Match examples [start, end) of the batch in the shared arrays."""
+    shape, start, end = args
+    W, C, M = _get_batch_views(_worker_arrays['weights'],
+                               _worker_arrays['covers'],
+                               _worker_arrays['matches'], shape)
+    n_X = shape[1]
+    for b in xrange(start, end):
+        c_0, c_1, M[b] = min_weighted_bp_cover_fast(W[b])
+        C[b, :n_X] = c_0
+        C[b, n_X:] = c_1
+
+    pass
+
+
+class MatchPool(object):
+    """Persistent process pool matching batches in shared memory.
+
+    Workers get the shared arrays when they start, so a batch is copied into
+    shared memory once and only chunk ranges are sent to the workers. The
+    pool is restarted with larger arrays when a batch does not fit.
+    """
+
+    def __init__(self, num_workers):
+        """Construct a pool, workers are started by the first batch.
+
+        Args:
+            num_workers: int, number of worker processes.
+        """
+        self.num_workers = num_workers
+        self._pool = None
+        self._capacity = (0, 0)
+        self._lock = threading.Lock()
+
+        pass
+
+    def _start(self, num_weights, num_covers):
+        """Start workers with shared arrays of at least the given sizes."""
+        self.close()
+        num_weights = max(num_weights, self._capacity[0])
+        num_covers = max(num_covers, self._capacity[1])
+        self._weights = multiprocessing.RawArray('d', num_weights)
+        self._covers = multiprocessing.RawArray('d', num_covers)
+        self._matches = multiprocessing.RawArray('B', num_weights)
+        self._pool = multiprocessing.Pool(
+            self.num_workers, initializer=_init_worker,
+            initargs=(self._weights, self._covers, self._matches))
+        self._capacity = (num_weights, num_covers)
+
+        pass
+
+    def match(self, W):
+        """Match each example of a batch.
+
+        Args:
+            W: numpy.ndarray, [B, N, M], edge weight matrices.
+        Returns:
+            C: numpy.ndarray, [B, N + M], float64 covers of X then Y.
+            M: numpy.ndarray, [B, N, M], matchings.
+        """
+        B, N, M = W.shape
+        with self._lock:
+            if self._pool is None or B * N * M > self._capacity[0] or \
+                    B * (N + M) > self._capacity[1]:
+                self._start(B * N * M, B * (N + M))
+            W_shared, C, M = _get_batch_views(
+                self._weights, self._covers, self._matches, W.shape)
+            W_shared[:] = W
+            num_chunks = min(B, self.num_workers * CHUNKS_PER_WORKER)
+            bounds = [B * i / num_chunks for i in xrange(num_chunks + 1)]
+            self._pool.map(_match_chunk, [
+                (W.shape, bounds[i], bounds[i + 1])
+                for i in xrange(num_chunks)])
+
+            return C.copy(), M.copy()
+
+    def close(self):
+        """Stop the workers."""
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+        pass
+
+
+# Pools by number of workers, kept between calls.
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _get_pool(num_workers):
+    """Get the persistent pool with a number of workers."""
+    with _pools_lock:
+        if num_workers not in _pools:
+            _pools[num_workers] = MatchPool(num_workers)
+
+        return _pools[num_workers]
+
+
+@atexit.register
+def _close_pools():
+    for pool in _pools.itervalues():
+        pool.close()
+
+    pass
+
+
+def batch_match(W, workers=1, min_pool_batch_size=MIN_POOL_BATCH_SIZE,
+                cache=None, keys=None):
+    """Calculates the max weighted bi-partite matching and min weighted
+    vertex cover of each example in a batch, see min_weighted_bp_cover_fast.
+
+    Args:
+        W: numpy.ndarray, [B, N, M], edge weight matrices.
+        workers: int, number of worker processes of a persistent pool, None
+        for the number of CPUs. Default 1 matches inline, the pool is forked,
+        so only ask for one in processes without other threads running.
+        min_pool_batch_size: int, smaller batches are matched inline.
+        cache: MatchCache, (optional) warm starts examples seen before, the
+        batch is then matched inline.
+        keys: list, key of each example in the cache, e.g. example indices.
+    Returns:
+        c_0: numpy.ndarray, [B, N], vertex covers on X.
+        c_1: numpy.ndarray, [B, M], vertex covers on Y.
+        M: numpy.ndarray, [B, N, M], max matchings, 1 matched, 0 unmatched.
+    """
+    if len(W.shape) != 3:
+        raise Exception('Expected weights of shape [B, N, M], got {}'.format(
+            W.shape))
+    B, N, M = W.shape
+    if cache is not None and (keys is None or len(keys) != B):
+        raise Exception('Need a key for each example to use the cache')
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    if workers <= 1 or B < min_pool_batch_size or N * M == 0 or \
+            cache is not None:
+        c_0 = np.zeros([B, N], dtype=W.dtype)
+        c_1 = np.zeros([B, M], dtype=W.dtype)
+        matches = np.zeros([B, N, M], dtype='uint8')
+        for b in xrange(B):
+            if cache is not None:
+                c_0[b], c_1[b], matches[b] = cache.match(keys[b], W[b])
+            else:
+                c_0[b], c_1[b], matches[b] = min_weighted_bp_cover_fast(W[b])
+
+        return c_0, c_1, matches
+
+    C, matches = _get_pool(workers).match(W)
+    C = C.astype(W.dtype)
+
+    return C[:, :N], C[:, N:], matches
+
+
+def get_bp_components(rows, cols, n_X, n_Y):
+    """Labels the connected components of a bi-partite graph.
+
+    Hooks the root of each edge end onto the smaller root and compresses the
+    parent pointers, vectorized over the edges, until no edge joins two
+    components.
+
+    Args:
+        rows: numpy.ndarray, [E], vertex in X of each edge.
+        cols: numpy.ndarray, [E], vertex in Y of each edge.
+        n_X: int, number of vertices in X.
+        n_Y: int, number of vertices in Y.
+    Returns:
+        labels_x: numpy.ndarray, [n_X], component of each vertex in X.
+        labels_y: numpy.ndarray, [n_Y], component of each vertex in Y.
+        Components are numbered from 0, isolated vertices have their own.
+    """
+    parent = np.arange(n_X + n_Y)
+    u = np.asarray(rows, dtype='int64')
+    v = np.asarray(cols, dtype='int64') + n_X
+    while True:
+        root_u = parent[u]
+        root_v = parent[v]
+        joined = root_u != root_v
+        if not joined.any():
+            break
+        root_min = np.minimum(root_u[joined], root_v[joined])
+        np.minimum.at(parent, root_u[joined], root_min)
+        np.minimum.at(parent, root_v[joined], root_min)
+        while True:
+            grand_parent = parent[parent]
+            if (grand_parent == parent).all():
+                break
+            parent = grand_parent
+    labels = np.unique(parent, return_inverse=True)[1]
+
+    return labels[:n_X], labels[n_X:]
+
+
+def sparse_match(rows, cols, weights, n_X, n_Y):
+    """Calculates the max weighted bi-partite matching of a sparse graph.
+
+    Only edges with positive weight can be matched, e.g. pairs with nonzero
+    IOU. The graph is split into connected components. Components with a
+    single vertex on one side are matched to their heaviest edge, all at
+    once, and each other component is solved densely with
+    min_weighted_bp_cover_fast, so the cost grows with the size of the
+    components instead of n_X and n_Y.
+
+    Args:
+        rows: numpy.ndarray, [E], vertex in X of each edge, COO format.
+        cols: numpy.ndarray, [E], vertex in Y of each edge.
+        weights: numpy.ndarray, [E], weight of each edge.
+        n_X: int, number of vertices in X.
+        n_Y: int, number of vertices in Y.
+    Returns:
+        match_x: numpy.ndarray, [n_X], vertex in Y matched to each x, -1 if
+        unmatched.
+        match_y: numpy.ndarray, [n_Y], vertex in X matched to each y, -1 if
+        unmatched.
+    """
+    keep = np.asarray(weights) > 0
+    rows = np.asarray(rows, dtype='int64')[keep]
+    cols = np.asarray(cols, dtype='int64')[keep]
+    weights = np.asarray(weights, dtype='float64')[keep]
+    match_x = np.zeros([n_X], dtype='int64') - 1
+    match_y = np.zeros([n_Y], dtype='int64') - 1
+    if rows.size == 0:
+        return match_x, match_y
+
+    labels_x, labels_y = get_bp_components(rows, cols, n_X, n_Y)
+    labels = labels_x[rows]
+
+    # In a component with a single vertex on one side, the best matching is
+    # its heaviest edge. Take the first edge of each such component, sorted
+    # by decreasing weight.
+    num_comps = max(labels_x.max(), labels_y.max()) + 1
+    comp_n_X = np.bincount(labels_x[np.unique(rows)], minlength=num_comps)
+    comp_n_Y = np.bincount(labels_y[np.unique(cols)], minlength=num_comps)
+    star = np.logical_or(comp_n_X[labels] == 1, comp_n_Y[labels] == 1)
+    star_edges = star.nonzero()[0]
+    order = star_edges[np.lexsort((-weights[star_edges],
+                                   labels[star_edges]))]
+    first = np.ones([order.size], dtype='bool')
+    first[1:] = labels[order[1:]] != labels[order[:-1]]
+    best = order[first]
+    match_x[rows[best]] = cols[best]
+    match_y[cols[best]] = rows[best]
+
+    # Solve the other components densely, edges grouped by component.
+    order = np.argsort(labels, kind='mergesort')
+    order = order[np.logical_not(star[order])]
+    bounds = np.flatnonzero(np.diff(labels[order])) + 1
+    for edges in np.split(order, bounds):
+        if edges.size == 0:
+            continue
+        xs, local_rows = np.unique(rows[edges], return_inverse=True)
+        ys, local_cols = np.unique(cols[edges], return_inverse=True)
+        W = np.zeros([xs.size, ys.size])
+        np.maximum.at(W, (local_rows, local_cols), weights[edges])
+        M = min_weighted_bp_cover_fast(W)[2]
+        # Drop pairs matched without an edge.
+        local_x, local_y = np.logical_and(M == 1, W > 0).nonzero()
+        match_x[xs[local_x]] = ys[local_y]
+        match_y[ys[local_y]] = xs[local_x]
+
+    return match_x, match_y
+
+
+def sparse_match_csr(indptr, indices, weights, n_Y):
+    """Calculates the max weighted bi-partite matching of a sparse graph in
+    CSR format, see sparse_match.
+
+    Args:
+        indptr: numpy.ndarray, [n_X + 1], see get_bp_csr.
+        indices: numpy.ndarray, [E], see get_bp_csr.
+        weights: numpy.ndarray, [E], weight of each edge.
+        n_Y: int, number of vertices in Y.
+    Returns:
+        match_x: numpy.ndarray, [n_X], see sparse_match.
+        match_y: numpy.ndarray, [n_Y], see sparse_match.
+    """
+    n_X = len(indptr) - 1
+    rows = np.repeat(np.arange(n_X), np.diff(indptr))
+
+    return sparse_match(rows, indices, weights, n_X, n_Y)
@@ -0,0 +1,290 @@
+"""
+Benchmarks for the bi-partite matching solvers.
+
+Usage:
+    python hungarian_bench.py -bench cover -timespans 5,10,20,50,100
+
+Benchmarks:
+    cover: min_weighted_bp_cover versus min_weighted_bp_cover_fast on random
+    IOU matrices, scaled to integers so that the equality graph of the
+    reference solver is exact. Each reference solve is stopped after -timeout
+    seconds, and only run up to -max_reference vertices.
+    match: max_bp_match_flow versus Hopcroft-Karp max_bp_match on random
+    sparse graphs, the flow is only run up to -max_reference vertices.
+    batch: batch_match inline versus in a pool of -workers processes, for
+    batches of -batch_size examples.
+    sparse: dense min_weighted_bp_cover_fast versus sparse_match on the IOU
+    of random boxes and jittered detections, most boxes overlap a few others.
+    warm: cold min_weighted_bp_cover_fast versus MatchCache on the IOU of
+    boxes whose detections move by -jitter pixels per step, for -num_steps
+    steps.
+"""
+
+import argparse
+import hungarian
+import multiprocessing
+import numpy as np
+import signal
+import time
+from utils import logger
+
+log = logger.get()
+
+
+class _Timeout(Exception):
+    pass
+
+
+def _raise_timeout(signum, frame):
+    raise _Timeout()
+
+
+def _get_weights(random, n, density):
+    """Get a random IOU matrix, scaled to integers.
+
+    Args:
+        random: numpy.random.RandomState instance.
+        n: number, number of vertices on each side.
+        density: number, fraction of pairs that overlap.
+    Returns:
+        W: numpy.ndarray, [n, n], weights in [1, 10000].
+    """
+    iou = random.rand(n, n) * (random.rand(n, n) < density)
+
+    return np.round(np.maximum(iou, 1e-4) * 1e4).astype('int64')
+
+
+def _time_solver(solver, W, timeout):
+    """Time a solver on a weight matrix.
+
+    Returns:
+        elapsed: number, seconds, None if the solver failed or timed out.
+        weight: number, weight of the matching, None if failed.
+    """
+    if timeout is not None:
+        signal.setitimer(signal.ITIMER_REAL, timeout)
+    start = time.time()
+    try:
+        M = solver(W)[2]
+    except _Timeout:
+        return None, None
+    except Exception as e:
+        log.warning('{} failed: {}'.format(solver.__name__, e))
+        return None, None
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+
+    return time.time() - start, (W * M).sum()
+
+
+def bench_cover(args):
+    """Compare the reference and the shortest augmenting path solvers."""
+    signal.signal(signal.SIGALRM, _raise_timeout)
+    random = np.random.RandomState(2)
+    for n in [int(x) for x in args.timespans.split(',')]:
+        ref_times = []
+        fast_times = []
+        num_failed = 0
+        for trial in xrange(args.num_trials):
+            W = _get_weights(random, n, args.density)
+            fast_time, fast_weight = _time_solver(
+                hungarian.min_weighted_bp_cover_fast, W, None)
+            fast_times.append(fast_time)
+            if n > args.max_reference:
+                continue
+            ref_time, ref_weight = _time_solver(
+                hungarian.min_weighted_bp_cover, W, args.timeout)
+            if ref_time is None:
+                num_failed += 1
+                continue
+            ref_times.append(ref_time)
+            if ref_weight != fast_weight:
+                log.error('Matching weights differ: {} {}'.format(
+                    ref_weight, fast_weight))
+
+        if len(ref_times) > 0:
+            ref_msg = '{:.4f}s'.format(np.mean(ref_times))
+        else:
+            ref_msg = '-'
+        log.info(('timespan {:3d} reference {} ({:d} failed or timed out) '
+                  'fast {:.4f}s').format(
+            n, ref_msg, num_failed, np.mean(fast_times)))
+
+    pass
+
+
+def bench_match(args):
+    """Compare max flow and Hopcroft-Karp bi-partite matching."""
+    random = np.random.RandomState(3)
+    for n in [int(x) for x in args.timespans.split(',')]:
+        flow_times = []
+        hk_times = []
+        for trial in xrange(args.num_trials):
+            # Each vertex overlaps a few others, as instances in an image.
+            G = (random.rand(n, n) < min(1.0, 4.0 / n)).astype('int32')
+            start = time.time()
+            M = hungarian.max_bp_match(G)
+            hk_times.append(time.time() - start)
+            if n > args.max_reference:
+                continue
+            start = time.time()
+            M_flow = hungarian.max_bp_match_flow(G)
+            flow_times.append(time.time() - start)
+            if M.sum() != M_flow.sum():
+                log.error('Matching sizes differ: {} {}'.format(
+                    M.sum(), M_flow.sum()))
+
+        if len(flow_times) > 0:
+            flow_msg = '{:.4f}s'.format(np.mean(flow_times))
+        else:
+            flow_msg = '-'
+        log.info('vertices {:4d} max flow {} hopcroft-karp {:.4f}s'.format(
+            n, flow_msg, np.mean(hk_times)))
+
+    pass
+
+
+def bench_batch(args):
+    """Compare batch matching inline and in the process pool."""
+    random = np.random.RandomState(4)
+    for n in [int(x) for x in args.timespans.split(',')]:
+        W = random.rand(args.batch_size, n, n)
+        # Start the pool workers before timing.
+        hungarian.batch_match(W, workers=args.workers, min_pool_batch_size=0)
+        times = []
+        for workers in [1, args.workers]:
+            start = time.time()
+            for trial in xrange(args.num_trials):
+                hungarian.batch_match(W, workers=workers,
+                                      min_pool_batch_size=0)
+            times.append((time.time() - start) / args.num_trials)
+        log.info('timespan {:3d} batch {:d} inline {:.4f}s {:d} workers '
+                 '{:.4f}s'.format(n, args.batch_size, times[0], args.workers,
+                                  times[1]))
+
+    pass
+
+
+def _get_box_iou(random, n):
+    """Get the IOU of n random boxes and n jittered copies, in an image
+    scaled to keep the density of boxes of an image of 50 boxes in 500 x
+    500."""
+    size = random.uniform(20, 60, size=[n, 2])
+    y1x1 = random.uniform(0, 500 * np.sqrt(n / 50.0), size=[n, 2])
+    gt = np.concatenate([y1x1, y1x1 + size], axis=1)
+    out = gt + random.normal(0, 5, size=[n, 4])
+    top = np.maximum(out[:, None, :2], gt[None, :, :2])
+    bottom = np.minimum(out[:, None, 2:], gt[None, :, 2:])
+    inter = np.maximum(bottom - top, 0).prod(axis=-1)
+    area_out = (out[:, 2:] - out[:, :2]).prod(axis=-1)
+    area_gt = (gt[:, 2:] - gt[:, :2]).prod(axis=-1)
+
+    return inter / (area_out[:, None] + area_gt[None, :] - inter)
+
+
+def bench_sparse(args):
+    """Compare dense and sparse matching of box IOU."""
+    random = np.random.RandomState(5)
+    for n in [int(x) for x in args.timespans.split(',')]:
+        dense_times = []
+        sparse_times = []
+        for trial in xrange(args.num_trials):
+            iou = _get_box_iou(random, n)
+            start = time.time()
+            M = hungarian.min_weighted_bp_cover_fast(iou)[2]
+            dense_times.append(time.time() - start)
+            start = time.time()
+            rows, cols = iou.nonzero()
+            match_x = hungarian.sparse_match(
+                rows, cols, iou[rows, cols], n, n)[0]
+            sparse_times.append(time.time() - start)
+            matched = (match_x != -1).nonzero()[0]
+            if not np.allclose(iou[matched, match_x[matched]].sum(),
+                               (iou * M).sum()):
+                log.error('Matching weights differ')
+        log.info('boxes {:4d} edges {:5d} dense {:.4f}s sparse {:.4f}s'.format(
+            n, rows.size, np.mean(dense_times), np.mean(sparse_times)))
+
+    pass
+
+
+def bench_warm(args):
+    """Compare cold and warm started matching of slowly changing IOU."""
+    random = np.random.RandomState(6)
+    for n in [int(x) for x in args.timespans.split(',')]:
+        cache = hungarian.MatchCache()
+        cold_time = 0.0
+        warm_time = 0.0
+        for trial in xrange(args.num_trials):
+            size = random.uniform(20, 60, size=[n, 2])
+            y1x1 = random.uniform(0, 500 * np.sqrt(n / 50.0), size=[n, 2])
+            gt = np.concatenate([y1x1, y1x1 + size], axis=1)
+            out = gt + random.normal(0, 5, size=[n, 4])
+            for step in xrange(args.num_steps):
+                out += random.normal(0, args.jitter, size=[n, 4])
+                top = np.maximum(out[:, None, :2], gt[None, :, :2])
+                bottom = np.minimum(out[:, None, 2:], gt[None, :, 2:])
+                inter = np.maximum(bottom - top, 0).prod(axis=-1)
+                area_out = np.abs(out[:, 2:] - out[:, :2]).prod(axis=-1)
+                area_gt = (gt[:, 2:] - gt[:, :2]).prod(axis=-1)
+                iou = inter / (area_out[:, None] + area_gt[None, :] - inter)
+                start = time.time()
+                M = hungarian.min_weighted_bp_cover_fast(iou)[2]
+                cold_time += time.time() - start
+                start = time.time()
+                M_warm = cache.match(trial, iou)[2]
+                warm_time += time.time() - start
+                if not np.allclose((iou * M).sum(), (iou * M_warm).sum()):
+                    log.error('Matching weights differ')
+        stats = cache.get_stats()
+        num_solves = args.num_trials * args.num_steps
+        log.info(('boxes {:4d} cold {:.4f}s warm {:.4f}s augmentations '
+                  '{:d} saved {:d}').format(
+            n, cold_time / num_solves, warm_time / num_solves,
+            stats['augmentations'], stats['augmentations_saved']))
+
+    pass
+
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark bi-partite matching solvers')
+    parser.add_argument('-bench', default='cover', help='Benchmark name')
+    parser.add_argument('-batch_size', default=64, type=int,
+                        help='Number of examples per batch')
+    parser.add_argument('-workers', default=multiprocessing.cpu_count(),
+                        type=int, help='Number of pool workers')
+    parser.add_argument('-timespans', default='5,10,20,50,100',
+                        help='Comma separated numbers of vertices per side')
+    parser.add_argument('-num_trials', default=5, type=int,
+                        help='Number of random matrices per timespan')
+    parser.add_argument('-density', default=0.3, type=float,
+                        help='Fraction of overlapping pairs')
+    parser.add_argument('-max_reference', default=20, type=int,
+                        help='Largest timespan solved by the reference')
+    parser.add_argument('-timeout', default=5.0, type=float,
+                        help='Seconds before stopping a reference solve')
+    parser.add_argument('-num_steps', default=10, type=int,
+                        help='Number of steps of each slowly changing matrix')
+    parser.add_argument('-jitter', default=1.0, type=float,
+                        help='Pixels the detections move by per step')
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.bench == 'cover':
+        bench_cover(args)
+    elif args.bench == 'match':
+        bench_match(args)
+    elif args.bench == 'batch':
+        bench_batch(args)
+    elif args.bench == 'sparse':
+        bench_sparse(args)
+    elif args.bench == 'warm':
+        bench_warm(args)
+    else:
+        log.fatal('Unknown benchmark: {}'.format(args.bench))
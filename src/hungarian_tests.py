@@ -1,4 +1,5 @@
 import hungarian
+import itertools
 import numpy as np
 import unittest
 
@@ -60,6 +61,43 @@ class HungarianTests(unittest.TestCase):
 
         pass
 
+    def test_max_bp_match_2(self):
+        G = np.array([[1, 1, 0, 0],
+                      [1, 0, 0, 0],
+                      [0, 1, 1, 0],
+                      [0, 0, 1, 0]])
+        indptr, indices = hungarian.get_bp_csr(G)
+        self.assertEqual(list(indptr), [0, 2, 3, 5, 6])
+        self.assertEqual(list(indices), [0, 1, 0, 1, 2, 2])
+        match_x, match_y = hungarian.max_bp_match_csr(indptr, indices, 4)
+        self.assertEqual((match_x != -1).sum(), 3)
+        for x in xrange(4):
+            if match_x[x] != -1:
+                self.assertEqual(G[x, match_x[x]], 1)
+                self.assertEqual(match_y[match_x[x]], x)
+        self.assertEqual((match_y != -1).sum(), 3)
+        M = hungarian.max_bp_match(G)
+        self.assertEqual(M.dtype, G.dtype)
+        self.assertEqual(M.sum(), 3)
+        self.assertTrue((M <= G).all())
+
+        pass
+
+    def test_max_bp_match_3(self):
+        random = np.random.RandomState(0)
+        for ii in xrange(50):
+            n_X = random.randint(1, 8)
+            n_Y = random.randint(1, 8)
+            G = (random.rand(n_X, n_Y) < 0.3).astype('int32')
+            M = hungarian.max_bp_match(G)
+            M_flow = hungarian.max_bp_match_flow(G)
+            self.assertTrue((M.sum(axis=0) <= 1).all())
+            self.assertTrue((M.sum(axis=1) <= 1).all())
+            self.assertTrue((M <= G).all())
+            self.assertEqual(M.sum(), M_flow.sum())
+
+        pass
+
     def test_is_bp_match_saturate_1(self):
         M = np.array([[0, 1, 0],
                       [0, 0, 1],
@@ -144,6 +182,199 @@ class HungarianTests(unittest.TestCase):
 
         pass
 
+    def _check_cover(self, W, c_0, c_1, M):
+        """Checks the matching is max weighted and the cover is tight."""
+        n_X = W.shape[0]
+        n_Y = W.shape[1]
+        if n_X <= n_Y:
+            best = max([W[np.arange(n_X), list(p)].sum() for p in
+                        itertools.permutations(range(n_Y), n_X)])
+        else:
+            best = max([W[list(p), np.arange(n_Y)].sum() for p in
+                        itertools.permutations(range(n_X), n_Y)])
+        self.assertTrue((M.sum(axis=0) <= 1).all())
+        self.assertTrue((M.sum(axis=1) <= 1).all())
+        self.assertEqual(M.sum(), min(n_X, n_Y))
+        self.assertTrue(np.allclose((W * M).sum(), best))
+        C = c_0.reshape([-1, 1]) + c_1.reshape([1, -1])
+        self.assertTrue((C >= W - 1e-5).all())
+        self.assertTrue(np.allclose(C[M == 1], W[M == 1]))
+        self.assertTrue(np.allclose(c_0.sum() + c_1.sum(), best))
+
+        pass
+
+    def test_min_weighted_bp_cover_fast_1(self):
+        W = np.array([[5, 0, 4, 0],
+                      [0, 4, 6, 8],
+                      [4, 0, 5, 7]])
+        c_0, c_1, M = hungarian.min_weighted_bp_cover_fast(W)
+        c_0_t = np.array([5, 6, 5])
+        c_1_t = np.array([0, 0, 0, 2])
+        self.assertTrue((c_0 == c_0_t).all())
+        self.assertTrue((c_1 == c_1_t).all())
+        self._check_cover(W, c_0, c_1, M)
+
+        W = np.array([[-5, -3, -4, -4],
+                      [-2, -4, -6, -8],
+                      [-4, -5, -5, -7]])
+        c_0, c_1, M = hungarian.min_weighted_bp_cover_fast(W)
+        c_0_t = np.array([-3, -3, -5])
+        c_1_t = np.array([1, 0, 0, 0])
+        M_t = np.array([[0, 1, 0, 0],
+                        [1, 0, 0, 0],
+                        [0, 0, 1, 0]])
+        self.assertTrue((c_0 == c_0_t).all())
+        self.assertTrue((c_1 == c_1_t).all())
+        self.assertTrue((M == M_t).all())
+
+        pass
+
+    def test_min_weighted_bp_cover_fast_2(self):
+        W = np.array([[5, 0],
+                      [3, 1],
+                      [0, 5],
+                      [4, 4]])
+        c_0, c_1, M = hungarian.min_weighted_bp_cover_fast(W)
+        self._check_cover(W, c_0, c_1, M)
+        self.assertTrue((c_0 >= 0).all())
+        self._check_cover(W.T, *hungarian.min_weighted_bp_cover_fast(W.T))
+
+        pass
+
+    def test_min_weighted_bp_cover_fast_3(self):
+        random = np.random.RandomState(0)
+        for ii in xrange(100):
+            n_X = random.randint(1, 6)
+            n_Y = random.randint(1, 6)
+            if ii % 2 == 0:
+                W = random.randint(-5, 10, size=[n_X, n_Y])
+            else:
+                W = random.rand(n_X, n_Y).astype('float32')
+            c_0, c_1, M = hungarian.min_weighted_bp_cover_fast(W)
+            self.assertEqual(c_0.dtype, W.dtype)
+            self._check_cover(W, c_0, c_1, M)
+
+        pass
+
+    def test_batch_match(self):
+        random = np.random.RandomState(1)
+        W = random.randint(0, 100, size=[6, 4, 3])
+        c_0, c_1, M = hungarian.batch_match(W, workers=1)
+        self.assertEqual(c_0.shape, (6, 4))
+        self.assertEqual(c_1.shape, (6, 3))
+        self.assertEqual(c_0.dtype, W.dtype)
+        for b in xrange(6):
+            self._check_cover(W[b], c_0[b], c_1[b], M[b])
+
+        # Batches matched in the pool, growing its shared arrays.
+        results = hungarian.batch_match(W, workers=2, min_pool_batch_size=0)
+        for x, y in zip(results, [c_0, c_1, M]):
+            self.assertTrue((x == y).all())
+        W = random.rand(20, 5, 7)
+        results = hungarian.batch_match(W, workers=2, min_pool_batch_size=0)
+        for b in xrange(20):
+            c_0, c_1, M = hungarian.min_weighted_bp_cover_fast(W[b])
+            self.assertTrue((results[0][b] == c_0).all())
+            self.assertTrue((results[1][b] == c_1).all())
+            self.assertTrue((results[2][b] == M).all())
+
+        self.assertRaises(Exception, hungarian.batch_match, W[0])
+
+        pass
+
+    def test_match_cache(self):
+        random = np.random.RandomState(2)
+        cache = hungarian.MatchCache(max_size=2)
+        W = random.rand(5, 5)
+        self._check_cover(W, *cache.match(0, W))
+        stats = cache.get_stats()
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['augmentations'], 5)
+
+        # Same weights, the last matching is kept as is.
+        self._check_cover(W, *cache.match(0, W))
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['augmentations'], 5)
+        self.assertEqual(stats['augmentations_saved'], 5)
+
+        # Slowly changing and rectangular weights.
+        for key, shape in [(0, (5, 5)), (1, (3, 5)), (2, (5, 3))]:
+            W = random.rand(*shape)
+            for step in xrange(5):
+                W = np.clip(W + random.normal(0, 0.05, size=shape), 0, 1)
+                c_0, c_1, M = cache.match(key, W)
+                self._check_cover(W, c_0, c_1, M)
+                self.assertTrue(np.allclose(
+                    (W * M).sum(),
+                    (W * hungarian.min_weighted_bp_cover_fast(W)[2]).sum()))
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'], 14)
+        self.assertEqual(stats['items'], 2)
+        self.assertTrue(stats['augmentations_saved'] > 5)
+
+        # A new shape of a key starts cold.
+        W = random.randint(0, 100, size=[4, 3])
+        self._check_cover(W, *cache.match(2, W))
+        self.assertEqual(cache.get_stats()['misses'], 4)
+
+        # Batches keyed by example index.
+        W = random.rand(3, 4, 4)
+        c_0, c_1, M = hungarian.batch_match(
+            W, cache=cache, keys=[10, 11, 12])
+        for b in xrange(3):
+            self._check_cover(W[b], c_0[b], c_1[b], M[b])
+        self.assertEqual(len(cache), 2)
+        self.assertRaises(Exception, hungarian.batch_match, W, cache=cache)
+
+        pass
+
+    def test_get_bp_components(self):
+        # x0 - y1 - x2 - y3, x1 - y0, x3 and y2 isolated.
+        rows = np.array([0, 2, 2, 1])
+        cols = np.array([1, 1, 3, 0])
+        labels_x, labels_y = hungarian.get_bp_components(rows, cols, 4, 4)
+        self.assertEqual(labels_x[0], labels_x[2])
+        self.assertEqual(labels_x[0], labels_y[1])
+        self.assertEqual(labels_x[0], labels_y[3])
+        self.assertEqual(labels_x[1], labels_y[0])
+        self.assertNotEqual(labels_x[0], labels_x[1])
+        self.assertEqual(len(set(labels_x) | set(labels_y)), 4)
+
+        pass
+
+    def test_sparse_match(self):
+        W = np.array([[0.9, 0.5, 0, 0, 0],
+                      [0.8, 0, 0, 0, 0],
+                      [0, 0, 0, 0, 0.3],
+                      [0, 0, 0, -0.2, 0]])
+        rows, cols = W.nonzero()
+        match_x, match_y = hungarian.sparse_match(
+            rows, cols, W[rows, cols], 4, 5)
+        self.assertEqual(list(match_x), [1, 0, 4, -1])
+        self.assertEqual(list(match_y), [1, 0, -1, -1, 2])
+        indptr, indices = hungarian.get_bp_csr(W)
+        match_x_csr, match_y_csr = hungarian.sparse_match_csr(
+            indptr, indices, W[rows, cols], 5)
+        self.assertTrue((match_x_csr == match_x).all())
+
+        random = np.random.RandomState(2)
+        for ii in xrange(50):
+            n_X = random.randint(1, 9)
+            n_Y = random.randint(1, 9)
+            W = random.rand(n_X, n_Y) * (random.rand(n_X, n_Y) < 0.25)
+            rows, cols = W.nonzero()
+            match_x, match_y = hungarian.sparse_match(
+                rows, cols, W[rows, cols], n_X, n_Y)
+            matched = (match_x != -1).nonzero()[0]
+            self.assertTrue((W[matched, match_x[matched]] > 0).all())
+            self.assertTrue((match_y[match_x[matched]] == matched).all())
+            M = hungarian.min_weighted_bp_cover_fast(W)[2]
+            self.assertAlmostEqual(W[matched, match_x[matched]].sum(),
+                                   (W * M).sum())
+
+        pass
+
 if __name__ == '__main__':
     # unittest.main()
     suite = unittest.TestLoader().loadTestsFromTestCase(HungarianTests)
@@ -55,13 +55,17 @@ Example:
 from data_api import MSCOCO
 from utils import logger
 from utils import progress_bar
-from utils.sharded_hdf5 import ShardedFile, ShardedFileReader, ShardedFileWriter
+from utils.sharded_hdf5 import ItemCache, ShardedFile, ShardedFileReader, \
+    ShardedFileWriter
 import argparse
 import numpy as np
 import os
 
 log = logger.get()
 
+# Number of questions whose features are looked up together.
+KEY_BATCH_SIZE = 1000
+
 
 def parse_args():
     """Parse input arguments."""
@@ -77,72 +81,88 @@ def parse_args():
                         help='Number of output example per shard')
     parser.add_argument('-local_feat', default=None,
                         help='Local feature layer name')
+    parser.add_argument('-feature_cache_mb', default=256, type=int,
+                        help='Size of the cache of image features in MB')
     args = parser.parse_args()
 
     return args
 
 
-def pack_data(mscoco, info_file, feature_file, local_feat, output_fname, num_ex_per_shards):
+def pack_data(mscoco, info_file, feature_file, local_feat, output_fname,
+              num_ex_per_shards, feature_cache_mb=256):
     """Pack data together"""
     inps = []
-    with ShardedFileReader(info_file) as info_reader:
+    with ShardedFileReader(info_file,
+                           batch_size=KEY_BATCH_SIZE) as info_reader:
         num_obj = len(info_reader)
         log.info('Number of entries: {:d}'.format(num_obj))
         pb = progress_bar.get(num_obj)
         num_shards = int(np.ceil(num_obj / float(num_ex_per_shards)))
         output_file = ShardedFile(output_fname, num_shards=num_shards)
-        with ShardedFileReader(feature_file) as feature_reader:
+        feature_fields = ['boxes', 'categories', 'scores']
+        if local_feat is not None:
+            feature_fields.append(local_feat)
+        # Several questions share an image, keep its features decoded.
+        feature_cache = ItemCache(max_bytes=feature_cache_mb * 1024 * 1024)
+        with ShardedFileReader(feature_file, fields=feature_fields,
+                               item_cache=feature_cache) as feature_reader:
             with ShardedFileWriter(output_file, num_objects=num_obj) as writer:
-                for question_entry in info_reader:
-                    image_id = question_entry['image_id']
-                    image_path = mscoco.get_image_path(image_id)
-
-                    feature = feature_reader[image_path]
-                    if feature is None:
-                        raise Exception(
-                            'Key {} not found in feature'.format(image_path))
-
-                    if local_feat is None:
-                        local_feat_dim = 0
-                    else:
-                        local_feat_dim = feature[local_feat].shape[-1]
-
-                    if len(feature['boxes'].shape) == 1:
-                        num_boxes = 1
-                    elif len(feature['boxes'].shape) == 2:
-                        num_boxes = feature['boxes'].shape[0]
-                    else:
-                        raise Exception('Unknown shape for boxes {}'.format(
-                            feature['boxes'].shape))
-
-                    inp_dim = 4 + 1 + 1 + local_feat_dim
-                    inp = np.zeros((num_boxes, inp_dim), dtype='float32')
-
-                    for box_i in xrange(num_boxes):
-                        if num_boxes == 1:
-                            inp[box_i, :4] = feature['boxes']
-                            inp[box_i, 4] = feature['categories']
-                            inp[box_i, 5] = feature['scores']
-                            if local_feat:
-                                inp[box_i, 6:] = feature[local_feat]
+                for question_entries in info_reader:
+                    # Look up features of the whole batch, grouped by shard.
+                    image_paths = [mscoco.get_image_path(e['image_id'])
+                                   for e in question_entries]
+                    features = feature_reader.read_keys(image_paths)
+                    for question_entry, image_path, feature in zip(
+                            question_entries, image_paths, features):
+                        image_id = question_entry['image_id']
+                        if feature is None:
+                            raise Exception('Key {} not found in feature'.format(
+                                image_path))
+
+                        if local_feat is None:
+                            local_feat_dim = 0
                         else:
-                            inp[box_i, :4] = feature['boxes'][box_i]
-                            inp[box_i, 4] = feature['categories'][box_i]
-                            inp[box_i, 5] = feature['scores'][box_i]
-                            if local_feat:
-                                inp[box_i, 6:] = feature[local_feat][box_i]
-
-                    inp = inp.reshape(num_boxes * inp_dim)
-                    cat = np.array([question_entry['category']])
-                    total_inp = np.concatenate((cat, inp)).astype('float32')
+                            local_feat_dim = feature[local_feat].shape[-1]
 
-                    data = {
-                        'image_id': image_id,
-                        'input': total_inp,
-                        'label': int(question_entry['number'])
-                    }
-                    writer.write(data)
-                    pb.increment()
+                        if len(feature['boxes'].shape) == 1:
+                            num_boxes = 1
+                        elif len(feature['boxes'].shape) == 2:
+                            num_boxes = feature['boxes'].shape[0]
+                        else:
+                            raise Exception(
+                                'Unknown shape for boxes {}'.format(
+                                    feature['boxes'].shape))
+
+                        inp_dim = 4 + 1 + 1 + local_feat_dim
+                        inp = np.zeros((num_boxes, inp_dim), dtype='float32')
+
+                        for box_i in xrange(num_boxes):
+                            if num_boxes == 1:
+                                inp[box_i, :4] = feature['boxes']
+                                inp[box_i, 4] = feature['categories']
+                                inp[box_i, 5] = feature['scores']
+                                if local_feat:
+                                    inp[box_i, 6:] = feature[local_feat]
+                            else:
+                                inp[box_i, :4] = feature['boxes'][box_i]
+                                inp[box_i, 4] = feature['categories'][box_i]
+                                inp[box_i, 5] = feature['scores'][box_i]
+                                if local_feat:
+                                    inp[box_i, 6:] = feature[local_feat][box_i]
+
+                        inp = inp.reshape(num_boxes * inp_dim)
+                        cat = np.array([question_entry['category']])
+                        total_inp = np.concatenate(
+                            (cat, inp)).astype('float32')
+
+                        data = {
+                            'image_id': image_id,
+                            'input': total_inp,
+                            'label': int(question_entry['number'])
+                        }
+                        writer.write(data)
+                        pb.increment()
+        log.info('Feature cache: {}'.format(feature_cache.get_stats()))
 
 
 if __name__ == '__main__':
@@ -163,4 +183,5 @@ if __name__ == '__main__':
         os.makedirs(dirname)
 
     pack_data(mscoco, info_file, feature_file, args.local_feat,
-              args.output, args.num_ex_per_shards)
+              args.output, args.num_ex_per_shards,
+              feature_cache_mb=args.feature_cache_mb)
@@ -123,13 +123,6 @@ def _f_best_dice(a, b):
     return bd
 
 
-def _f_match(iou_pairwise):
-    sess = tf.Session()
-    tf_match = tf.user_ops.hungarian(
-        tf.constant(iou_pairwise.astype('float32')))[0]
-    return tf_match.eval(session=sess)
-
-
 def f_ins_iou(y_out, y_gt, s_out, s_gt):
     """Calculates average instance-level IOU..
 
@@ -148,13 +141,17 @@ def f_ins_iou(y_out, y_gt, s_out, s_gt):
         y_out_ = np.expand_dims(y_out[ii], 1)
         y_gt_ = np.expand_dims(y_gt[ii], 0)
         iou_pairwise = _f_iou(y_out_, y_gt_)
-        iou_pairwise = np.maximum(1e-4, iou_pairwise)
         iou_pairwise = np.round(iou_pairwise * 1e4) / 1e4
-        match = _f_match(iou_pairwise)
-        match[num_obj[ii]:, :] = 0.0
-        match[:, num_obj[ii]:] = 0.0
-        ins_iou[ii] = (iou_pairwise * match).sum(
-            axis=-1).sum(axis=-1) / num_obj[ii]
+        # Only overlapping pairs are matched, the others stay unmatched.
+        rows, cols = iou_pairwise.nonzero()
+        match_x = hungarian.sparse_match(
+            rows, cols, iou_pairwise[rows, cols], iou_pairwise.shape[0],
+            iou_pairwise.shape[1])[0]
+        matched = (match_x != -1).nonzero()[0]
+        matched = matched[np.logical_and(
+            matched < num_obj[ii], match_x[matched] < num_obj[ii])]
+        ins_iou[ii] = iou_pairwise[matched, match_x[matched]].sum() / \
+            num_obj[ii]
     return ins_iou
 
 
@@ -13,10 +13,31 @@ Storing of a bundle of sharded files for homogeneous data type.
     - /path/folder/example-00003-of-00005.h5
     - /path/folder/example-00004-of-00005.h5
 
+    A manifest sidecar is written next to the shards when the writer closes:
+    /path/folder/file_prefix-manifest-of-{num_shards}.json
+    e.g.
+    - /path/folder/example-manifest-of-00005.json
+
+    A sorted key index is written with the manifest, as two numpy files:
+    /path/folder/file_prefix-keys-of-{num_shards}.npy, sorted keys.
+    /path/folder/file_prefix-keyloc-of-{num_shards}.npy, int64 array,
+    (shard index << 32) | position in shard, aligned with the sorted keys.
+    The reader memory-maps both and looks up keys with binary search.
+
+    A Bloom filter of all keys is written with the key index:
+    /path/folder/file_prefix-bloom-of-{num_shards}.npy, uint8 bit array.
+    Until the key index is needed, the reader answers missing keys from it,
+    and looks up other keys only in shards whose own Bloom filter may hold
+    them. The Bloom filters of the shards are written next to it, so they are
+    checked without opening the shards:
+    /path/folder/file_prefix-shardbloom-of-{num_shards}.npy, uint8 array,
+    [num_shards, num_bytes], filters of the same size.
+
     2. HDF5 structure
     {
         '__num_items__': 1 elem numpy.ndarray, number of items in this file.
         '__keys__': 1D numpy.ndarray, look up keys.
+        '__bloom__': 1D uint8 numpy.ndarray, Bloom filter bits of the keys.
         '__sep_key1__': 1D int64 array storing position of each item.
         '__sep_key2__': 1D int64 array storing position of each item.
         'key1': 1-2D numpy.ndarray, 1st dimension is concatenated.
@@ -24,7 +45,22 @@ Storing of a bundle of sharded files for homogeneous data type.
         ...
     }
 
-    3. Object mapping
+    3. Manifest structure (JSON)
+    {
+        'version': 1,
+        'num_shards': number of shards.
+        'num_items': total number of items.
+        'fields': {'key1': {'dtype': numpy dtype string, 'shape': trailing
+                   dimensions, 'chunks', 'compression', 'compression_opts',
+                   'shuffle': HDF5 storage layout}, ...}
+        'shards': [{'num_items': number of items, 'size': file size in bytes,
+                    'nbytes': {'key1': bytes of field data, ...}}, ...]
+    }
+    The reader builds its index from the manifest without opening any shard,
+    and falls back to scanning the shards if the manifest is missing or any
+    shard size does not match.
+
+    4. Object mapping
     {
         'key1': 1-2D numpy.ndarray, maps to 2D numpy.ndarray in the file.
         'key2': string, int, float, maps to 1D numpy.ndarray in the file.
@@ -35,6 +71,10 @@ Storing of a bundle of sharded files for homogeneous data type.
     1. ShardedFile
     2. ShardedFileReader
     3. ShardedFileWriter
+    4. ParallelShardedFileWriter
+    5. ShuffledIterator
+    6. ItemCache
+    7. AsyncShardedFileReader
 
 ==Examples
     1. Read: iterate everything
@@ -49,6 +89,8 @@ Storing of a bundle of sharded files for homogeneous data type.
     >>     for items in reader:
     >>         do(items)
 
+    Pass prefetch=N to read the next N batches on a background thread.
+
     3. Read: iterate from a position
     >> f = ShardedFile('a', num_shards=100)
     >> with ShardedFileReader(f) as reader:
@@ -66,28 +108,87 @@ Storing of a bundle of sharded files for homogeneous data type.
     >> with ShardedFileReader(f) as reader:
     >>     item = reader[key]
 
-    6. Write a list
+    Pass fields=[...] to the reader, or to read, read_key and read_keys, to
+    read only some of the fields.
+
+    Pass mmap=True to the reader to get views of memory-mapped shards for
+    contiguous uncompressed fields, and copy=True to a read to own the data.
+
+    6. Read: random access with a list of keys, grouped by shard
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ShardedFileReader(f) as reader:
+    >>     items = reader.read_keys(keys)
+
+    Pass item_cache=ItemCache(max_bytes) to the reader to cache items read
+    by key, the cache can be shared by readers in several threads.
+
+    AsyncShardedFileReader(f) reads on background threads, its get,
+    get_many and read_next return futures, e.g. for an event loop. Requests
+    queued at the same time for the same shard share range reads.
+
+    Call reader.read_batch(num_items) or pass collate=True to the reader to
+    get a dict of stacked columns instead of a list of items.
+
+    Call reader.partition(worker_id, num_workers) to get a reader over a
+    disjoint part of the file for each worker.
+
+    7. Read: shuffled epochs with a bounded buffer, resumable
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ShardedFileReader(f) as reader:
+    >>     shuffled = ShuffledIterator(reader, buffer_size=1000, seed=2)
+    >>     shuffled.set_state(saved_state)
+    >>     for epoch in xrange(10):
+    >>         for item in shuffled:
+    >>             do(item)
+    >>             saved_state = shuffled.get_state()
+
+    8. Write a list
     >> f = ShardedFile('a', num_shards=100)
     >> with ShardedFileWriter(f, num_objects=1000) as writer:
     >>     for i in xrange(1000):
     >>         writer.write(item[i])
 
-    7. Write a dictionary (see example 5 for reading dictionary)
+    9. Write a dictionary (see example 5 for reading dictionary)
     >> f = ShardedFile('a', num_shards=100)
     >> with ShardedFileWriter(f, num_objects=1000) as writer:
     >>     for i in xrange(1000):
     >>         writer.write(item, key=key)
+
+    Call writer.write_many(columns, keys=keys) to write items stacked along
+    the first dimension, or (values, lengths) for ragged fields, in bulk.
+
+    10. Write with flat memory, appending 256 items at a time
+    >> f = ShardedFile('a', num_shards=100)
+    >> with ShardedFileWriter(f, num_objects=1000, block_size=256) as writer:
+    >>     for i in xrange(1000):
+    >>         writer.write(item[i])
+
+    11. Write with 8 processes, produce(start, end) yields (item, key)
+    >> f = ShardedFile('a', num_shards=100)
+    >> ParallelShardedFileWriter(f, 1000, num_workers=8).run(produce)
+
+    12. Write with compression
+    >> f = ShardedFile('a', num_shards=100)
+    >> opts = {'mask': {'compression': 'gzip', 'shuffle': True}}
+    >> with ShardedFileWriter(f, 1000, field_options=opts) as writer:
+    >>     for i in xrange(1000):
+    >>         writer.write(item[i])
 """
 
 
 import bisect
+import collections
 import fnmatch
 import h5py
+import json
 import logger
 import math
+import multiprocessing
 import numpy
 import os
+import Queue
 import re
+import threading
 
 log = logger.get()
 
@@ -101,8 +202,26 @@ KEY_SEPARATOR = '__sep_{}__'
 KEY_SEPARATOR_RE = re.compile('^__sep_([^_]+)__$')
 KEY_SEPARATOR_PREFIX = '__sep_'
 KEY_KEYS = '__keys__'
+KEY_BLOOM = '__bloom__'
 FILE_PATTERN = re.compile(
     '^(?P<prefix>.*)-(?P<shard>[0-9]{5})-of-(?P<total>[0-9]{5})(?P<suffix>.*)$')
+SIDECAR_PATTERN = re.compile(
+    '^(?P<prefix>.*)-(?P<kind>[a-z]+)-of-(?P<total>[0-9]{5})(?P<suffix>.*)$')
+MANIFEST_VERSION = 1
+DEFAULT_MAX_OPEN_FILES = 8
+PREFETCH_POLL_SECS = 0.1
+STREAM_CHUNK_BYTES = 512 * 1024
+FIELD_OPTIONS = ['compression', 'compression_opts', 'shuffle', 'chunks']
+LOC_SHARD_SHIFT = 32
+FNV_OFFSET = 14695981039346656037
+FNV_PRIME = 1099511628211
+BLOOM_BITS_PER_KEY = 10
+BLOOM_NUM_HASHES = 7
+MAX_COALESCED_REQUESTS = 256
+MAX_READ_GAP = 8
+REQUEST_KEYS = 'keys'
+REQUEST_NEXT = 'next'
+LOC_POS_MASK = (1 << LOC_SHARD_SHIFT) - 1
 
 
 def _get_sep_from_key(key):
@@ -167,6 +286,8 @@ class ShardedFile(object):
 
         for fname in os.listdir(dirname):
             fullname = os.path.join(dirname, fname)
+            if SIDECAR_PATTERN.match(fname):
+                continue
             if fnmatch.fnmatch(fullname, file_pattern):
                 flist.append(fullname)
 
@@ -217,371 +338,1759 @@ class ShardedFile(object):
         return '{}-{:05d}-of-{:05d}{}'.format(
             self.file_prefix, shard, self.num_shards, self.suffix)
 
-
-class ShardedFileReader(object):
-    """Shareded file reader.
-    """
-
-    def __init__(self, sharded_file,
-                 key_name=KEY_KEYS, batch_size=1, check=True):
-        """Construct a sharded file reader instance.
+    def get_sidecar_fname(self, kind, suffix):
+        """Get the file name for a sidecar file of the whole bundle.
 
         Args:
-            sharded_file: SharededFile instance.
-            key_name: Name of key field for random access (optional).
-            batch_size: number, average batch_size for each read. The actual 
-            size depends on the number of items in a file so is not guaranteed 
-            to be the same size.
+            kind: string, lower case letters, type of the sidecar.
+            suffix: string, file extension of the sidecar.
         """
-        self.file = sharded_file
+        return '{}-{}-of-{:05d}{}'.format(
+            self.file_prefix, kind, self.num_shards, suffix)
 
-        # Batch size of reading.
-        self.batch_size = batch_size
-
-        # Position index in each file for binary search.
-        self._file_index = None
+    def get_manifest_fname(self):
+        """Get the file name for the manifest."""
+        return self.get_sidecar_fname('manifest', '.json')
 
-        # Reader position.
-        self._pos = 0
+    def get_key_index_fnames(self):
+        """Get the file names for the sorted keys and their locations."""
+        return (self.get_sidecar_fname('keys', '.npy'),
+                self.get_sidecar_fname('keyloc', '.npy'))
 
-        # Current file ID.
-        self._cur_fid = 0
+    def get_bloom_fname(self):
+        """Get the file name of the Bloom filter of all keys."""
+        return self.get_sidecar_fname('bloom', '.npy')
 
-        # Current file handler.
-        self._fh = None
+    def get_shard_bloom_fname(self):
+        """Get the file name of the Bloom filters of the shards."""
+        return self.get_sidecar_fname('shardbloom', '.npy')
 
-        # Whether need to refresh file handler in the next read.
-        self._need_refresh = False
+    def get_sidecar_fnames(self):
+        """Get the file names of all sidecars."""
+        return [self.get_manifest_fname()] + \
+            list(self.get_key_index_fnames()) + \
+            [self.get_bloom_fname(), self.get_shard_bloom_fname()]
 
-        # Current file separator.
-        self._cur_sep = {}
 
-        # Index based on keys.
-        self._key_index = None
+def _pack_loc(shard, pos):
+    """Pack shard index and position in shard into one int64."""
+    return (numpy.int64(shard) << LOC_SHARD_SHIFT) | \
+        numpy.asarray(pos, dtype='int64')
 
-        # Name of the key field.
-        self._key_name = key_name
 
-        # Check files all exist.
-        if check:
-            self._check_files()
+def _unpack_loc(loc):
+    """Unpack an int64 location into shard index and position in shard."""
+    return int(loc >> LOC_SHARD_SHIFT), int(loc & LOC_POS_MASK)
 
-        pass
 
-    def __iter__(self):
-        """Get an iterator."""
-        return self
+class SortedKeyIndex(object):
+    """Key index backed by a sorted key array and a location array.
 
-    def __getitem__(self, key):
-        """Get item based on key"""
-        return self.read_key(key)
+    Supports the subset of dict interface used by the reader.
+    """
 
-    def __enter__(self):
-        """Enter with clause."""
-        return self
+    def __init__(self, keys, locs):
+        """Construct a sorted key index.
 
-    def __exit__(self, type, value, traceback):
-        """Exit with clause."""
-        if self._fh is not None:
-            self._fh.close()
-            self._fh = None
+        Args:
+            keys: 1D numpy.ndarray, sorted keys, can be a numpy.memmap.
+            locs: 1D int64 numpy.ndarray, packed location of each key.
+        """
+        self._keys = keys
+        self._locs = locs
 
         pass
 
     def __len__(self):
-        """Get total number of items."""
-        return self.get_num_items()
+        return self._keys.shape[0]
 
     def __contains__(self, key):
-        """Check whether a key is contained in the file."""
-        # Lazy build key index.
-        if self._key_index is None:
-            if self._key_name:
-                self._build_key(self._key_name)
-            else:
-                raise Exception(
-                    'You need to specify key field in the constructor.')
+        return self._find(key) >= 0
+
+    def _find(self, key):
+        """Find the index of a key in the sorted array, -1 if not found."""
+        try:
+            # The last duplicate wins, same as the dict index.
+            idx = numpy.searchsorted(self._keys, key, side='right') - 1
+        except (TypeError, ValueError):
+            return -1
+        if idx >= 0 and self._keys[idx] == key:
+            return idx
+        else:
+            return -1
 
-        return key in self._key_index
+    def get(self, key, default=None):
+        """Get the (shard, position) tuple of a key."""
+        idx = self._find(key)
+        if idx < 0:
+            return default
+        else:
+            return _unpack_loc(self._locs[idx])
 
-    def _check_files(self):
-        """Check existing files"""
+    def keys(self):
+        return self._keys.tolist()
 
-        fname_re = re.compile(
-            '({})-([0-9]{{5}})-of-{:05d}{}'.format(
-                self.file.basename,
-                self.file.num_shards,
-                self.file.suffix))
-        dirname = os.path.dirname(os.path.abspath(self.file.file_prefix))
-        files_in_dir = os.listdir(dirname)
-        found_files = {}
+    def iterkeys(self):
+        for idx in xrange(self._keys.shape[0]):
+            yield self._keys[idx].item()
 
-        # Look for files in the expected pattern.
-        for fname in files_in_dir:
-            match = fname_re.match(fname)
-            if match is not None:
-                index_str = match.groups()[1]
-                index_int = int(index_str)
-                if index_int >= self.file.num_shards:
-                    raise Exception(ERR_MSG_IDX_TOO_LARGE.format(fname))
-                if index_int in found_files:
-                    raise Exception(ERR_MSG_DUPE_FILES.format(index_int))
-                found_files[index_int] = fname
 
-        # Check all files in the sequence exist.
-        for idx in xrange(self.file.num_shards):
-            if idx not in found_files:
-                raise Exception(ERR_MSG_MISSING_FILE.format(
-                    idx, self.file.num_shards))
+def _hash_keys(keys):
+    """Hash string keys with 64-bit FNV-1a, vectorized over the keys.
 
-        log.info('Check file success: {}'.format(self.file.file_prefix))
+    Trailing null bytes are skipped, so the hash does not depend on the
+    width of the string array.
 
-        pass
+    Args:
+        keys: 1D numpy.ndarray or list of keys.
+    Returns:
+        hashes: 1D uint64 numpy.ndarray.
+    """
+    keys = numpy.asarray(keys)
+    if keys.dtype.kind != 'S':
+        keys = keys.astype('S')
+    keys = numpy.ascontiguousarray(keys)
+    chars = keys.view('uint8').reshape([keys.shape[0], keys.dtype.itemsize])
+    hashes = numpy.zeros([keys.shape[0]], dtype='uint64') + \
+        numpy.uint64(FNV_OFFSET)
+    prime = numpy.uint64(FNV_PRIME)
+    for col in xrange(chars.shape[1]):
+        c = chars[:, col].astype('uint64')
+        used = c != 0
+        hashes[used] = (hashes[used] ^ c[used]) * prime
+
+    return hashes
+
+
+class HashedKeyIndex(object):
+    """Key index backed by sorted key hashes and a location array.
+
+    Keys themselves are not kept in memory. A hash match is checked against
+    the key stored in the shard, read by the caller, so readers sharing the
+    index each read through their own open shards.
+    """
 
-    def _build_index(self):
-        """Build a mapping from an index to shard number.
+    def __init__(self, hashes, locs):
+        """Construct a hashed key index.
 
-        Returns:
-            file_index: list, end element id - 1 of each shard.
+        Args:
+            hashes: 1D uint64 numpy.ndarray, sorted key hashes.
+            locs: 1D int64 numpy.ndarray, packed location of each key.
         """
-        log.info('Building index of file {}'.format(self.file.basename))
-        file_index = []
-        index = 0
-        for shard_idx in xrange(self.file.num_shards):
-            fname = self.file.get_fname(shard_idx)
-            fh = h5py.File(fname, 'r')
-            if KEY_NUM_ITEM in fh:
-                num_items = fh[KEY_NUM_ITEM][0]
-            else:
-                raise Exception(ERR_MSG_MISSING_NUM_ITEMS_FIELD.format(fname))
-            index += num_items
-            file_index.append(index)
+        self._hashes = hashes
+        self._locs = locs
 
-        return file_index
+        pass
 
-    def _build_key(self, key_name):
-        """Build a mapping from a key to shard number and position.
+    def __len__(self):
+        return self._hashes.shape[0]
+
+    def _find(self, key, read_keys):
+        """Find the index of a key in the sorted array, -1 if not found."""
+        try:
+            h = _hash_keys([key])[0]
+        except (TypeError, ValueError, UnicodeError):
+            return -1
+        start = numpy.searchsorted(self._hashes, h, side='left')
+        end = numpy.searchsorted(self._hashes, h, side='right')
+        # The last duplicate wins, same as the dict index.
+        for idx in xrange(end - 1, start - 1, -1):
+            shard, pos = _unpack_loc(self._locs[idx])
+            if read_keys(shard, pos, pos + 1)[0] == key:
+                return idx
+
+        return -1
+
+    def lookup(self, key, read_keys):
+        """Get the (shard, position) tuple of a key.
 
         Args:
-            key_name: string, name of the key field.
+            key: string, key of the item.
+            read_keys: function (shard, start, end), reads stored keys.
+        Returns:
+            location: tuple of shard index and position, None if not found.
         """
-        log.info('Building key index of file {}'.format(self.file.basename))
-        self._key_index = {}
-        for shard_idx in xrange(self.file.num_shards):
-            fname = self.file.get_fname(shard_idx)
-            fh = h5py.File(fname, 'r')
-            if key_name in fh:
-                key_index_i = fh[key_name][:]
-                num_keys = key_index_i.shape[0]
+        idx = self._find(key, read_keys)
+        if idx < 0:
+            return None
+        else:
+            return _unpack_loc(self._locs[idx])
 
-                if KEY_NUM_ITEM in fh:
-                    num_items = fh[KEY_NUM_ITEM][0]
-                else:
-                    raise Exception(
-                        ERR_MSG_MISSING_NUM_ITEMS_FIELD.format(fname))
+    def iterkeys(self, read_keys):
+        """Get an iterable of the keys, in file order.
 
-                if num_keys != num_items:
-                    raise Exception(
-                        'Number of keys not equal to number of items')
+        Args:
+            read_keys: function (shard, start, end), reads stored keys.
+        """
+        shards = numpy.right_shift(self._locs, LOC_SHARD_SHIFT)
+        counts = numpy.bincount(shards)
+        for shard in xrange(counts.shape[0]):
+            if counts[shard] > 0:
+                for key in read_keys(shard, 0, counts[shard]):
+                    yield key
 
-                for key_idx in xrange(key_index_i.shape[0]):
-                    k = key_index_i[key_idx]
-                    self._key_index[k] = (shard_idx, key_idx)
-            else:
-                raise Exception(
-                    'Key "{}" not found in the file {}'.format(
-                        key_name, fname))
 
-        pass
+def _get_bloom_hashes(keys):
+    """Hash int or string keys to 64 bits for Bloom filters.
 
-    def find(self, index):
-        """Find the file id.
+    Args:
+        keys: 1D numpy.ndarray or list of keys.
+    Returns:
+        hashes: 1D uint64 numpy.ndarray.
+    """
+    keys = numpy.asarray(keys)
+    if keys.dtype.kind in 'iu':
+        # Mix the bits of int keys, splitmix64 finalizer.
+        x = keys.astype('uint64')
+        x ^= x >> numpy.uint64(30)
+        x *= numpy.uint64(0xbf58476d1ce4e5b9)
+        x ^= x >> numpy.uint64(27)
+        x *= numpy.uint64(0x94d049bb133111eb)
+        x ^= x >> numpy.uint64(31)
+        return x
+    else:
+        return _hash_keys(keys)
 
-        Args:
-            index: number, item index.
 
-        """
-        # Lazy build file index.
-        if self._file_index is None:
-            self._file_index = self._build_index()
+def _is_bloom_key(key):
+    """Whether a key can be looked up in a Bloom filter. Other types may
+    still compare equal to a stored key."""
+    return isinstance(key, (int, long, str, numpy.integer, numpy.string_))
 
-        return bisect.bisect_left(self._file_index, index)
 
-    def _renew(self):
-        """Move to next file."""
-        self._cur_fid += 1
-        if self._fh is not None:
-            self._fh.close()
-            self._fh = None
-        self._fh = h5py.File(self.file.get_fname(self._cur_fid), 'r')
-        self._need_refresh = False
+def _get_bloom_nbytes(num_keys, bits_per_key=BLOOM_BITS_PER_KEY):
+    """Get the size of a Bloom filter of a number of keys."""
+    return max(8, (num_keys * bits_per_key + 7) // 8)
 
-        pass
 
-    def _build_sep(self):
-        """Build separators."""
-        num_items = self._fh[KEY_NUM_ITEM][0]
-        for key in self._fh.keys():
-            if not key.startswith('__'):
-                sepname = _get_sep_from_key(key)
-                if sepname in self._fh:
-                    self._cur_sep[key] = self._fh[sepname][:]
-                else:
-                    if self._fh[key].shape[0] != num_items:
-                        raise Exception('Unknown sep {}'.format(key))
-                    else:
-                        self._cur_sep[key] = numpy.arange(num_items)
+class BloomFilter(object):
+    """Bloom filter of int or string keys, in a uint8 bit array."""
 
-        pass
+    def __init__(self, bits, num_hashes=BLOOM_NUM_HASHES):
+        """Construct a Bloom filter.
 
-    def _read_item(self, idx):
-        result = {}
-        for key in self._fh.keys():
-            if not key.startswith('__'):
-                # Compute line start and end.
-                if idx == 0:
-                    line_start = 0
-                else:
-                    line_start = self._cur_sep[key][idx - 1]
-                line_end = self._cur_sep[key][idx]
-                if line_start == line_end - 1:
-                    result[key] = self._fh[key][line_start]
-                else:
-                    result[key] = self._fh[key][line_start: line_end]
+        Args:
+            bits: 1D uint8 numpy.ndarray, bit array.
+            num_hashes: number, number of bits set per key.
+        """
+        self.bits = bits
+        self.num_hashes = num_hashes
 
-        return result
+        pass
 
-    def read(self, num_items=1):
-        """Read from the current position.
+    @classmethod
+    def build(cls, hashes, bits_per_key=BLOOM_BITS_PER_KEY, num_bytes=None):
+        """Build a Bloom filter of about 1% false positives.
 
         Args:
-            num_items: number, number of desired items to read. It is not 
-            guaranteed to return the exact same number of items.
+            hashes: 1D uint64 numpy.ndarray, key hashes, see
+            _get_bloom_hashes.
+            bits_per_key: number, size of the filter per key.
+            num_bytes: number, (optional) size of the filter, default is
+            given by bits_per_key.
         Returns:
-            results: list of dict, keys are same with the keys defined in the 
-            file, values are numpy.ndarray.
+            bloom: BloomFilter instance.
         """
-        # Lazy build file index.
-        if self._file_index is None:
-            self._file_index = self._build_index()
+        if num_bytes is None:
+            num_bytes = _get_bloom_nbytes(hashes.shape[0], bits_per_key)
+        bloom = cls(numpy.zeros([num_bytes], dtype='uint8'))
+        if hashes.shape[0] > 0:
+            pos = bloom._get_positions(hashes).ravel()
+            numpy.bitwise_or.at(
+                bloom.bits, pos >> numpy.uint64(3),
+                (numpy.uint64(1) << (pos & numpy.uint64(7))).astype('uint8'))
+
+        return bloom
+
+    def _get_positions(self, hashes):
+        """Get the bit positions of key hashes, with double hashing."""
+        num_bits = numpy.uint64(self.bits.shape[0] * 8)
+        h1 = hashes & numpy.uint64(0xffffffff)
+        h2 = (hashes >> numpy.uint64(32)) | numpy.uint64(1)
+        i = numpy.arange(self.num_hashes, dtype='uint64')
+
+        return (h1[:, None] + i[None, :] * h2[:, None]) % num_bits
 
-        # Renew file ID.
-        if self._need_refresh:
-            self._renew()
+    def __contains__(self, key):
+        pos = self._get_positions(_get_bloom_hashes([key]))[0]
+        bits = self.bits[pos >> numpy.uint64(3)] >> \
+            (pos & numpy.uint64(7)).astype('uint8')
 
-        # Open a file.
-        if self._fh is None:
-            self._fh = h5py.File(self.file.get_fname(self._cur_fid), 'r')
-            self._build_sep()
+        return bool((bits & 1).all())
 
-        # Compute file_start and file_end (absolute cursor) and
-        # item_start and item_end (relative cursor).
-        if self._cur_fid == 0:
-            file_start = 0
-        else:
-            file_start = self._file_index[self._cur_fid - 1]
-        file_end = self._file_index[self._cur_fid]
 
-        item_start = self._pos - file_start
-        item_end = min(self._pos + num_items, file_end) - file_start
+def _load_bloom(sharded_file):
+    """Load the Bloom filter of all keys, None if missing."""
+    fname = sharded_file.get_bloom_fname()
+    if not os.path.exists(fname):
+        return None
 
-        # Refresh next time if reached the end.
-        if item_end == file_end - file_start:
-            self._need_refresh = True
+    return BloomFilter(numpy.load(fname))
 
-        # log.error('fn: {}'.format(self.file))
-        # log.error('fs: {:d}'.format(file_start))
-        # log.error('fe: {:d}'.format(file_end))
-        # log.error('is: {:d}'.format(item_start))
-        # log.error('ie: {:d}'.format(item_end))
 
-        # Read data.
-        results = []
-        for i, idx in enumerate(xrange(item_start, item_end)):
-            results.append(self._read_item(idx))
+def _load_shard_blooms(sharded_file):
+    """Load the Bloom filters of the shards, None if missing or stale.
 
-        self._pos += num_items
+    Returns:
+        bits: numpy.ndarray, [num_shards, num_bytes], uint8 filter bits.
+    """
+    fname = sharded_file.get_shard_bloom_fname()
+    if not os.path.exists(fname):
+        return None
+    bits = numpy.load(fname)
+    if bits.shape[0] != sharded_file.num_shards:
+        log.warning('Stale shard Bloom filters for file {}'.format(
+            sharded_file))
+        return None
 
-        if num_items == 1:
-            return results[0]
-        else:
-            return results
+    return bits
 
-    def read_key(self, key):
-        """Read an item based on key.
 
-        Args:
-            key: string, key of the item.
-        Returns:
-            results: dict.
-        """
-        # Lazy build file index.
-        if self._file_index is None:
-            self._file_index = self._build_index()
+def _check_shard_blooms(bits, key):
+    """Check a key against the Bloom filters of all shards at once.
 
-        # Lazy build key index.
-        if self._key_index is None:
-            if self._key_name:
-                self._build_key(self._key_name)
-            else:
-                raise Exception(
-                    'You need to specify key field in the constructor.')
+    Args:
+        bits: numpy.ndarray, [num_shards, num_bytes], filters of the same
+        size, see _load_shard_blooms.
+        key: int or string, key to check.
+    Returns:
+        may_hold: 1D bool numpy.ndarray, shards whose filter may hold the key.
+    """
+    pos = BloomFilter(bits[0])._get_positions(_get_bloom_hashes([key]))[0]
+    set_bits = bits[:, pos >> numpy.uint64(3)] >> \
+        (pos & numpy.uint64(7)).astype('uint8')
 
-        if key not in self._key_index:
-            log.warning('Key {} not found in file {}'.format(key, self.file))
-            return None
-        else:
-            location = self._key_index[key]
-            fid = location[0]
-            pos = location[1]
-            # log.error('fid: {:d} pos: {:d}'.format(fid, pos))
-            if fid != self._cur_fid:
-                self._cur_fid = fid
-                self._fh = None
-            if fid != 0:
-                file_start = self._file_index[fid - 1]
-                pos = pos + file_start
-            self._pos = pos
+    return (set_bits & 1).all(axis=1)
 
-        # Disable refresh in key reading mode.
-        self._need_refresh = False
 
-        return self.read(num_items=1)
+def _write_key_index(sharded_file, shard_keys):
+    """Write the sorted key index and the Bloom filter of all keys of a
+    sharded file.
 
-    def keys(self):
-        """Get a list of keys."""
-        # Lazy build key index.
-        if self._key_index is None:
-            if self._key_name:
-                self._build_key(self._key_name)
+    Args:
+        sharded_file: ShardedFile instance.
+        shard_keys: list of 1D numpy.ndarray, keys of each shard.
+    """
+    shard_hashes = [_get_bloom_hashes(k) if k.shape[0] > 0
+                    else numpy.zeros([0], dtype='uint64') for k in shard_keys]
+    hashes = numpy.concatenate([numpy.zeros([0], dtype='uint64')] +
+                               shard_hashes)
+    numpy.save(sharded_file.get_bloom_fname(), BloomFilter.build(hashes).bits)
+
+    # Filters of the shards share a size, to check them all without opening
+    # the shards.
+    num_bytes = _get_bloom_nbytes(max([0] + [k.shape[0] for k in shard_keys]))
+    numpy.save(sharded_file.get_shard_bloom_fname(), numpy.array(
+        [BloomFilter.build(h, num_bytes=num_bytes).bits
+         for h in shard_hashes], dtype='uint8').reshape([-1, num_bytes]))
+
+    kinds = set([k.dtype.kind for k in shard_keys if k.shape[0] > 0])
+    if len(kinds) > 1:
+        log.warning('Mixed key types {}, skip writing key index'.format(
+            list(kinds)))
+        return
+
+    # Empty shards have no keys, and no key type.
+    shard_locs = [(shard_idx, k) for shard_idx, k in enumerate(shard_keys)
+                  if k.shape[0] > 0]
+    if len(shard_locs) == 0:
+        shard_locs = [(0, numpy.zeros([0], dtype='int64'))]
+    keys = numpy.concatenate([k for shard_idx, k in shard_locs])
+    locs = numpy.concatenate(
+        [_pack_loc(shard_idx, numpy.arange(k.shape[0], dtype='int64'))
+         for shard_idx, k in shard_locs])
+    order = numpy.argsort(keys, kind='mergesort')
+    keys_fname, locs_fname = sharded_file.get_key_index_fnames()
+    numpy.save(keys_fname, keys[order])
+    numpy.save(locs_fname, locs[order])
+
+    pass
+
+
+def _load_key_index(sharded_file, manifest):
+    """Memory-map the key index of a sharded file.
+
+    Args:
+        sharded_file: ShardedFile instance.
+        manifest: dict, a valid manifest of the file.
+    Returns:
+        key_index: SortedKeyIndex instance, or None if missing or stale.
+    """
+    keys_fname, locs_fname = sharded_file.get_key_index_fnames()
+    if not os.path.exists(keys_fname) or not os.path.exists(locs_fname):
+        return None
+    keys = numpy.load(keys_fname, mmap_mode='r')
+    locs = numpy.load(locs_fname, mmap_mode='r')
+    if keys.shape[0] != manifest['num_items'] or \
+            locs.shape[0] != manifest['num_items']:
+        log.warning('Stale key index for file {}'.format(sharded_file))
+        return None
 
-        return self._key_index.keys()
+    return SortedKeyIndex(keys, locs)
 
-    def iterkeys(self):
-        """Get an iterable of keys."""
-        # Lazy build key index.
-        if self._key_index is None:
+
+def _remove_sidecars(sharded_file):
+    """Remove all sidecars of a sharded file."""
+    for fname in sharded_file.get_sidecar_fnames():
+        if os.path.exists(fname):
+            try:
+                os.remove(fname)
+            except OSError:
+                # Removed by another writer process.
+                pass
+
+    pass
+
+
+def _get_field_info(dset):
+    """Get the manifest entry of a field from its dataset."""
+    return {
+        'dtype': dset.dtype.str,
+        'shape': list(dset.shape[1:]),
+        'chunks': list(dset.chunks) if dset.chunks is not None else None,
+        'compression': dset.compression,
+        'compression_opts': dset.compression_opts,
+        'shuffle': dset.shuffle
+    }
+
+
+def _read_shard_info(fname):
+    """Read the manifest entry of a shard by opening it.
+
+    Args:
+        fname: string, shard file name.
+    Returns:
+        info: dict, manifest entry of the shard.
+        fields: dict, field name to dtype and trailing shape.
+    """
+    fh = h5py.File(fname, 'r')
+    try:
+        if KEY_NUM_ITEM not in fh:
+            raise Exception(ERR_MSG_MISSING_NUM_ITEMS_FIELD.format(fname))
+        info = {'num_items': int(fh[KEY_NUM_ITEM][0]), 'nbytes': {}}
+        fields = {}
+        for key in fh.keys():
+            if not key.startswith('__'):
+                dset = fh[key]
+                info['nbytes'][key] = int(dset.size * dset.dtype.itemsize)
+                fields[key] = _get_field_info(dset)
+    finally:
+        fh.close()
+    info['size'] = os.path.getsize(fname)
+
+    return info, fields
+
+
+def _write_manifest(sharded_file, shard_infos, fields):
+    """Write the manifest of a sharded file.
+
+    Args:
+        sharded_file: ShardedFile instance.
+        shard_infos: list of dict, manifest entry of each shard.
+        fields: dict, field name to dtype and trailing shape.
+    """
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'num_shards': sharded_file.num_shards,
+        'num_items': sum([info['num_items'] for info in shard_infos]),
+        'fields': fields,
+        'shards': shard_infos
+    }
+    fname = sharded_file.get_manifest_fname()
+    with open(fname, 'w') as f:
+        json.dump(manifest, f)
+
+    pass
+
+
+def _load_manifest(sharded_file):
+    """Load the manifest of a sharded file.
+
+    Args:
+        sharded_file: ShardedFile instance.
+    Returns:
+        manifest: dict, or None if the manifest is missing or stale.
+    """
+    fname = sharded_file.get_manifest_fname()
+    if not os.path.exists(fname):
+        return None
+    try:
+        with open(fname, 'r') as f:
+            manifest = json.load(f)
+    except ValueError:
+        log.warning('Corrupted manifest {}'.format(fname))
+        return None
+
+    if manifest.get('version') != MANIFEST_VERSION or \
+            manifest.get('num_shards') != sharded_file.num_shards or \
+            len(manifest['shards']) != sharded_file.num_shards:
+        log.warning('Manifest does not match file {}'.format(sharded_file))
+        return None
+
+    # A shard rewritten after the manifest shows up with a different size.
+    for shard_idx, info in enumerate(manifest['shards']):
+        fname_i = sharded_file.get_fname(shard_idx)
+        if not os.path.exists(fname_i) or \
+                os.path.getsize(fname_i) != info['size']:
+            log.warning('Stale manifest for file {}'.format(sharded_file))
+            return None
+
+    return manifest
+
+
+def build_manifest(sharded_file):
+    """Build the manifest of an existing sharded file by scanning all shards.
+
+    Args:
+        sharded_file: ShardedFile instance.
+    """
+    shard_infos = []
+    fields = {}
+    for shard_idx in xrange(sharded_file.num_shards):
+        info, fields_i = _read_shard_info(sharded_file.get_fname(shard_idx))
+        shard_infos.append(info)
+        if len(fields) == 0:
+            fields = fields_i
+    _write_manifest(sharded_file, shard_infos, fields)
+
+    pass
+
+
+def build_key_index(sharded_file):
+    """Build the key index of an existing sharded file by scanning all
+    shards.
+
+    Args:
+        sharded_file: ShardedFile instance.
+    """
+    shard_keys = []
+    for shard_idx in xrange(sharded_file.num_shards):
+        fh = h5py.File(sharded_file.get_fname(shard_idx), 'r')
+        try:
+            shard_keys.append(fh[KEY_KEYS][:])
+        finally:
+            fh.close()
+    _write_key_index(sharded_file, shard_keys)
+
+    pass
+
+
+def _read_sep(fh, key, num_items):
+    """Read the separator of a field in an open shard.
+
+    Args:
+        fh: h5py.File instance.
+        key: string, field name.
+        num_items: number, number of items in the shard.
+    Returns:
+        sep: 1D int64 numpy.ndarray, end line of each item.
+    """
+    sepname = _get_sep_from_key(key)
+    if sepname in fh:
+        return fh[sepname][:]
+    else:
+        if fh[key].shape[0] != num_items:
+            raise Exception('Unknown sep {}'.format(key))
+        else:
+            return numpy.arange(1, num_items + 1)
+
+
+def _get_memmap(fh, key):
+    """Get a memory map of a field stored contiguous and uncompressed.
+
+    Args:
+        fh: h5py.File instance.
+        key: string, field name.
+    Returns:
+        memmap: numpy.memmap, or None if the layout does not allow.
+    """
+    dset = fh[key]
+    if dset.chunks is not None or dset.compression is not None or \
+            dset.dtype.hasobject or dset.size == 0:
+        return None
+    offset = dset.id.get_offset()
+    if offset is None:
+        return None
+
+    return numpy.memmap(fh.filename, dtype=dset.dtype, mode='r',
+                        offset=offset, shape=dset.shape)
+
+
+class ShardHandle(object):
+    """An open shard and its separators, read lazily per field."""
+
+    def __init__(self, fname):
+        """Open a shard for reading.
+
+        Args:
+            fname: string, shard file name.
+        """
+        self.fh = h5py.File(fname, 'r')
+        self.num_items = int(self.fh[KEY_NUM_ITEM][0])
+        self.fields = [key for key in self.fh.keys()
+                       if not key.startswith('__')]
+        self.sep = {}
+        self.memmaps = {}
+
+        pass
+
+    def get_memmap(self, key):
+        """Get a memory map of a field, None if the layout does not allow."""
+        if key not in self.memmaps:
+            self.memmaps[key] = _get_memmap(self.fh, key)
+
+        return self.memmaps[key]
+
+    def get_sep(self, key):
+        """Get the separator of a field, read on first use."""
+        if key not in self.sep:
+            self.sep[key] = _read_sep(self.fh, key, self.num_items)
+
+        return self.sep[key]
+
+    def close(self):
+        self.fh.close()
+
+        pass
+
+
+class ShardHandleCache(object):
+    """LRU cache of open shard handles."""
+
+    def __init__(self, sharded_file, max_open_files=DEFAULT_MAX_OPEN_FILES):
+        """Construct a shard handle cache.
+
+        Args:
+            sharded_file: ShardedFile instance.
+            max_open_files: number, maximum number of shards open at a time.
+        """
+        if max_open_files < 1:
+            raise Exception('Need at least one open file')
+        self.file = sharded_file
+        self.max_open_files = max_open_files
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._handles = collections.OrderedDict()
+
+        pass
+
+    def __len__(self):
+        return len(self._handles)
+
+    def get(self, fid):
+        """Get the handle of a shard, opening it if needed.
+
+        Args:
+            fid: number, shard index.
+        Returns:
+            handle: ShardHandle instance.
+        """
+        if fid in self._handles:
+            self.hits += 1
+            handle = self._handles.pop(fid)
+        else:
+            self.misses += 1
+            if len(self._handles) >= self.max_open_files:
+                old_fid, old_handle = self._handles.popitem(last=False)
+                old_handle.close()
+                self.evictions += 1
+            handle = ShardHandle(self.file.get_fname(fid))
+        self._handles[fid] = handle
+
+        return handle
+
+    def get_stats(self):
+        """Get hit, miss and eviction counters."""
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'open': len(self._handles)
+        }
+
+    def close(self):
+        """Close all open shards."""
+        for handle in self._handles.itervalues():
+            handle.close()
+        self._handles.clear()
+
+        pass
+
+
+def _get_item_nbytes(item):
+    """Get the number of bytes of the values of an item."""
+    return sum([getattr(value, 'nbytes', 8) for value in item.itervalues()])
+
+
+class ItemCache(object):
+    """LRU cache of decoded items, bounded in bytes.
+
+    Items are keyed by file, shard, position and fields read. The cache is
+    thread-safe and can be shared by several readers, e.g. one per thread.
+    Cached arrays are shared by all readers and must not be modified.
+    """
+
+    def __init__(self, max_bytes):
+        """Construct an item cache.
+
+        Args:
+            max_bytes: number, maximum number of bytes of cached values.
+        """
+        self.max_bytes = max_bytes
+        self.num_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._items = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        pass
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        """Get a cached item.
+
+        Args:
+            key: tuple, cache key.
+        Returns:
+            item: dict, or None if not cached.
+        """
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                entry = self._items.pop(key)
+                self._items[key] = entry
+                return entry[0]
+            else:
+                self.misses += 1
+                return None
+
+    def put(self, key, item):
+        """Cache an item, evicting the least recently used items over the
+        byte limit. Items larger than the limit are not cached.
+
+        Args:
+            key: tuple, cache key.
+            item: dict, decoded item.
+        """
+        nbytes = _get_item_nbytes(item)
+        if nbytes > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self.num_bytes -= self._items.pop(key)[1]
+            self._items[key] = (item, nbytes)
+            self.num_bytes += nbytes
+            while self.num_bytes > self.max_bytes:
+                old_key, old_entry = self._items.popitem(last=False)
+                self.num_bytes -= old_entry[1]
+                self.evictions += 1
+
+        pass
+
+    def get_stats(self):
+        """Get hit, miss and eviction counters and the cache size."""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'items': len(self._items),
+                'bytes': self.num_bytes
+            }
+
+    def clear(self):
+        """Drop all cached items."""
+        with self._lock:
+            self._items.clear()
+            self.num_bytes = 0
+
+        pass
+
+
+class Prefetcher(object):
+    """Reads batches ahead of the consumer on a background thread.
+
+    The thread reads with its own reader and open shard handles, puts batches
+    in a bounded queue in file order, and opens the next shard as soon as the
+    current one is read.
+    """
+
+    def __init__(self, reader, num_batches):
+        """Construct and start a prefetcher from the reader position.
+
+        Args:
+            reader: ShardedFileReader instance.
+            num_batches: number, maximum number of batches read ahead.
+        """
+        self._reader = reader._clone(max_open_files=2)
+        self._reader.seek(reader._pos - reader._start)
+        self._queue = Queue.Queue(maxsize=num_batches)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+        pass
+
+    def _put(self, entry):
+        """Put an entry in the queue, return False if stopped."""
+        while not self._stop.is_set():
+            try:
+                self._queue.put(entry, timeout=PREFETCH_POLL_SECS)
+                return True
+            except Queue.Full:
+                pass
+
+        return False
+
+    def _run(self):
+        reader = self._reader
+        try:
+            end = reader._get_end()
+            while reader._pos < end:
+                pos = reader._pos
+                items = reader._read_next()
+                if not self._put((reader._pos - pos, items, None)):
+                    return
+
+                # Open the next shard before the consumer reaches it.
+                fid = reader._cur_fid
+                if reader._pos == reader._file_index[fid] and \
+                        fid + 1 < reader.file.num_shards:
+                    reader._handles.get(fid + 1)
+            self._put((0, None, None))
+        except Exception as e:
+            self._put((0, None, e))
+        finally:
+            reader.close()
+
+        pass
+
+    def get(self):
+        """Get the next batch.
+
+        Returns:
+            num_items: number, number of items in the batch, 0 at the end.
+            items: same as ShardedFileReader.read.
+        """
+        num_items, items, error = self._queue.get()
+        if error is not None:
+            raise error
+
+        return num_items, items
+
+    def stop(self):
+        """Stop the background thread and drop the batches read ahead."""
+        self._stop.set()
+        self._thread.join()
+
+        pass
+
+
+class ShardedFileReader(object):
+    """Shareded file reader.
+    """
+
+    def __init__(self, sharded_file,
+                 key_name=KEY_KEYS, batch_size=1, check=True,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES, prefetch=0,
+                 fields=None, mmap=False, collate=False, item_cache=None):
+        """Construct a sharded file reader instance.
+
+        Args:
+            sharded_file: SharededFile instance.
+            key_name: Name of key field for random access (optional).
+            batch_size: number, average batch_size for each read. The actual 
+            size depends on the number of items in a file so is not guaranteed 
+            to be the same size.
+            check: bool, whether to check all shards exist.
+            max_open_files: number, maximum number of shards kept open.
+            prefetch: number, number of batches read ahead on a background
+            thread when iterating, 0 to read in the calling thread.
+            fields: list of string, (optional) fields to read, default is all
+            fields. Other fields and their separators are never read.
+            mmap: bool, return views of memory-mapped shards for fields stored
+            contiguous and uncompressed, instead of copies made by h5py. Pass
+            copy=True to a read to own the data.
+            collate: bool, iterate batches as columns, see read_batch.
+            item_cache: ItemCache, (optional) cache of items read by key, can
+            be shared by several readers.
+        """
+        self.file = sharded_file
+
+        # Batch size of reading.
+        self.batch_size = batch_size
+
+        # Position index in each file for binary search.
+        self._file_index = None
+
+        # Reader position.
+        self._pos = 0
+
+        # Range of items covered by the reader, see partition. The end is
+        # None for the end of the file.
+        self._start = 0
+        self._end = None
+
+        # Current file ID.
+        self._cur_fid = 0
+
+        # Current file handler.
+        self._fh = None
+
+        # Current shard handle.
+        self._handle = None
+
+        # Fields to read, None for all fields.
+        self._fields = fields
+
+        # Whether to read through memory maps when possible.
+        self._mmap = mmap
+
+        # Whether to iterate batches as columns.
+        self._collate = collate
+
+        # Cache of items read by key.
+        self._item_cache = item_cache
+
+        # Open shards.
+        self._handles = ShardHandleCache(sharded_file, max_open_files)
+
+        # Number of batches to read ahead when iterating.
+        self._prefetch = prefetch
+
+        # Background reader, started by the first iteration.
+        self._prefetcher = None
+
+        # Index based on keys.
+        self._key_index = None
+
+        # Name of the key field.
+        self._key_name = key_name
+
+        # Bloom filter of all keys, None if missing.
+        self._bloom = None
+
+        # Whether the Bloom filter has been looked up.
+        self._bloom_loaded = False
+
+        # Whether to look up keys shard by shard, when there is a Bloom
+        # filter but no key index sidecar to memory-map.
+        self._shard_lookup = False
+
+        # Bloom filters of all shards from the sidecar, None if missing.
+        self._shard_bloom_bits = None
+
+        # Bloom filters and key indices of single shards, loaded on demand
+        # until the key index of all shards is loaded.
+        self._shard_blooms = {}
+        self._shard_key_indices = {}
+
+        # Manifest of the file, None if missing or stale.
+        self._manifest = None
+
+        # Whether the manifest has been looked up.
+        self._manifest_loaded = False
+
+        # Check files all exist.
+        if check:
+            self._check_files()
+
+        pass
+
+    def __iter__(self):
+        """Get an iterator."""
+        return self
+
+    def __getitem__(self, key):
+        """Get item based on key"""
+        return self.read_key(key)
+
+    def __enter__(self):
+        """Enter with clause."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Exit with clause."""
+        self._stop_prefetch()
+        self._handles.close()
+        self._fh = None
+        self._handle = None
+
+        pass
+
+    def __len__(self):
+        """Get number of items covered by the reader."""
+        return self.get_num_items()
+
+    def __contains__(self, key):
+        """Check whether a key is contained in the file."""
+        return self._find_key(key) is not None
+
+    def _get_bloom(self):
+        """Get the Bloom filter of all keys, loaded lazily."""
+        if not self._bloom_loaded:
+            if self._key_name == KEY_KEYS and \
+                    self._get_manifest() is not None:
+                self._bloom = _load_bloom(self.file)
+                keys_fname, locs_fname = self.file.get_key_index_fnames()
+                self._shard_lookup = self._bloom is not None and \
+                    not (os.path.exists(keys_fname) and
+                         os.path.exists(locs_fname))
+                if self._shard_lookup:
+                    self._shard_bloom_bits = _load_shard_blooms(self.file)
+            self._bloom_loaded = True
+
+        return self._bloom
+
+    def _find_key(self, key):
+        """Find the location of a key.
+
+        Until the key index is loaded, keys rejected by the Bloom filter are
+        answered without reading any key. Without a key index sidecar, other
+        keys are looked up in the shards whose Bloom filter may hold them,
+        instead of building the key index of all shards. The filters of the
+        shards are checked in their sidecar, and only read from the shards
+        when it is missing.
+
+        Args:
+            key: string or int, key of the item.
+        Returns:
+            location: tuple of shard index and position, None if not found.
+        """
+        if self._key_index is None and _is_bloom_key(key):
+            bloom = self._get_bloom()
+            if bloom is not None:
+                if key not in bloom:
+                    return None
+            if self._shard_lookup:
+                # The last duplicate wins, same as the key index.
+                if self._shard_bloom_bits is not None:
+                    fids = _check_shard_blooms(
+                        self._shard_bloom_bits, key).nonzero()[0][::-1]
+                else:
+                    fids = xrange(self.file.num_shards - 1, -1, -1)
+                for fid in fids:
+                    if self._shard_bloom_bits is None:
+                        shard_bloom = self._get_shard_bloom(fid)
+                        if shard_bloom is not None and \
+                                key not in shard_bloom:
+                            continue
+                    location = self._get_shard_key_index(fid).get(key)
+                    if location is not None:
+                        return location
+                return None
+
+        key_index = self._get_key_index()
+        if isinstance(key_index, HashedKeyIndex):
+            # Hash matches are checked through the shards of this reader.
+            return key_index.lookup(key, self._read_stored_keys)
+        else:
+            return key_index.get(key)
+
+    def _get_shard_bloom(self, fid):
+        """Get the Bloom filter of a shard, None if missing."""
+        if fid not in self._shard_blooms:
+            handle = self._handles.get(fid)
+            # Opening a shard can close the current one, reopen on next read.
+            self._fh = None
+            if KEY_BLOOM in handle.fh:
+                self._shard_blooms[fid] = BloomFilter(handle.fh[KEY_BLOOM][:])
+            else:
+                self._shard_blooms[fid] = None
+
+        return self._shard_blooms[fid]
+
+    def _get_shard_key_index(self, fid):
+        """Get the key index of a single shard."""
+        if fid not in self._shard_key_indices:
+            keys = self._read_stored_keys(fid, 0, None)
+            order = numpy.argsort(keys, kind='mergesort')
+            locs = _pack_loc(fid, order.astype('int64'))
+            self._shard_key_indices[fid] = SortedKeyIndex(keys[order], locs)
+
+        return self._shard_key_indices[fid]
+
+    def _get_key_index(self):
+        """Get the key index, built lazily."""
+        if self._key_index is None:
             if self._key_name:
                 self._build_key(self._key_name)
+            else:
+                raise Exception(
+                    'You need to specify key field in the constructor.')
+
+        return self._key_index
+
+    def _clone(self, max_open_files=DEFAULT_MAX_OPEN_FILES):
+        """Get a reader of the same file with its own position and open
+        shards, sharing the indices already built."""
+        reader = ShardedFileReader(
+            self.file, key_name=self._key_name, batch_size=self.batch_size,
+            check=False, max_open_files=max_open_files, fields=self._fields,
+            mmap=self._mmap, collate=self._collate,
+            item_cache=self._item_cache)
+        reader._manifest = self._manifest
+        reader._manifest_loaded = self._manifest_loaded
+        reader._file_index = self._file_index
+        reader._key_index = self._key_index
+        reader._bloom = self._bloom
+        reader._bloom_loaded = self._bloom_loaded
+        reader._shard_lookup = self._shard_lookup
+        reader._shard_bloom_bits = self._shard_bloom_bits
+        reader._shard_blooms = self._shard_blooms
+        reader._shard_key_indices = self._shard_key_indices
+        reader._start = self._start
+        reader._end = self._end
+        reader._pos = self._start
+
+        return reader
+
+    def _stop_prefetch(self):
+        """Stop reading ahead, e.g. when the position changes."""
+        if self._prefetcher is not None:
+            self._prefetcher.stop()
+            self._prefetcher = None
+
+        pass
+
+    def _get_manifest(self):
+        """Get the manifest, loaded lazily."""
+        if not self._manifest_loaded:
+            self._manifest = _load_manifest(self.file)
+            self._manifest_loaded = True
 
-        return self._key_index.iterkeys()
+        return self._manifest
+
+    def _check_files(self):
+        """Check existing files"""
+
+        # A valid manifest already checked every shard exists.
+        if self._get_manifest() is not None:
+            log.info('Check file success: {}'.format(self.file.file_prefix))
+            return
+
+        fname_re = re.compile(
+            '({})-([0-9]{{5}})-of-{:05d}{}'.format(
+                self.file.basename,
+                self.file.num_shards,
+                self.file.suffix))
+        dirname = os.path.dirname(os.path.abspath(self.file.file_prefix))
+        files_in_dir = os.listdir(dirname)
+        found_files = {}
+
+        # Look for files in the expected pattern.
+        for fname in files_in_dir:
+            match = fname_re.match(fname)
+            if match is not None:
+                index_str = match.groups()[1]
+                index_int = int(index_str)
+                if index_int >= self.file.num_shards:
+                    raise Exception(ERR_MSG_IDX_TOO_LARGE.format(fname))
+                if index_int in found_files:
+                    raise Exception(ERR_MSG_DUPE_FILES.format(index_int))
+                found_files[index_int] = fname
+
+        # Check all files in the sequence exist.
+        for idx in xrange(self.file.num_shards):
+            if idx not in found_files:
+                raise Exception(ERR_MSG_MISSING_FILE.format(
+                    idx, self.file.num_shards))
+
+        log.info('Check file success: {}'.format(self.file.file_prefix))
+
+        pass
+
+    def _build_index(self):
+        """Build a mapping from an index to shard number.
+
+        Returns:
+            file_index: list, end element id - 1 of each shard.
+        """
+        file_index = []
+        index = 0
+        manifest = self._get_manifest()
+        if manifest is not None:
+            for info in manifest['shards']:
+                index += info['num_items']
+                file_index.append(index)
+
+            return file_index
+
+        log.info('Building index of file {}'.format(self.file.basename))
+        for shard_idx in xrange(self.file.num_shards):
+            fname = self.file.get_fname(shard_idx)
+            fh = h5py.File(fname, 'r')
+            try:
+                if KEY_NUM_ITEM in fh:
+                    num_items = fh[KEY_NUM_ITEM][0]
+                else:
+                    raise Exception(
+                        ERR_MSG_MISSING_NUM_ITEMS_FIELD.format(fname))
+            finally:
+                fh.close()
+            index += num_items
+            file_index.append(index)
+
+        return file_index
+
+    def _build_key(self, key_name):
+        """Build a mapping from a key to shard number and position.
+
+        Args:
+            key_name: string, name of the key field.
+        """
+        manifest = self._get_manifest()
+        if key_name == KEY_KEYS and manifest is not None:
+            self._key_index = _load_key_index(self.file, manifest)
+            if self._key_index is not None:
+                return
+
+        log.info('Building key index of file {}'.format(self.file.basename))
+        shard_keys = []
+        has_ints = False
+        has_strings = False
+        for shard_idx in xrange(self.file.num_shards):
+            fname = self.file.get_fname(shard_idx)
+            fh = h5py.File(fname, 'r')
+            if key_name in fh:
+                key_index_i = fh[key_name][:]
+                num_keys = key_index_i.shape[0]
+
+                if KEY_NUM_ITEM in fh:
+                    num_items = fh[KEY_NUM_ITEM][0]
+                else:
+                    fh.close()
+                    raise Exception(
+                        ERR_MSG_MISSING_NUM_ITEMS_FIELD.format(fname))
+                fh.close()
+
+                if num_keys != num_items:
+                    raise Exception(
+                        'Number of keys not equal to number of items')
+
+                # Hash string keys per shard, only one shard of keys is
+                # in memory at a time.
+                if num_keys == 0:
+                    shard_keys.append(key_index_i)
+                elif key_index_i.dtype.kind in 'iu':
+                    shard_keys.append(key_index_i)
+                    has_ints = True
+                else:
+                    shard_keys.append(_hash_keys(key_index_i))
+                    has_strings = True
+            else:
+                fh.close()
+                raise Exception(
+                    'Key "{}" not found in the file {}'.format(
+                        key_name, fname))
+
+        if has_ints and has_strings:
+            log.warning('Mixed key types, using a dict index')
+            self._key_index = self._build_key_dict(
+                [k.shape[0] for k in shard_keys])
+        else:
+            self._key_index = self._build_key_arrays(shard_keys, has_strings)
+
+        pass
+
+    def _build_key_dict(self, num_keys):
+        """Build a dict index, for mixed key types.
+
+        Args:
+            num_keys: list of number, number of keys of each shard.
+        """
+        key_index = {}
+        for shard_idx in xrange(len(num_keys)):
+            keys = self._read_stored_keys(shard_idx, 0, num_keys[shard_idx])
+            for key_idx in xrange(keys.shape[0]):
+                key_index[keys[key_idx]] = (shard_idx, key_idx)
+
+        return key_index
+
+    def _build_key_arrays(self, shard_keys, hashed):
+        """Build an index of numpy arrays from the keys of each shard.
+
+        Int keys are sorted as is, string keys are sorted by hash.
+
+        Args:
+            shard_keys: list of 1D numpy.ndarray, int keys or string key
+            hashes of each shard.
+            hashed: bool, whether the keys are string key hashes.
+        Returns:
+            key_index: SortedKeyIndex or HashedKeyIndex.
+        """
+
+        shard_locs = [(shard_idx, k) for shard_idx, k in enumerate(shard_keys)
+                      if k.shape[0] > 0]
+        if len(shard_locs) == 0:
+            shard_locs = [(0, numpy.zeros([0], dtype='int64'))]
+        locs = numpy.concatenate(
+            [_pack_loc(shard_idx, numpy.arange(k.shape[0], dtype='int64'))
+             for shard_idx, k in shard_locs])
+        keys = numpy.concatenate([k for shard_idx, k in shard_locs])
+        order = numpy.argsort(keys, kind='mergesort')
+        if hashed:
+            return HashedKeyIndex(keys[order], locs[order])
+        else:
+            return SortedKeyIndex(keys[order], locs[order])
+
+    def _read_stored_keys(self, shard, start, end):
+        """Read keys stored in a shard, for the hashed key index."""
+        handle = self._handles.get(shard)
+        # Opening a shard can close the current one, reopen on next read.
+        self._fh = None
+
+        return handle.fh[self._key_name][start: end]
+
+    def find(self, index):
+        """Find the file id.
+
+        Args:
+            index: number, item index.
+
+        """
+        # Lazy build file index.
+        if self._file_index is None:
+            self._file_index = self._build_index()
+
+        return bisect.bisect_right(self._file_index, index)
+
+    def _goto_shard(self, fid):
+        """Make a shard the current file.
+
+        Args:
+            fid: number, shard index.
+        """
+        if fid != self._cur_fid or self._fh is None:
+            self._handle = self._handles.get(fid)
+            self._cur_fid = fid
+            self._fh = self._handle.fh
+
+        pass
+
+    def _get_file_start(self, fid):
+        """Get the absolute position of the first item in a shard."""
+        if fid == 0:
+            return 0
+        else:
+            return self._file_index[fid - 1]
+
+    def _get_fields(self, fields):
+        """Get the fields to read in the current shard.
+
+        Args:
+            fields: list of string, fields of a call, None for the fields
+            of the reader.
+        """
+        if fields is None:
+            fields = self._fields
+        if fields is None:
+            return self._handle.fields
+        for key in fields:
+            if key not in self._handle.fields:
+                raise Exception('Unknown field: {}'.format(key))
+
+        return fields
+
+    def _read_item(self, idx, fields=None):
+        result = {}
+        for key in self._get_fields(fields):
+            sep = self._handle.get_sep(key)
+            # Compute line start and end.
+            if idx == 0:
+                line_start = 0
+            else:
+                line_start = sep[idx - 1]
+            line_end = sep[idx]
+            if line_start == line_end - 1:
+                result[key] = self._fh[key][line_start]
+            else:
+                result[key] = self._fh[key][line_start: line_end]
+
+        return result
+
+    def _read_block(self, key, line_start, line_end, copy=False):
+        """Read lines of a field in the current shard.
+
+        Args:
+            key: string, field name.
+            line_start: number, first line.
+            line_end: number, last line (exclusive).
+            copy: bool, whether to copy data read through a memory map.
+        Returns:
+            block: numpy.ndarray.
+        """
+        if self._mmap:
+            memmap = self._handle.get_memmap(key)
+            if memmap is not None:
+                block = memmap[line_start: line_end]
+                if copy:
+                    return numpy.array(block)
+                else:
+                    # Plain ndarray view, item views of a memmap are slow.
+                    return block.view(numpy.ndarray)
+
+        return self._fh[key][line_start: line_end]
+
+    def _read_range(self, item_start, item_end, fields=None, copy=False):
+        """Read a range of items in the current shard.
+
+        Each field is read from the file once for the whole range, and split
+        into items with numpy views.
+
+        Args:
+            item_start: number, start position in the current shard.
+            item_end: number, end position (exclusive) in the current shard.
+            fields: list of string, (optional) fields to read.
+            copy: bool, whether to copy data read through a memory map.
+        Returns:
+            results: list of dict.
+        """
+        results = [{} for idx in xrange(item_start, item_end)]
+        if item_end <= item_start:
+            return results
+
+        for key in self._get_fields(fields):
+            sep = self._handle.get_sep(key)
+            if item_start == 0:
+                line_start = 0
+            else:
+                line_start = sep[item_start - 1]
+            line_end = sep[item_end - 1]
+            block = self._read_block(key, line_start, line_end, copy=copy)
+
+            # Item boundaries relative to the block.
+            ends = sep[item_start: item_end] - line_start
+            starts = numpy.concatenate([[0], ends[:-1]])
+            for i in xrange(item_end - item_start):
+                if starts[i] == ends[i] - 1:
+                    results[i][key] = block[starts[i]]
+                else:
+                    results[i][key] = block[starts[i]: ends[i]]
+
+        return results
+
+    def _get_read_range(self, num_items):
+        """Open the shard of the current position and get the range to read.
+
+        Args:
+            num_items: number, number of desired items to read.
+        Returns:
+            item_start: number, start position in the current shard.
+            item_end: number, end position (exclusive) in the current shard.
+        """
+        # Reading moves the position, batches read ahead are no longer valid.
+        self._stop_prefetch()
+
+        # Open the shard of the current position.
+        self._goto_shard(self.find(self._pos))
+
+        # Compute file_start and file_end (absolute cursor) and
+        # item_start and item_end (relative cursor).
+        file_start = self._get_file_start(self._cur_fid)
+        file_end = self._file_index[self._cur_fid]
+
+        item_start = self._pos - file_start
+        item_end = min(self._pos + num_items, file_end,
+                       self._get_end()) - file_start
+
+        # log.error('fn: {}'.format(self.file))
+        # log.error('fs: {:d}'.format(file_start))
+        # log.error('fe: {:d}'.format(file_end))
+        # log.error('is: {:d}'.format(item_start))
+        # log.error('ie: {:d}'.format(item_end))
+
+        return item_start, item_end
+
+    def _read_columns(self, item_start, item_end, fields=None, copy=False,
+                      out=None, stack=True):
+        """Read a range of items in the current shard as columns.
+
+        Args:
+            item_start: number, start position in the current shard.
+            item_end: number, end position (exclusive) in the current shard.
+            fields: list of string, (optional) fields to read.
+            copy: bool, whether to copy data read through a memory map.
+            out: dict, (optional) preallocated arrays to read fields into.
+            stack: bool, whether to stack fields of items with the same
+            number of lines.
+        Returns:
+            columns: dict, see read_batch.
+        """
+        columns = {}
+        num_items = item_end - item_start
+        if num_items <= 0:
+            return columns
+
+        for key in self._get_fields(fields):
+            sep = self._handle.get_sep(key)
+            if item_start == 0:
+                line_start = 0
+            else:
+                line_start = sep[item_start - 1]
+            line_end = sep[item_end - 1]
+            num_lines = line_end - line_start
+
+            if out is not None and key in out:
+                block = out[key][: num_lines]
+                memmap = self._handle.get_memmap(key) if self._mmap else None
+                if memmap is not None:
+                    block[...] = memmap[line_start: line_end]
+                else:
+                    self._fh[key].read_direct(
+                        block, source_sel=numpy.s_[line_start: line_end],
+                        dest_sel=numpy.s_[0: num_lines])
+            else:
+                block = self._read_block(key, line_start, line_end,
+                                         copy=copy)
+
+            offsets = numpy.zeros([num_items + 1], dtype='int64')
+            offsets[1:] = sep[item_start: item_end]
+            offsets[1:] -= line_start
+            lengths = numpy.diff(offsets)
+            if not stack:
+                columns[key] = (block, offsets)
+            elif (lengths == 1).all():
+                columns[key] = block
+            elif (lengths == lengths[0]).all():
+                columns[key] = block.reshape(
+                    (num_items, lengths[0]) + block.shape[1:])
+            else:
+                columns[key] = (block, offsets)
+
+        return columns
+
+    def read_batch(self, num_items, fields=None, copy=False, out=None,
+                   stack=True):
+        """Read from the current position as columns.
+
+        Each field is read with one allocation, or none if a buffer is given
+        in out.
+
+        Args:
+            num_items: number, number of desired items to read. It is not 
+            guaranteed to return the exact same number of items.
+            fields: list of string, (optional) fields to read, default is the
+            fields of the reader.
+            copy: bool, in mmap mode, copy the data out of the memory map.
+            out: dict, (optional) preallocated arrays to read fields into,
+            with at least as many lines as the batch. Columns are views of
+            these arrays.
+            stack: bool, False to return (values, offsets) for all fields.
+        Returns:
+            columns: dict, keys are the fields. Values are numpy.ndarray with
+            items stacked along the first dimension if all items have the same
+            number of lines, or (values, offsets) otherwise, with item i in
+            values[offsets[i]: offsets[i + 1]].
+        """
+        item_start, item_end = self._get_read_range(num_items)
+        columns = self._read_columns(item_start, item_end, fields=fields,
+                                     copy=copy, out=out, stack=stack)
+        self._pos += item_end - item_start
+
+        return columns
+
+    def _read_next(self):
+        """Read the next batch when iterating."""
+        if self._collate:
+            return self.read_batch(self.batch_size)
+        else:
+            return self.read(self.batch_size)
+
+    def read(self, num_items=1, fields=None, copy=False):
+        """Read from the current position.
+
+        Args:
+            num_items: number, number of desired items to read. It is not 
+            guaranteed to return the exact same number of items.
+            fields: list of string, (optional) fields to read, default is the
+            fields of the reader.
+            copy: bool, in mmap mode, copy the data out of the memory map.
+        Returns:
+            results: list of dict, keys are same with the keys defined in the 
+            file, values are numpy.ndarray.
+        """
+        item_start, item_end = self._get_read_range(num_items)
+
+        # Read data.
+        results = self._read_range(item_start, item_end, fields=fields,
+                                   copy=copy)
+
+        # Only advance by the items read, a batch stops at the shard end.
+        self._pos += item_end - item_start
+
+        if num_items == 1:
+            return results[0]
+        else:
+            return results
+
+    def read_key(self, key, fields=None, copy=False):
+        """Read an item based on key.
+
+        Args:
+            key: string, key of the item.
+            fields: list of string, (optional) fields to read.
+            copy: bool, in mmap mode, copy the data out of the memory map.
+        Returns:
+            results: dict.
+        """
+        # Lazy build file index.
+        if self._file_index is None:
+            self._file_index = self._build_index()
+
+        location = self._find_key(key)
+        if location is None:
+            log.warning('Key {} not found in file {}'.format(key, self.file))
+            return None
+        else:
+            fid = location[0]
+            pos = location[1]
+            # log.error('fid: {:d} pos: {:d}'.format(fid, pos))
+
+        # Moving the position invalidates batches read ahead.
+        self._stop_prefetch()
+        self._pos = self._get_file_start(fid) + pos + 1
+        if self._item_cache is not None:
+            cache_key = self._get_cache_key(fid, pos, fields)
+            result = self._item_cache.get(cache_key)
+            if result is not None:
+                return dict(result)
+
+        # Read the shard directly, a key may be outside of a partition.
+        self._goto_shard(fid)
+        result = self._read_range(pos, pos + 1, fields=fields, copy=copy)[0]
+        if self._item_cache is not None:
+            self._item_cache.put(cache_key, result)
+            result = dict(result)
+
+        return result
+
+    def _get_cache_key(self, fid, pos, fields):
+        """Get the item cache key of an item."""
+        if fields is None:
+            fields = self._fields
+        if fields is not None:
+            fields = tuple(fields)
+
+        return (self.file.file_prefix, self.file.num_shards, fid, pos, fields)
+
+    def read_keys(self, keys, fields=None, copy=False):
+        """Read a list of items based on keys.
+
+        Requests are sorted by shard and position, so that each shard is
+        opened once and items at most MAX_READ_GAP items apart are read with
+        one range read. Does not change the reader position.
+
+        Args:
+            keys: list of keys.
+            fields: list of string, (optional) fields to read.
+            copy: bool, in mmap mode, copy the data out of the memory map.
+        Returns:
+            results: list of dict, in the same order as keys, None for keys
+            not found.
+        """
+        # Lazy build file index.
+        if self._file_index is None:
+            self._file_index = self._build_index()
+
+        locations = []
+        for key in keys:
+            location = self._find_key(key)
+            if location is None:
+                log.warning('Key {} not found in file {}'.format(
+                    key, self.file))
+            locations.append(location)
+
+        return self._read_locations(locations, fields=fields, copy=copy)
+
+    def _read_locations(self, locations, fields=None, copy=False):
+        """Read a list of items based on locations, see read_keys.
+
+        Args:
+            locations: list of tuple of shard index and position, or None.
+            fields: list of string, (optional) fields to read.
+            copy: bool, in mmap mode, copy the data out of the memory map.
+        Returns:
+            results: list of dict, in the same order as locations, None for
+            None locations.
+        """
+        # Lazy build file index.
+        if self._file_index is None:
+            self._file_index = self._build_index()
+
+        results = [None] * len(locations)
+        pending = []
+        for i, location in enumerate(locations):
+            if location is None:
+                continue
+            if self._item_cache is not None:
+                item = self._item_cache.get(
+                    self._get_cache_key(location[0], location[1], fields))
+                if item is not None:
+                    results[i] = dict(item)
+                    continue
+            pending.append((location[0], location[1], i))
+        pending.sort()
+
+        run_start = 0
+        for j in xrange(1, len(pending) + 1):
+            # Close a run at the end, at a shard change or at a gap too large
+            # to read through.
+            if j < len(pending) and \
+                    pending[j][0] == pending[j - 1][0] and \
+                    pending[j][1] <= pending[j - 1][1] + 1 + MAX_READ_GAP:
+                continue
+            fid = pending[run_start][0]
+            item_start = pending[run_start][1]
+            item_end = pending[j - 1][1] + 1
+            self._goto_shard(fid)
+            items = self._read_range(item_start, item_end, fields=fields,
+                                     copy=copy)
+            for location in pending[run_start: j]:
+                item = items[location[1] - item_start]
+                results[location[2]] = dict(item)
+                if self._item_cache is not None:
+                    self._item_cache.put(self._get_cache_key(
+                        location[0], location[1], fields), item)
+            run_start = j
+
+        return results
+
+    def keys(self):
+        """Get a list of keys."""
+        key_index = self._get_key_index()
+        if isinstance(key_index, HashedKeyIndex):
+            return list(key_index.iterkeys(self._read_stored_keys))
+        else:
+            return key_index.keys()
+
+    def iterkeys(self):
+        """Get an iterable of keys."""
+        key_index = self._get_key_index()
+        if isinstance(key_index, HashedKeyIndex):
+            return key_index.iterkeys(self._read_stored_keys)
+        else:
+            return key_index.iterkeys()
 
     def seek(self, pos):
         """Seek to specific position.
 
         Args:
-            pos: number, position in terms of number of items.
+            pos: number, position in terms of number of items, from the start
+            of the range covered by the reader.
         Returns:
             A SharededReader instance.
         """
-        self._pos = pos
-        fid = self.find(self._pos)
-        if fid != self._cur_fid or self._fh is None:
-            self._cur_fid = fid
-            if self._fh is not None:
-                self._fh.close()
-                self._fh = None
-            self._fh = h5py.File(self.file.get_fname(fid), 'r')
+        self._stop_prefetch()
+        self._pos = self._start + pos
+        # At the end there is no shard to open, the reader is exhausted.
+        if self._pos < self._get_end():
+            self._goto_shard(self.find(self._pos))
 
         return self
 
@@ -592,21 +2101,89 @@ class ShardedFileReader(object):
         if self._file_index is None:
             self._file_index = self._build_index()
 
-        if self._pos < self._file_index[-1]:
-            return self.read(self.batch_size)
-        else:
+        if self._pos >= self._get_end():
             raise StopIteration()
 
+        if self._prefetch > 0:
+            if self._prefetcher is None:
+                self._prefetcher = Prefetcher(self, self._prefetch)
+            num_items, items = self._prefetcher.get()
+            self._pos += num_items
+
+            return items
+        else:
+            return self._read_next()
+
         pass
 
-    def get_num_items(self):
-        """Get total number of items.
-        """
+    def _get_end(self):
+        """Get the absolute end position of the range covered."""
         # Lazy build file index.
         if self._file_index is None:
             self._file_index = self._build_index()
 
-        return self._file_index[-1]
+        if self._end is None:
+            return self._file_index[-1]
+        else:
+            return self._end
+
+    def get_num_items(self):
+        """Get number of items covered by the reader, all items in the file
+        unless the reader is a partition.
+        """
+        return self._get_end() - self._start
+
+    def partition(self, worker_id, num_workers, by='shard'):
+        """Get a reader over a disjoint part of the items, for one worker.
+
+        Parts are contiguous and balanced by number of items. Iterating, seek,
+        read and len of the returned reader are limited to its part. Reads by
+        key still cover the whole file.
+
+        Args:
+            worker_id: number, index of the worker, in [0, num_workers).
+            num_workers: number, number of workers.
+            by: string, 'shard' to give each worker whole shards, split at
+            the shard boundaries closest to an even split, or 'item' to split
+            evenly by items.
+        Returns:
+            reader: ShardedFileReader instance.
+        """
+        if worker_id < 0 or worker_id >= num_workers:
+            raise Exception('Worker {} out of {} workers'.format(
+                worker_id, num_workers))
+        start = self._start
+        end = self._get_end()
+        num_items = end - start
+
+        if by == 'shard':
+            bounds = [start] + [b for b in self._file_index
+                                if b > start and b < end] + [end]
+            bounds = numpy.array(bounds)
+
+            def get_bound(w):
+                target = start + w * num_items / float(num_workers)
+                return bounds[numpy.abs(bounds - target).argmin()]
+
+            part_start = get_bound(worker_id)
+            part_end = get_bound(worker_id + 1)
+        elif by == 'item':
+            part_start = start + worker_id * num_items / num_workers
+            part_end = start + (worker_id + 1) * num_items / num_workers
+        else:
+            raise Exception('Unknown partition: {}'.format(by))
+
+        reader = self._clone(max_open_files=self._handles.max_open_files)
+        reader._prefetch = self._prefetch
+        reader._start = int(part_start)
+        reader._end = int(part_end)
+        reader._pos = reader._start
+
+        return reader
+
+    def get_handle_stats(self):
+        """Get hit, miss and eviction counters of the open shard cache."""
+        return self._handles.get_stats()
 
     def close(self):
         self.__exit__(None, None, None)
@@ -614,18 +2191,575 @@ class ShardedFileReader(object):
         pass
 
 
+class ShuffledIterator(object):
+    """Iterate a sharded file in a shuffled order, one epoch at a time.
+
+    Each epoch visits the shards in a random order and reads each shard
+    sequentially, read_size items at a time, into a shuffle buffer. Items are
+    drawn from the buffer at random once it holds buffer_size items, so at
+    most buffer_size + read_size items are in memory.
+
+    The order of an epoch only depends on the seed and the epoch number. To
+    resume, the random draws are replayed on item positions without reading
+    any data, and the items left in the buffer are read back one by one.
+    """
+
+    def __init__(self, reader, buffer_size=1000, seed=0, read_size=None):
+        """Construct a shuffled iterator.
+
+        Args:
+            reader: ShardedFileReader instance.
+            buffer_size: number, number of items to shuffle among.
+            seed: number, random seed, the epoch number is added to it.
+            read_size: number, (optional) number of items per sequential
+            read, default is a quarter of the buffer.
+        """
+        if buffer_size < 1:
+            raise Exception('Need a buffer of at least one item')
+        self._reader = reader
+        self._buffer_size = buffer_size
+        self._seed = seed
+        if read_size is None:
+            read_size = max(1, buffer_size / 4)
+        self._read_size = read_size
+        self._epoch = 0
+        self._num_emitted = 0
+
+        pass
+
+    def __iter__(self):
+        """Iterate the rest of the current epoch, then move to the next."""
+        for item in self._iter_epoch(self._epoch, self._num_emitted):
+            yield item
+        self._epoch += 1
+        self._num_emitted = 0
+
+        pass
+
+    def get_state(self):
+        """Get the position to resume from.
+
+        Returns:
+            state: dict, seed, epoch, and number of items emitted in the
+            epoch.
+        """
+        return {
+            'seed': self._seed,
+            'epoch': self._epoch,
+            'num_emitted': self._num_emitted
+        }
+
+    def set_state(self, state):
+        """Resume from a position given by get_state.
+
+        Args:
+            state: dict, seed, epoch, and number of items emitted in the
+            epoch.
+        """
+        self._seed = state['seed']
+        self._epoch = state['epoch']
+        self._num_emitted = state['num_emitted']
+
+        pass
+
+    def _read_items(self, start, end):
+        """Read items in [start, end) of a single shard as a dict by index."""
+        reader = self._reader
+        reader.seek(start - reader._start)
+        items = reader.read(num_items=end - start)
+        if end - start == 1:
+            items = [items]
+
+        return dict(zip(xrange(start, end), items))
+
+    def _iter_epoch(self, epoch, skip):
+        """Iterate an epoch, skipping the first items emitted.
+
+        Args:
+            epoch: number, epoch number.
+            skip: number, number of items already emitted in this epoch.
+        """
+        reader = self._reader
+        # Builds the file index if needed.
+        reader._get_end()
+        random = numpy.random.RandomState(self._seed + epoch)
+        shard_order = random.permutation(len(reader._file_index))
+
+        # Positions in the buffer, and items read for them.
+        buffer = []
+        items = {}
+        num_emitted = 0
+
+        def emit():
+            idx = random.randint(len(buffer))
+            pos = buffer[idx]
+            buffer[idx] = buffer[-1]
+            buffer.pop()
+
+            return pos
+
+        for fid in shard_order:
+            # Only the part of the shard in the range of the reader.
+            file_start = max(reader._get_file_start(fid), reader._start)
+            file_end = min(reader._file_index[fid], reader._get_end())
+            for start in xrange(file_start, file_end, self._read_size):
+                end = min(start + self._read_size, file_end)
+                buffer.extend(xrange(start, end))
+                if num_emitted >= skip:
+                    items.update(self._read_items(start, end))
+                while len(buffer) >= self._buffer_size:
+                    pos = emit()
+                    num_emitted += 1
+                    if num_emitted > skip:
+                        self._num_emitted = num_emitted
+                        yield self._pop_item(items, pos)
+
+        while len(buffer) > 0:
+            pos = emit()
+            num_emitted += 1
+            if num_emitted > skip:
+                self._num_emitted = num_emitted
+                yield self._pop_item(items, pos)
+
+        pass
+
+    def _pop_item(self, items, pos):
+        """Take an item out of the buffer, reading it if it was skipped."""
+        if pos in items:
+            return items.pop(pos)
+        else:
+            return self._read_items(pos, pos + 1)[pos]
+
+
+def _to_array(values):
+    """Convert a list of buffered values of a field into one array."""
+    num_arrays = len([v for v in values if isinstance(v, numpy.ndarray)])
+    if num_arrays == len(values):
+        return numpy.concatenate(values, axis=0)
+    elif num_arrays > 0:
+        # Items from write mixed with blocks from write_many.
+        return numpy.concatenate(
+            [numpy.atleast_1d(v) for v in values], axis=0)
+    elif isinstance(values[0], str):
+        return numpy.array(values, dtype='string')
+    elif isinstance(values[0], int):
+        return numpy.array(values)
+    elif isinstance(values[0], float):
+        return numpy.array(values)
+    else:
+        raise Exception('Unknown type: {}'.format(type(values[0])))
+
+
+def _get_column(value, num_items):
+    """Get the lines of a write_many column and the end line of each item.
+
+    Args:
+        value: numpy.ndarray, items stacked along the first dimension, or
+        tuple of values and lengths, item i has lengths[i] lines.
+        num_items: number, number of items.
+    Returns:
+        lines: numpy.ndarray, lines to write.
+        ends: numpy.ndarray, cumulative number of lines after each item.
+    """
+    if isinstance(value, tuple):
+        lines, lengths = value
+        lines = numpy.asarray(lines)
+        lengths = numpy.asarray(lengths, dtype='int64')
+    else:
+        lines = numpy.asarray(value)
+        if lines.ndim <= 1:
+            lengths = numpy.ones([num_items], dtype='int64')
+        else:
+            # Same as writing each item, one line per row.
+            lengths = numpy.zeros([num_items], dtype='int64') + lines.shape[1]
+            lines = lines.reshape((-1,) + lines.shape[2:])
+    if lengths.shape[0] != num_items:
+        raise Exception('Expected {} items, got {}'.format(
+            num_items, lengths.shape[0]))
+    ends = numpy.cumsum(lengths)
+    if lines.shape[0] != ends[-1]:
+        raise Exception('Expected {} lines, got {}'.format(
+            ends[-1], lines.shape[0]))
+
+    return lines, ends
+
+
+def _get_chunk_shape(value):
+    """Get a chunk shape of whole rows, about STREAM_CHUNK_BYTES each."""
+    row_bytes = value.dtype.itemsize * int(numpy.prod(value.shape[1:]))
+    num_rows = max(1, STREAM_CHUNK_BYTES // max(1, row_bytes))
+
+    return (num_rows,) + value.shape[1:]
+
+
+class ReadFuture(object):
+    """Result of a read done on a background thread.
+
+    Wait for it with result(), or register callbacks, e.g. to hand the result
+    over to an event loop.
+    """
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._error = None
+        self._callbacks = []
+
+        pass
+
+    def done(self):
+        """Whether the read is done."""
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        """Wait for the read and get its result.
+
+        Args:
+            timeout: number, (optional) maximum number of seconds to wait.
+        Returns:
+            result: result of the read. Raises the error of a failed read.
+        """
+        if not self._done.wait(timeout):
+            raise Exception('Read not done after {} seconds'.format(timeout))
+        if self._error is not None:
+            raise self._error
+
+        return self._result
+
+    def add_done_callback(self, callback):
+        """Call a function with the future once the read is done.
+
+        The function is called on the reading thread, or right away if the
+        read is already done.
+
+        Args:
+            callback: function, takes the future.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+        pass
+
+    def _call(self, callback):
+        try:
+            callback(self)
+        except Exception as e:
+            log.error('Read callback failed: {}'.format(e))
+
+        pass
+
+    def _set(self, result=None, error=None):
+        """Finish the read and call the callbacks."""
+        with self._lock:
+            self._result = result
+            self._error = error
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+        for callback in callbacks:
+            self._call(callback)
+
+        pass
+
+
+class AsyncShardedFileReader(object):
+    """Reads a sharded file on background threads, returning futures.
+
+    Reads by key from any thread are queued. A worker takes all requests
+    queued so far, looks up their keys, and reads them with one read_keys
+    pass, so concurrent requests for the same shard share its range reads.
+    Each worker has its own open shards, key lookups share one key index.
+    Batches are read in file order by read_next, or by iterating.
+    """
+
+    def __init__(self, sharded_file, num_workers=2, batch_size=1,
+                 max_open_files=DEFAULT_MAX_OPEN_FILES, prefetch=0,
+                 fields=None, item_cache=None):
+        """Construct an async reader and start its workers.
+
+        Args:
+            sharded_file: SharededFile instance.
+            num_workers: number, number of reading threads.
+            batch_size: number, batch size of read_next.
+            max_open_files: number, maximum number of shards kept open by
+            each worker.
+            prefetch: number, number of batches read ahead by read_next.
+            fields: list of string, (optional) fields to read, default is all
+            fields.
+            item_cache: ItemCache, (optional) cache of items read by key.
+        """
+        self._reader = ShardedFileReader(
+            sharded_file, batch_size=batch_size,
+            max_open_files=max_open_files, fields=fields,
+            item_cache=item_cache)
+
+        # Build the file index once, the readers of the workers share it.
+        self._reader._get_end()
+
+        # Reader of read_next, batches are read one at a time in call order.
+        self._iter_reader = self._reader._clone(max_open_files=max_open_files)
+        self._iter_reader._prefetch = prefetch
+        self._iter_lock = threading.Lock()
+        self._next_futures = collections.deque()
+
+        # Key lookups on the main reader.
+        self._index_lock = threading.Lock()
+
+        self._lock = threading.Lock()
+        self._closed = False
+        self._num_requests = 0
+        self._num_reads = 0
+
+        self._queue = Queue.Queue()
+        self._threads = []
+        for i in xrange(num_workers):
+            reader = self._reader._clone(max_open_files=max_open_files)
+            thread = threading.Thread(target=self._run, args=(reader,))
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+        pass
+
+    def __enter__(self):
+        """Enter with clause."""
+        return self
+
+    def __exit__(self, type, value, traceback):
+        """Exit with clause."""
+        self.close()
+
+        pass
+
+    def __iter__(self):
+        """Iterate batches, reading the next batch while the current one is
+        used."""
+        future = self.read_next()
+        while True:
+            batch = future.result()
+            if batch is None:
+                return
+            future = self.read_next()
+            yield batch
+
+    def __len__(self):
+        """Get number of items in the file."""
+        return len(self._reader)
+
+    def _submit(self, request):
+        """Queue a request, raise if closed."""
+        with self._lock:
+            if self._closed:
+                raise Exception('Reader of {} is closed'.format(
+                    self._reader.file))
+            if request[0] == REQUEST_KEYS:
+                self._num_requests += 1
+            else:
+                self._next_futures.append(request[-1])
+            self._queue.put(request)
+
+        return request[-1]
+
+    def get(self, key, fields=None):
+        """Read an item based on key.
+
+        Args:
+            key: string or int, key of the item.
+            fields: list of string, (optional) fields to read.
+        Returns:
+            future: ReadFuture of a dict, None if the key is not found.
+        """
+        return self._submit((REQUEST_KEYS, [key], fields, True, ReadFuture()))
+
+    def get_many(self, keys, fields=None):
+        """Read a list of items based on keys.
+
+        Args:
+            keys: list of keys.
+            fields: list of string, (optional) fields to read.
+        Returns:
+            future: ReadFuture of a list of dict, in the same order as keys,
+            None for keys not found.
+        """
+        return self._submit((REQUEST_KEYS, list(keys), fields, False,
+                             ReadFuture()))
+
+    def read_next(self):
+        """Read the next batch, in the order of the calls.
+
+        Returns:
+            future: ReadFuture of a batch as returned by iterating
+            ShardedFileReader, None at the end of the file.
+        """
+        return self._submit((REQUEST_NEXT, ReadFuture()))
+
+    def get_stats(self):
+        """Get the number of keyed requests and of reads serving them."""
+        with self._lock:
+            return {'requests': self._num_requests, 'reads': self._num_reads}
+
+    def _take_requests(self, request):
+        """Take the requests queued after a request, to read them together.
+
+        Returns:
+            requests: list of requests.
+            stop: bool, whether the reader is closed.
+        """
+        requests = [request]
+        while len(requests) < MAX_COALESCED_REQUESTS:
+            try:
+                request = self._queue.get_nowait()
+            except Queue.Empty:
+                return requests, False
+            if request is None:
+                return requests, True
+            requests.append(request)
+
+        return requests, False
+
+    def _run(self, reader):
+        try:
+            stop = False
+            while not stop:
+                request = self._queue.get()
+                if request is None:
+                    break
+
+                # Requests queued while waiting for the lock join this read.
+                with self._index_lock:
+                    requests, stop = self._take_requests(request)
+                    key_requests = [r for r in requests
+                                    if r[0] == REQUEST_KEYS]
+                    try:
+                        locations = self._find_keys(key_requests)
+                    except Exception as e:
+                        for r in key_requests:
+                            r[-1]._set(error=e)
+                        key_requests = []
+
+                if len(key_requests) > 0:
+                    self._read_keys(reader, key_requests, locations)
+                for r in requests:
+                    if r[0] == REQUEST_NEXT:
+                        self._read_next()
+        finally:
+            reader.close()
+
+        pass
+
+    def _find_keys(self, requests):
+        """Find the locations of the keys of requests."""
+        locations = []
+        for r in requests:
+            for key in r[1]:
+                location = self._reader._find_key(key)
+                if location is None:
+                    log.warning('Key {} not found in file {}'.format(
+                        key, self._reader.file))
+                locations.append(location)
+
+        return locations
+
+    def _read_keys(self, reader, requests, locations):
+        """Read the keys of requests, together for each set of fields."""
+        groups = collections.OrderedDict()
+        offset = 0
+        for r in requests:
+            fields = r[2] if r[2] is None else tuple(r[2])
+            group = groups.setdefault(fields, ([], []))
+            group[0].append(r)
+            group[1].extend(locations[offset: offset + len(r[1])])
+            offset += len(r[1])
+
+        for fields, (group_requests, group_locations) in groups.iteritems():
+            with self._lock:
+                self._num_reads += 1
+            try:
+                results = reader._read_locations(
+                    group_locations,
+                    fields=fields if fields is None else list(fields))
+            except Exception as e:
+                for r in group_requests:
+                    r[-1]._set(error=e)
+                continue
+            offset = 0
+            for r in group_requests:
+                items = results[offset: offset + len(r[1])]
+                offset += len(r[1])
+                r[-1]._set(items[0] if r[3] else items)
+
+        pass
+
+    def _read_next(self):
+        """Read the next batch for the oldest read_next call."""
+        with self._iter_lock:
+            future = self._next_futures.popleft()
+            try:
+                result = (self._iter_reader.next(), None)
+            except StopIteration:
+                result = (None, None)
+            except Exception as e:
+                result = (None, e)
+        future._set(*result)
+
+        pass
+
+    def close(self):
+        """Stop the workers once the queued requests are read."""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            for thread in self._threads:
+                self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._iter_reader.close()
+        self._reader.close()
+
+        pass
+
+
 class ShardedFileWriter(object):
     """Sharded file writer."""
 
-    def __init__(self, sharded_file, num_objects):
+    def __init__(self, sharded_file, num_objects, block_size=None,
+                 field_options=None):
         """Construct a sharded file writer instance.
 
         Args:
             sharded_file: ShardedFile instance.
             num_objects: number, total number of objects to write.
+            block_size: number, (optional) streaming mode, number of items
+            appended at a time to chunked, resizable datasets. By default a
+            whole shard is buffered in memory.
+            field_options: dict, (optional) field name to storage options:
+                compression: 'gzip' or 'lzf'.
+                compression_opts: gzip level, 0-9.
+                shuffle: bool, byte shuffle filter before compression.
+                chunks: tuple, chunk shape, or number of rows per chunk.
+            The options are stored in the HDF5 dataset filters and in the
+            manifest, readers need no configuration.
         """
         self.file = sharded_file
 
+        # Storage options of each field.
+        if field_options is None:
+            field_options = {}
+        for key, opts in field_options.iteritems():
+            for opt in opts.iterkeys():
+                if opt not in FIELD_OPTIONS:
+                    raise Exception('Unknown option {} for field {}'.format(
+                        opt, key))
+        self._field_options = field_options
+
+        # Number of items appended at a time, None to buffer a whole shard.
+        self._block_size = block_size
+
         # Total number of items to write.
         self._num_objects = num_objects
 
@@ -657,6 +2791,15 @@ class ShardedFileWriter(object):
         # Set of keys used.
         self._keys = set()
 
+        # Manifest entry of each shard written, keyed by shard index.
+        self._shard_infos = {}
+
+        # Field name to dtype and trailing shape, for the manifest.
+        self._fields = {}
+
+        # Keys of each shard written, keyed by shard index.
+        self._shard_keys = {}
+
         pass
 
     def __enter__(self):
@@ -669,6 +2812,50 @@ class ShardedFileWriter(object):
         if self._fh is not None:
             self._fh.close()
             self._fh = None
+        if self._pos == self._num_objects and self._num_objects > 0:
+            # Last shards left empty by rounding the items per shard up.
+            if self._shard not in self._shard_infos:
+                self._close_shard()
+            while self._shard + 1 < self.file.num_shards:
+                self._shard += 1
+                self._close_shard()
+        if len(self._shard_infos) > 0:
+            self._finalize()
+
+        pass
+
+    def _finalize(self):
+        """Write the manifest and the key index after all shards are
+        closed."""
+        shard_infos = []
+        shard_keys = []
+        fields = self._fields
+        for shard_idx in xrange(self.file.num_shards):
+            fname = self.file.get_fname(shard_idx)
+            if shard_idx in self._shard_infos:
+                info = self._shard_infos[shard_idx]
+                info['size'] = os.path.getsize(fname)
+                keys = self._shard_keys[shard_idx]
+            elif os.path.exists(fname):
+                # Shard written by a previous run, e.g. after seek().
+                info, fields_i = _read_shard_info(fname)
+                if len(fields) == 0:
+                    fields = fields_i
+                fh = h5py.File(fname, 'r')
+                keys = fh[KEY_KEYS][:]
+                fh.close()
+            else:
+                log.warning(
+                    'Shard {} not written, skip writing manifest'.format(
+                        fname))
+                return
+            shard_infos.append(info)
+            shard_keys.append(keys)
+
+        # Manifest goes last, the reader only trusts the key index if the
+        # manifest is valid.
+        _write_key_index(self.file, shard_keys)
+        _write_manifest(self.file, shard_infos, fields)
 
         pass
 
@@ -681,7 +2868,7 @@ class ShardedFileWriter(object):
             0-based index.
         """
         if self._fh is None:
-            self._fh = h5py.File(self.file.get_fname(self._shard), 'w')
+            self._open()
 
         # Assign numerical key.
         if key is None:
@@ -725,27 +2912,208 @@ class ShardedFileWriter(object):
 
         # Increment counter.
         self._cur_num_items += 1
+        if self._block_size is not None and \
+                self._cur_num_items % self._block_size == 0:
+            self._append_block()
         self.next()
 
         pass
 
+    def write_many(self, columns, keys=None):
+        """Write a batch of entries, given as columns.
+
+        Same as calling write for each item, but the separators are computed
+        with cumsum and the columns are split at shard boundaries in bulk.
+
+        Args:
+            columns: dict, field name to numpy.ndarray with items stacked
+            along the first dimension, or to tuple of values and lengths for
+            ragged fields, where item i has lengths[i] lines.
+            keys: (optional) list or numpy.ndarray of int or string, keys of
+            the items, default is the 0-based index.
+        """
+        if len(columns) == 0:
+            return
+
+        # Check data format.
+        for kkey in columns.iterkeys():
+            if kkey.startswith('__'):
+                raise Exception(
+                    'Keys must not start with "__": {}'.format(kkey))
+
+        # Number of items from any field.
+        value = columns.itervalues().next()
+        if isinstance(value, tuple):
+            num_items = len(value[1])
+        else:
+            num_items = len(value)
+        if num_items == 0:
+            return
+        if self._pos + num_items > self._num_objects:
+            raise Exception(
+                'Exceeded initialized capacity {}'.format(self._num_objects))
+
+        lines = {}
+        ends = {}
+        for kkey, value in columns.iteritems():
+            lines[kkey], ends[kkey] = _get_column(value, num_items)
+
+        # Assign numerical key.
+        if keys is None:
+            keys = numpy.arange(self._pos, self._pos + num_items)
+        else:
+            keys = numpy.asarray(keys)
+            if keys.shape[0] != num_items:
+                raise Exception('Expected {} keys, got {}'.format(
+                    num_items, keys.shape[0]))
+            sorted_keys = numpy.sort(keys)
+            dupes = sorted_keys[1:][sorted_keys[1:] == sorted_keys[:-1]]
+            if dupes.shape[0] > 0:
+                raise Exception('Key already exists: {}.'.format(dupes[0]))
+
+        start = 0
+        while start < num_items:
+            if self._fh is None:
+                self._open()
+
+            for kkey in columns.iterkeys():
+                if len(self._buffer) > 0 and kkey not in self._buffer:
+                    raise Exception('Unknown key: {}'.format(kkey))
+
+            # Position of the last item of the current shard, see next().
+            shard_last = (self._shard + 1) * self._num_objects_per_shard
+            end = min(num_items, start + shard_last - self._pos + 1)
+
+            if KEY_KEYS not in self._buffer:
+                self._buffer[KEY_KEYS] = []
+            self._buffer[KEY_KEYS].append(keys[start: end])
+
+            for kkey in columns.iterkeys():
+                if start == 0:
+                    line_start = 0
+                else:
+                    line_start = ends[kkey][start - 1]
+                line_end = ends[kkey][end - 1]
+                if kkey not in self._buffer:
+                    self._buffer[kkey] = []
+                self._buffer[kkey].append(lines[kkey][line_start: line_end])
+
+                if kkey not in self._cur_sep:
+                    self._cur_sep[kkey] = []
+                if len(self._cur_sep[kkey]) > 0:
+                    last = self._cur_sep[kkey][-1]
+                else:
+                    last = 0
+                self._cur_sep[kkey].extend(
+                    (ends[kkey][start: end] - line_start + last).tolist())
+
+            self._cur_num_items += end - start
+            self._pos += end - start
+            # Append when the items pass a multiple of the block size, same
+            # as write(), the rest is appended when the shard is closed.
+            if self._block_size is not None and \
+                    self._cur_num_items // self._block_size != \
+                    (self._cur_num_items - end + start) // self._block_size:
+                self._append_block()
+            if self._pos - 1 == shard_last:
+                self.next_file()
+            start = end
+
+        pass
+
+    def _open(self):
+        """Open the current shard for writing."""
+        # Sidecars are no longer valid once a shard is rewritten.
+        _remove_sidecars(self.file)
+        self._fh = h5py.File(self.file.get_fname(self._shard), 'w')
+
+        pass
+
+    def _is_streamed(self, values):
+        """Whether a buffered field is appended in blocks.
+
+        Strings need a fixed width in HDF5, so they stay buffered until the
+        shard is closed.
+        """
+        if isinstance(values[0], numpy.ndarray):
+            return values[0].dtype.kind not in 'SU'
+        else:
+            return isinstance(values[0], (int, float))
+
+    def _append_block(self):
+        """Append the buffered block of numeric fields to resizable datasets
+        in the current shard."""
+        for key, values in self._buffer.iteritems():
+            if key == KEY_KEYS or len(values) == 0 or \
+                    not self._is_streamed(values):
+                continue
+            value = _to_array(values)
+            if key in self._fh:
+                dset = self._fh[key]
+                start = dset.shape[0]
+                dset.resize(start + value.shape[0], axis=0)
+                dset[start:] = value
+            else:
+                self._create_dataset(key, value, resizable=True)
+            self._buffer[key] = []
+
+        pass
+
+    def _create_dataset(self, key, value, resizable=False):
+        """Create a dataset in the current shard with the field options.
+
+        Args:
+            key: string, field name.
+            value: numpy.ndarray, initial data.
+            resizable: bool, whether rows can be appended later.
+        """
+        opts = dict(self._field_options.get(key, {}))
+        chunks = opts.pop('chunks', None)
+        if value.shape[0] == 0 and not resizable:
+            # Chunks and filters need at least one row.
+            self._fh[key] = value
+            return
+
+        if isinstance(chunks, int):
+            chunks = (chunks,) + value.shape[1:]
+        if chunks is None and (resizable or len(opts) > 0):
+            # Chunks of at least one row, also for an empty first block.
+            chunks = _get_chunk_shape(value)
+        if chunks is not None and not resizable:
+            # Chunks cannot be larger than a fixed size dataset.
+            chunks = tuple([min(c, d) for c, d in zip(chunks, value.shape)])
+
+        if resizable:
+            maxshape = (None,) + value.shape[1:]
+        else:
+            maxshape = None
+        self._fh.create_dataset(key, data=value, chunks=chunks,
+                                maxshape=maxshape, **opts)
+
+        pass
+
     def _flush(self):
         """Flush the buffer into the current shard."""
         if len(self._buffer) > 0:
-            for key in self._buffer.iterkeys():
-                if isinstance(self._buffer[key][0], numpy.ndarray):
-                    value = numpy.concatenate(self._buffer[key], axis=0)
-                elif isinstance(self._buffer[key][0], str):
-                    value = numpy.array(self._buffer[key], dtype='string')
-                elif isinstance(self._buffer[key][0], int):
-                    value = numpy.array(self._buffer[key])
-                elif isinstance(self._buffer[key][0], float):
-                    value = numpy.array(self._buffer[key])
-                else:
-                    raise Exception('Unknown type: {}'.format(
-                        type(self._buffer[key][0])))
-                self._fh[key] = value
+            if self._block_size is not None:
+                self._append_block()
+            info = {'num_items': self._cur_num_items, 'nbytes': {}}
+            for key, values in self._buffer.iteritems():
+                if len(values) > 0:
+                    value = _to_array(values)
+                    self._create_dataset(key, value)
+                    if key == KEY_KEYS:
+                        self._shard_keys[self._shard] = value
+                        self._fh[KEY_BLOOM] = BloomFilter.build(
+                            _get_bloom_hashes(value)).bits
+                if key != KEY_KEYS:
+                    dset = self._fh[key]
+                    info['nbytes'][key] = int(
+                        dset.size * dset.dtype.itemsize)
+                    if key not in self._fields:
+                        self._fields[key] = _get_field_info(dset)
             self._fh[KEY_NUM_ITEM] = numpy.array([self._cur_num_items])
+            self._shard_infos[self._shard] = info
             for key in self._cur_sep.iterkeys():
                 sepname = _get_sep_from_key(key)
                 self._fh[sepname] = numpy.array(
@@ -756,6 +3124,40 @@ class ShardedFileWriter(object):
 
         pass
 
+    def get_shard_range(self, shard):
+        """Get the range of items written to a shard.
+
+        Args:
+            shard: number, shard index.
+        Returns:
+            start: number, first item index.
+            end: number, last item index (exclusive).
+        """
+        start = min(shard * self._num_objects_per_shard, self._num_objects)
+        end = min(start + self._num_objects_per_shard, self._num_objects)
+
+        return start, end
+
+    def _close_shard(self):
+        """Flush and close the current shard, writing an empty shard if no
+        item was written."""
+        if self._fh is None:
+            self._open()
+        if self._cur_num_items > 0:
+            self._flush()
+        else:
+            self._fh[KEY_NUM_ITEM] = numpy.array([0])
+            self._fh[KEY_BLOOM] = BloomFilter.build(
+                numpy.zeros([0], dtype='uint64')).bits
+            self._shard_infos[self._shard] = {'num_items': 0, 'nbytes': {}}
+            self._shard_keys[self._shard] = numpy.zeros([0], dtype='int64')
+        self._fh.close()
+        self._fh = None
+        fname = self.file.get_fname(self._shard)
+        self._shard_infos[self._shard]['size'] = os.path.getsize(fname)
+
+        pass
+
     def seek(self, pos, shard):
         """Seek to a position."""
         self._shard = shard
@@ -802,3 +3204,103 @@ class ShardedFileWriter(object):
         self.__exit__(None, None, None)
 
         pass
+
+
+def _write_shards_worker(args):
+    """Write a set of shards in a worker process.
+
+    Args:
+        args: tuple of sharded_file, num_objects, shards, producer,
+        block_size, field_options. See ParallelShardedFileWriter.
+    Returns:
+        shard_infos: dict, shard index to manifest entry.
+        shard_keys: dict, shard index to keys.
+        fields: dict, field name to dtype and trailing shape.
+    """
+    sharded_file, num_objects, shards, producer, block_size, \
+        field_options = args
+    writer = ShardedFileWriter(sharded_file, num_objects,
+                               block_size=block_size,
+                               field_options=field_options)
+    for shard in shards:
+        start, end = writer.get_shard_range(shard)
+        writer.seek(pos=start, shard=shard)
+        for data, key in producer(start, end):
+            writer.write(data, key=key)
+        if writer._pos != end:
+            raise Exception(
+                'Producer wrote {:d} items for range [{:d}, {:d})'.format(
+                    writer._pos - start, start, end))
+        writer._close_shard()
+
+    return writer._shard_infos, writer._shard_keys, writer._fields
+
+
+class ParallelShardedFileWriter(object):
+    """Sharded file writer running several processes.
+
+    Each worker owns a contiguous block of shards and writes the items of
+    those shards. The manifest and the key index are written once all
+    workers finish, so the result reads the same as a ShardedFileWriter
+    output.
+    """
+
+    def __init__(self, sharded_file, num_objects, num_workers=None,
+                 block_size=None, field_options=None):
+        """Construct a parallel sharded file writer instance.
+
+        Args:
+            sharded_file: ShardedFile instance.
+            num_objects: number, total number of objects to write.
+            num_workers: number, number of processes, default is the number
+            of CPUs, at most the number of shards.
+            block_size: number, (optional) streaming mode of each worker, see
+            ShardedFileWriter.
+            field_options: dict, (optional) storage options of each field,
+            see ShardedFileWriter.
+        """
+        self.file = sharded_file
+        self._num_objects = num_objects
+        if num_workers is None:
+            num_workers = multiprocessing.cpu_count()
+        self._num_workers = max(1, min(num_workers, sharded_file.num_shards))
+        self._block_size = block_size
+        self._field_options = field_options
+
+        pass
+
+    def run(self, producer):
+        """Write all items.
+
+        Args:
+            producer: picklable callable (e.g. a module level function),
+            producer(start, end) returns an iterable of (data, key) for items
+            in [start, end). key can be None for the 0-based index.
+        """
+        _remove_sidecars(self.file)
+        shard_blocks = numpy.array_split(
+            numpy.arange(self.file.num_shards), self._num_workers)
+        args = [(self.file, self._num_objects, [int(s) for s in shards],
+                 producer, self._block_size, self._field_options)
+                for shards in shard_blocks]
+        pool = multiprocessing.Pool(self._num_workers)
+        try:
+            results = pool.map(_write_shards_worker, args)
+        finally:
+            pool.close()
+            pool.join()
+
+        shard_infos = {}
+        shard_keys = {}
+        fields = {}
+        for infos_i, keys_i, fields_i in results:
+            shard_infos.update(infos_i)
+            shard_keys.update(keys_i)
+            if len(fields) == 0:
+                fields = fields_i
+        num_shards = self.file.num_shards
+        _write_key_index(self.file, [shard_keys[s] for s in xrange(num_shards)])
+        _write_manifest(self.file, [shard_infos[s] for s in xrange(num_shards)],
+                        fields)
+
+        pass
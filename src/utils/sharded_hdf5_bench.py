@@ -0,0 +1,516 @@
+"""
+Benchmarks for sharded HDF5 reading and writing.
+
+Usage:
+    python sharded_hdf5_bench.py -bench read -num_items 20000 -batch 10000
+
+Benchmarks:
+    read: per-item HDF5 slicing versus range reads split with numpy views, on
+    fixed-size and variable-length fields.
+    keys: random keyed reads with one open shard versus a pool of open shards.
+    prefetch: scan with a simulated consumer, with and without read-ahead.
+    write: buffered versus streaming writes, time and peak memory.
+    compression: write and read MB/s and compression ratio of mask, box and
+    feature fields under each compression setting.
+    mmap: scan of a fixed-size feature field, h5py copies versus memory-mapped
+    views.
+    collate: per-item reads stacked with numpy versus column reads.
+    write_many: per-item writes versus column writes.
+    key_index: build time and memory of a dict key index versus numpy arrays,
+    for image path keys without a key index sidecar.
+    item_cache: repeated keyed reads of a few hot keys, with and without an
+    item cache.
+    async: single-key reads one at a time versus concurrent requests to the
+    async reader, for keys spread over the file and clustered keys.
+"""
+
+import argparse
+import h5py
+import logger
+import multiprocessing
+import numpy
+import os
+import resource
+import sharded_hdf5 as sh
+import shutil
+import tempfile
+import time
+
+log = logger.get()
+
+
+class _PerItemReader(sh.ShardedFileReader):
+    """Reader that slices the file once per item and per field."""
+
+    def _read_range(self, item_start, item_end, fields=None, copy=False):
+        return [self._read_item(idx, fields=fields)
+                for idx in xrange(item_start, item_end)]
+
+
+def _write_bench_file(f, num_items, variable, dim=16):
+    """Write a sharded file for benchmarking.
+
+    Args:
+        f: ShardedFile instance.
+        num_items: number, number of items.
+        variable: bool, whether the array field has variable length.
+        dim: number, size of the array field trailing dimension.
+    """
+    random = numpy.random.RandomState(2)
+    with sh.ShardedFileWriter(f, num_objects=num_items) as writer:
+        for i in xrange(num_items):
+            num_rows = random.randint(1, 10) if variable else 4
+            writer.write({
+                'feature': random.uniform(
+                    size=(num_rows, dim)).astype('float32'),
+                'label': i
+            })
+
+    pass
+
+
+def _time_read(reader_cls, f, batch_size):
+    """Time a full scan of a sharded file.
+
+    Returns:
+        elapsed: number, seconds.
+        num_items: number, number of items read.
+    """
+    num_items = 0
+    start = time.time()
+    with reader_cls(f, batch_size=batch_size) as reader:
+        for items in reader:
+            if batch_size == 1:
+                num_items += 1
+            else:
+                num_items += len(items)
+    elapsed = time.time() - start
+
+    return elapsed, num_items
+
+
+def bench_read(args):
+    """Compare per-item and range reads."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for variable in [False, True]:
+            name = 'variable' if variable else 'fixed'
+            f = sh.ShardedFile(os.path.join(tmpdir, name),
+                               num_shards=args.num_shards)
+            _write_bench_file(f, args.num_items, variable)
+            for reader_cls, path in [(_PerItemReader, 'per-item'),
+                                     (sh.ShardedFileReader, 'range')]:
+                elapsed, num_items = _time_read(reader_cls, f, args.batch)
+                log.info('{:8s} {:8s} {:d} items {:.3f}s {:.0f} items/s'.format(
+                    name, path, num_items, elapsed, num_items / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def bench_keys(args):
+    """Compare random keyed reads with different open shard pool sizes."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(tmpdir, 'keys'),
+                           num_shards=args.num_shards)
+        _write_bench_file(f, args.num_items, variable=True)
+        random = numpy.random.RandomState(3)
+        keys = random.randint(0, args.num_items, size=args.batch)
+        for max_open_files in [1, args.num_shards]:
+            start = time.time()
+            with sh.ShardedFileReader(
+                    f, max_open_files=max_open_files) as reader:
+                for key in keys:
+                    reader[key]
+                stats = reader.get_handle_stats()
+            elapsed = time.time() - start
+            log.info(('max_open_files {:3d} {:d} reads {:.3f}s '
+                      '{:.0f} reads/s hits {:d} misses {:d}').format(
+                max_open_files, len(keys), elapsed, len(keys) / elapsed,
+                stats['hits'], stats['misses']))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def bench_prefetch(args):
+    """Compare scans with and without reading ahead on a thread."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(tmpdir, 'prefetch'),
+                           num_shards=args.num_shards)
+        _write_bench_file(f, args.num_items, variable=True, dim=256)
+        for prefetch in [0, 4]:
+            start = time.time()
+            with sh.ShardedFileReader(
+                    f, batch_size=args.batch, prefetch=prefetch) as reader:
+                for items in reader:
+                    # Simulated consumer work.
+                    time.sleep(args.work)
+            elapsed = time.time() - start
+            log.info('prefetch {:d} {:.3f}s'.format(prefetch, elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def _write_masks(f, num_items, block_size, queue):
+    """Write segmentation-like items and report time and peak memory."""
+    start = time.time()
+    mask = numpy.zeros((128, 128), dtype='uint8')
+    image = numpy.zeros((128, 128, 3), dtype='uint8')
+    with sh.ShardedFileWriter(f, num_objects=num_items,
+                              block_size=block_size) as writer:
+        for i in xrange(num_items):
+            writer.write({'input': image, 'label_segmentation': mask,
+                          'label_objectness': 1})
+    elapsed = time.time() - start
+    queue.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+    pass
+
+
+def bench_write(args):
+    """Compare buffered and streaming writes, each in a fresh process."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(tmpdir, 'write'),
+                           num_shards=args.num_shards)
+        for block_size in [None, 256]:
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(
+                target=_write_masks,
+                args=(f, args.num_items, block_size, queue))
+            proc.start()
+            elapsed, maxrss = queue.get()
+            proc.join()
+            log.info('block_size {} {:.3f}s {:.0f} items/s peak {:.0f}MB'.format(
+                block_size, elapsed, args.num_items / elapsed,
+                maxrss / 1024.0))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+COMPRESSION_SETTINGS = [
+    ('none', {}),
+    ('lzf', {'compression': 'lzf'}),
+    ('gzip1', {'compression': 'gzip', 'compression_opts': 1}),
+    ('gzip4', {'compression': 'gzip', 'compression_opts': 4}),
+    ('shuffle+lzf', {'compression': 'lzf', 'shuffle': True}),
+    ('shuffle+gzip4', {'compression': 'gzip', 'compression_opts': 4,
+                       'shuffle': True})
+]
+
+
+def _get_field_data(name, random):
+    """Generate one item of a mask, box or feature field."""
+    if name == 'mask':
+        mask = numpy.zeros((128, 128), dtype='uint8')
+        y, x = random.randint(0, 96, size=2)
+        h, w = random.randint(8, 32, size=2)
+        mask[y: y + h, x: x + w] = 1
+        return mask
+    elif name == 'box':
+        num_boxes = random.randint(1, 20)
+        return (random.uniform(size=(num_boxes, 4)) * 640).astype('float32')
+    elif name == 'feature':
+        num_boxes = random.randint(1, 20)
+        feat = random.normal(size=(num_boxes, 512)).astype('float32')
+        return numpy.maximum(feat, 0)
+    else:
+        raise Exception('Unknown field {}'.format(name))
+
+
+def bench_compression(args):
+    """Report throughput and compression ratio of each setting."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        for name in ['mask', 'box', 'feature']:
+            random = numpy.random.RandomState(2)
+            items = [_get_field_data(name, random)
+                     for i in xrange(args.num_items)]
+            raw_bytes = sum([item.nbytes for item in items])
+            for setting, opts in COMPRESSION_SETTINGS:
+                f = sh.ShardedFile(os.path.join(tmpdir, name + setting),
+                                   num_shards=args.num_shards)
+                start = time.time()
+                with sh.ShardedFileWriter(
+                        f, num_objects=args.num_items,
+                        field_options={name: opts}) as writer:
+                    for item in items:
+                        writer.write({name: item})
+                write_secs = time.time() - start
+                disk_bytes = sum([os.path.getsize(f.get_fname(i))
+                                  for i in xrange(args.num_shards)])
+                read_secs, num_items = _time_read(
+                    sh.ShardedFileReader, f, args.batch)
+                log.info(('{:8s} {:14s} write {:7.1f}MB/s read {:7.1f}MB/s '
+                          'ratio {:6.2f}').format(
+                    name, setting, raw_bytes / write_secs / 1e6,
+                    raw_bytes / read_secs / 1e6,
+                    raw_bytes / float(disk_bytes)))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def bench_mmap(args):
+    """Compare scans through h5py and through memory maps."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(tmpdir, 'mmap'),
+                           num_shards=args.num_shards)
+        _write_bench_file(f, args.num_items, variable=False, dim=256)
+        for mmap in [False, True]:
+            num_items = 0
+            total = 0.0
+            start = time.time()
+            with sh.ShardedFileReader(
+                    f, batch_size=args.batch, mmap=mmap) as reader:
+                for items in reader:
+                    for item in items:
+                        # Touch the data, as a consumer would.
+                        total += item['feature'][0, 0]
+                    num_items += len(items)
+            elapsed = time.time() - start
+            log.info('mmap {} {:d} items {:.3f}s {:.0f} items/s'.format(
+                mmap, num_items, elapsed, num_items / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def bench_collate(args):
+    """Compare stacking item reads with reading columns."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(tmpdir, 'collate'),
+                           num_shards=args.num_shards)
+        _write_bench_file(f, args.num_items, variable=False, dim=256)
+        for collate in [False, True]:
+            start = time.time()
+            with sh.ShardedFileReader(
+                    f, batch_size=args.batch, collate=collate) as reader:
+                for batch in reader:
+                    if not collate:
+                        batch = {
+                            'feature': numpy.array(
+                                [item['feature'] for item in batch]),
+                            'label': numpy.array(
+                                [item['label'] for item in batch])
+                        }
+            elapsed = time.time() - start
+            log.info('collate {} {:.3f}s {:.0f} items/s'.format(
+                collate, elapsed, args.num_items / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def bench_write_many(args):
+    """Compare writing items one by one and writing columns."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        random = numpy.random.RandomState(2)
+        columns = {
+            'feature': random.uniform(
+                size=(args.num_items, 16)).astype('float32'),
+            'label': numpy.arange(args.num_items)
+        }
+        f = sh.ShardedFile(os.path.join(tmpdir, 'write_many'),
+                           num_shards=args.num_shards)
+        for bulk in [False, True]:
+            start = time.time()
+            with sh.ShardedFileWriter(
+                    f, num_objects=args.num_items) as writer:
+                if bulk:
+                    for batch_start in xrange(
+                            0, args.num_items, args.batch):
+                        batch_end = batch_start + args.batch
+                        writer.write_many({
+                            'feature': columns['feature'][
+                                batch_start: batch_end],
+                            'label': columns['label'][batch_start: batch_end]
+                        })
+                else:
+                    for i in xrange(args.num_items):
+                        writer.write({'feature': columns['feature'][i],
+                                      'label': columns['label'][i]})
+            elapsed = time.time() - start
+            log.info('write_many {} {:.3f}s {:.0f} items/s'.format(
+                bulk, elapsed, args.num_items / elapsed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def _build_key_index(f, use_dict, queue):
+    """Build a key index and report time and memory growth."""
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if use_dict:
+        # As the reader did before it used numpy arrays.
+        key_index = {}
+        for shard_idx in xrange(f.num_shards):
+            fh = h5py.File(f.get_fname(shard_idx), 'r')
+            keys = fh[sh.KEY_KEYS][:]
+            fh.close()
+            for key_idx in xrange(keys.shape[0]):
+                key_index[keys[key_idx]] = (shard_idx, key_idx)
+    else:
+        reader = sh.ShardedFileReader(f, check=False)
+        key_index = reader._get_key_index()
+    elapsed = time.time() - start
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss
+    queue.put((elapsed, rss, len(key_index)))
+
+    pass
+
+
+def bench_key_index(args):
+    """Compare dict and numpy key indices, each in a fresh process."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(tmpdir, 'key_index'),
+                           num_shards=args.num_shards)
+        keys = ['train2014/COCO_train2014_{:012d}.jpg'.format(i)
+                for i in xrange(args.num_items)]
+        with sh.ShardedFileWriter(f, num_objects=args.num_items) as writer:
+            writer.write_many({'label': numpy.arange(args.num_items)},
+                              keys=keys)
+        del keys
+        for fname in f.get_sidecar_fnames():
+            os.remove(fname)
+        for use_dict in [True, False]:
+            queue = multiprocessing.Queue()
+            proc = multiprocessing.Process(
+                target=_build_key_index, args=(f, use_dict, queue))
+            proc.start()
+            elapsed, rss, num_keys = queue.get()
+            proc.join()
+            log.info('dict {} {:d} keys {:.3f}s memory {:.1f}MB'.format(
+                use_dict, num_keys, elapsed, rss / 1024.0))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def bench_item_cache(args):
+    """Compare repeated keyed reads with and without an item cache."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(tmpdir, 'item_cache'),
+                           num_shards=args.num_shards)
+        _write_bench_file(f, args.num_items, variable=True)
+        # Several reads per key, as with several questions per image.
+        random = numpy.random.RandomState(4)
+        keys = random.randint(0, args.num_items / 10, size=args.batch)
+        for max_bytes in [None, 64 * 1024 * 1024]:
+            item_cache = None
+            if max_bytes is not None:
+                item_cache = sh.ItemCache(max_bytes)
+            start = time.time()
+            with sh.ShardedFileReader(f, item_cache=item_cache) as reader:
+                for i in xrange(0, len(keys), 100):
+                    reader.read_keys(keys[i: i + 100])
+            elapsed = time.time() - start
+            stats = {} if item_cache is None else item_cache.get_stats()
+            log.info('cache {} {:d} reads {:.3f}s {:.0f} reads/s {}'.format(
+                max_bytes, len(keys), elapsed, len(keys) / elapsed, stats))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def bench_async(args):
+    """Compare keyed reads one at a time with concurrent async requests, for
+    keys spread over the file and keys clustered in one part of it."""
+    tmpdir = tempfile.mkdtemp()
+    try:
+        f = sh.ShardedFile(os.path.join(tmpdir, 'async'),
+                           num_shards=args.num_shards)
+        _write_bench_file(f, args.num_items, variable=True)
+        random = numpy.random.RandomState(5)
+        for name, num_keys in [('spread', args.num_items),
+                               ('cluster', args.num_items / 10)]:
+            keys = random.randint(0, num_keys, size=args.batch)
+
+            start = time.time()
+            with sh.ShardedFileReader(f) as reader:
+                for key in keys:
+                    reader[key]
+            elapsed = time.time() - start
+            log.info('{:8s} sync  {:d} reads {:.3f}s {:.0f} reads/s'.format(
+                name, len(keys), elapsed, len(keys) / elapsed))
+
+            start = time.time()
+            with sh.AsyncShardedFileReader(f) as reader:
+                futures = [reader.get(key) for key in keys]
+                for future in futures:
+                    future.result()
+                stats = reader.get_stats()
+            elapsed = time.time() - start
+            log.info('{:8s} async {:d} reads {:.3f}s {:.0f} reads/s {}'.format(
+                name, len(keys), elapsed, len(keys) / elapsed, stats))
+    finally:
+        shutil.rmtree(tmpdir)
+
+    pass
+
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(
+        description='Benchmark sharded HDF5 reading and writing')
+    parser.add_argument('-bench', default='read', help='Benchmark name')
+    parser.add_argument('-num_items', default=20000, type=int,
+                        help='Number of items')
+    parser.add_argument('-num_shards', default=4, type=int,
+                        help='Number of shards')
+    parser.add_argument('-batch', default=10000, type=int,
+                        help='Number of items per read')
+    parser.add_argument('-work', default=0.01, type=float,
+                        help='Simulated consumer seconds per batch')
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.bench == 'read':
+        bench_read(args)
+    elif args.bench == 'keys':
+        bench_keys(args)
+    elif args.bench == 'prefetch':
+        bench_prefetch(args)
+    elif args.bench == 'write':
+        bench_write(args)
+    elif args.bench == 'compression':
+        bench_compression(args)
+    elif args.bench == 'mmap':
+        bench_mmap(args)
+    elif args.bench == 'collate':
+        bench_collate(args)
+    elif args.bench == 'write_many':
+        bench_write_many(args)
+    elif args.bench == 'key_index':
+        bench_key_index(args)
+    elif args.bench == 'item_cache':
+        bench_item_cache(args)
+    elif args.bench == 'async':
+        bench_async(args)
+    else:
+        log.fatal('Unknown benchmark: {}'.format(args.bench))
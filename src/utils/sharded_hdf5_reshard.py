@@ -0,0 +1,214 @@
+"""
+Reshard and merge sharded HDF5 files.
+
+Copies the items of one or more sharded files into a new sharded file with a
+target number of items or bytes per shard, e.g. to even out shards written by
+restarted or parallel jobs. Fields are copied in blocks of lines, items are
+never decoded one by one, and the writer appends a block at a time, so memory
+is bounded by the block size and the keys.
+
+Usage:
+    python sharded_hdf5_reshard.py -input "a-*" -input "b-*" -output c \\
+        -items_per_shard 10000 -dedup
+"""
+
+import argparse
+import h5py
+import logger
+import math
+import numpy
+import sharded_hdf5 as sh
+
+log = logger.get()
+
+DEFAULT_BLOCK_ITEMS = 1000
+
+
+def _get_shard_infos(sharded_file):
+    """Get the manifest entries of the shards of a file.
+
+    Args:
+        sharded_file: ShardedFile instance.
+    Returns:
+        shard_infos: list of dict, manifest entry of each shard.
+        fields: dict, field name to dtype, shape and storage layout.
+    """
+    manifest = sh._load_manifest(sharded_file)
+    if manifest is not None:
+        return manifest['shards'], manifest['fields']
+
+    shard_infos = []
+    fields = {}
+    for shard in xrange(sharded_file.num_shards):
+        info, fields_i = sh._read_shard_info(sharded_file.get_fname(shard))
+        shard_infos.append(info)
+        fields.update(fields_i)
+
+    return shard_infos, fields
+
+
+def _read_keys(sharded_file):
+    """Read the keys of all items of a file, in file order."""
+    keys = []
+    for shard in xrange(sharded_file.num_shards):
+        fh = h5py.File(sharded_file.get_fname(shard), 'r')
+        if sh.KEY_KEYS in fh:
+            keys.append(fh[sh.KEY_KEYS][:])
+        fh.close()
+
+    return numpy.concatenate(keys)
+
+
+def _get_field_options(fields):
+    """Get writer options that keep the compression of the input fields."""
+    field_options = {}
+    for key, info in fields.iteritems():
+        if info.get('compression') is not None:
+            field_options[key] = {
+                'compression': info['compression'],
+                'compression_opts': info['compression_opts'],
+                'shuffle': info['shuffle']
+            }
+
+    return field_options
+
+
+def _select(columns, keep):
+    """Select items of a block of columns.
+
+    Args:
+        columns: dict, field name to values and offsets.
+        keep: numpy.ndarray, bool mask of the items to keep.
+    Returns:
+        columns: dict, field name to values and lengths, for write_many.
+    """
+    results = {}
+    for key, (values, offsets) in columns.iteritems():
+        lengths = numpy.diff(offsets)
+        if keep is None:
+            results[key] = (values, lengths)
+        else:
+            line_keep = numpy.repeat(keep, lengths)
+            results[key] = (values[line_keep], lengths[keep])
+
+    return results
+
+
+def reshard(input_files, output_prefix, items_per_shard=None,
+            bytes_per_shard=None, dedup=False, field_options=None,
+            block_items=DEFAULT_BLOCK_ITEMS):
+    """Copy sharded files into one sharded file with even shards.
+
+    Args:
+        input_files: list of ShardedFile instances, copied in order.
+        output_prefix: string, file prefix of the output.
+        items_per_shard: number, target number of items per output shard.
+        bytes_per_shard: number, target number of field bytes per output
+        shard, used if items_per_shard is not given.
+        dedup: bool, only copy the first item of each key.
+        field_options: dict, (optional) storage options of the output fields,
+        see ShardedFileWriter. Default keeps the compression of the input.
+        block_items: number, number of items copied at a time.
+    Returns:
+        output_file: ShardedFile instance.
+    """
+    if items_per_shard is None and bytes_per_shard is None:
+        raise Exception('Need either items_per_shard or bytes_per_shard')
+
+    # Keys and sizes of the inputs.
+    keys = []
+    num_items = 0
+    num_bytes = 0
+    fields = {}
+    for f in input_files:
+        keys.append(_read_keys(f))
+        shard_infos, fields_i = _get_shard_infos(f)
+        num_items += sum([info['num_items'] for info in shard_infos])
+        num_bytes += sum([sum(info['nbytes'].itervalues())
+                          for info in shard_infos])
+        if len(fields) == 0:
+            fields = fields_i
+
+    # Keep the first item of each key.
+    keep = None
+    if dedup:
+        all_keys = numpy.concatenate(keys)
+        keep = numpy.zeros([all_keys.shape[0]], dtype='bool')
+        keep[numpy.unique(all_keys, return_index=True)[1]] = True
+        num_kept = int(keep.sum())
+        log.info('Dropping {} duplicate items'.format(num_items - num_kept))
+        if num_items > 0:
+            num_bytes = num_bytes * num_kept / num_items
+        num_items = num_kept
+
+    if items_per_shard is not None:
+        num_shards = int(math.ceil(num_items / float(items_per_shard)))
+    else:
+        num_shards = int(math.ceil(num_bytes / float(bytes_per_shard)))
+    num_shards = max(1, num_shards)
+    output_file = sh.ShardedFile(output_prefix, num_shards=num_shards)
+    log.info('Writing {} items to {}'.format(num_items, output_file))
+
+    output_fnames = set([output_file.get_fname(i) for i in xrange(num_shards)])
+    for f in input_files:
+        for shard in xrange(f.num_shards):
+            if f.get_fname(shard) in output_fnames:
+                raise Exception('Output overwrites input {}'.format(
+                    f.get_fname(shard)))
+
+    if field_options is None:
+        field_options = _get_field_options(fields)
+
+    offset = 0
+    with sh.ShardedFileWriter(output_file, num_objects=num_items,
+                              block_size=block_items,
+                              field_options=field_options) as writer:
+        for f, keys_i in zip(input_files, keys):
+            log.info('Copying {}'.format(f))
+            with sh.ShardedFileReader(f) as reader:
+                pos = 0
+                while pos < keys_i.shape[0]:
+                    columns = reader.read_batch(block_items, stack=False)
+                    num_read = len(columns.itervalues().next()[1]) - 1
+                    keep_i = None
+                    if keep is not None:
+                        keep_i = keep[offset + pos: offset + pos + num_read]
+                    block_keys = keys_i[pos: pos + num_read]
+                    if keep_i is not None:
+                        block_keys = block_keys[keep_i]
+                    if block_keys.shape[0] > 0:
+                        writer.write_many(_select(columns, keep_i),
+                                          keys=block_keys)
+                    pos += num_read
+            offset += keys_i.shape[0]
+
+    return output_file
+
+
+def parse_args():
+    """Parse input arguments."""
+    parser = argparse.ArgumentParser(
+        description='Reshard and merge sharded HDF5 files')
+    parser.add_argument('-input', action='append', required=True,
+                        help='Input file pattern, can be repeated')
+    parser.add_argument('-output', required=True, help='Output file prefix')
+    parser.add_argument('-items_per_shard', default=None, type=int,
+                        help='Number of items per output shard')
+    parser.add_argument('-bytes_per_shard', default=None, type=int,
+                        help='Number of field bytes per output shard')
+    parser.add_argument('-dedup', action='store_true',
+                        help='Only keep the first item of each key')
+    parser.add_argument('-block_items', default=DEFAULT_BLOCK_ITEMS,
+                        type=int, help='Number of items copied at a time')
+    args = parser.parse_args()
+
+    return args
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    input_files = [sh.ShardedFile.from_pattern_read(pattern)
+                   for pattern in args.input]
+    reshard(input_files, args.output, items_per_shard=args.items_per_shard,
+            bytes_per_shard=args.bytes_per_shard, dedup=args.dedup,
+            block_items=args.block_items)
@@ -0,0 +1,70 @@
+import numpy as np
+import os
+import sharded_hdf5 as sh
+import sharded_hdf5_reshard as reshard
+import unittest
+
+
+def _remove_files(f):
+    """Remove all shards and sidecars of a sharded file."""
+    dirname = os.path.dirname(f.file_prefix)
+    for fname in os.listdir(dirname):
+        fullname = os.path.join(dirname, fname)
+        if fullname.startswith(f.file_prefix + '-'):
+            os.remove(fullname)
+
+    pass
+
+
+def _write(fname, num_shards, indices, field_options=None):
+    """Write items with a ragged field, keyed by index."""
+    f = sh.ShardedFile(fname, num_shards=num_shards)
+    with sh.ShardedFileWriter(f, num_objects=len(indices),
+                              field_options=field_options) as writer:
+        for i in indices:
+            writer.write({'index': i,
+                          'row': np.zeros((4,)) + i,
+                          'value': np.zeros((i % 3 + 1, 2)) + i},
+                         key='k{:d}'.format(i))
+
+    return f
+
+
+class ShardedFileReshardTests(unittest.TestCase):
+
+    def test_reshard(self):
+        opts = {'value': {'compression': 'gzip'}}
+        f = _write('reshard1', 8, range(0, 30), field_options=opts)
+        f2 = _write('reshard2', 2, range(20, 45))
+
+        out = reshard.reshard([f, f2], 'reshard3', items_per_shard=10,
+                              block_items=4)
+        self.assertEqual(out.num_shards, 6)
+        with sh.ShardedFileReader(out, batch_size=100) as reader:
+            indices = [item['index'] for items in reader for item in items]
+            self.assertEqual(indices, range(30) + range(20, 45))
+            item = reader['k28']
+            self.assertTrue((item['value'] == 28).all())
+            self.assertEqual(item['value'].shape, (28 % 3 + 1, 2))
+            self.assertEqual(item['row'].shape, (4,))
+            self.assertEqual(reader._handle.fh['value'].compression, 'gzip')
+        _remove_files(out)
+
+        out = reshard.reshard([f, f2], 'reshard3', bytes_per_shard=1000,
+                              dedup=True, block_items=4)
+        with sh.ShardedFileReader(out, batch_size=100) as reader:
+            indices = [item['index'] for items in reader for item in items]
+            self.assertEqual(indices, range(45))
+            self.assertTrue(out.num_shards > 1)
+        _remove_files(out)
+
+        self.assertRaises(Exception, reshard.reshard, [f], 'reshard1',
+                          items_per_shard=4)
+
+        _remove_files(f)
+        _remove_files(f2)
+
+        pass
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,9 +1,40 @@
+import h5py
+import json
 import numpy as np
 import os
 import sharded_hdf5 as sh
+import threading
 import unittest
 
 
+def _remove_files(f):
+    """Remove all shards and sidecars of a sharded file."""
+    dirname = os.path.dirname(f.file_prefix)
+    for fname in os.listdir(dirname):
+        fullname = os.path.join(dirname, fname)
+        if fullname.startswith(f.file_prefix + '-'):
+            os.remove(fullname)
+
+    pass
+
+
+def _produce(start, end):
+    """Produce items for the parallel writer test."""
+    for i in xrange(start, end):
+        yield {'value': np.zeros((i % 3 + 1, 2)) + i, 'index': i}, \
+            'k{:d}'.format(i)
+
+
+def _is_mapped(value):
+    """Whether an array is a view of a memory map."""
+    while value is not None:
+        if isinstance(value, np.memmap):
+            return True
+        value = value.base
+
+    return False
+
+
 class ShardedFileTests(unittest.TestCase):
     """Unit tests for ShardedFile, ShardedFileReader, and ShardedFileWriter."""
 
@@ -50,8 +81,7 @@ class ShardedFileTests(unittest.TestCase):
                     self.assertTrue((dkey1 == 3 * i).all())
                     self.assertTrue((dkey2 == -3 * i).all())
 
-        for i in xrange(num_shards):
-            os.remove(f.get_fname(i))
+        _remove_files(f)
 
         pass
 
@@ -78,8 +108,943 @@ class ShardedFileTests(unittest.TestCase):
                 self.assertTrue((data['value'] == i).all())
                 self.assertTrue(data['key'] == i)
 
-        for i in xrange(num_shards):
-            os.remove(f.get_fname(i))
+        _remove_files(f)
+
+        pass
+
+    def test_manifest(self):
+        N = 100
+        N1 = 10
+        D1 = 10
+        num_shards = 10
+
+        f = sh.ShardedFile('test3', num_shards=num_shards)
+
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'value': np.zeros((N1, D1)) + i}, key=str(i))
+
+        self.assertTrue(os.path.exists(f.get_manifest_fname()))
+        manifest = sh._load_manifest(f)
+        self.assertEqual(manifest['num_items'], N)
+        self.assertEqual(manifest['fields']['value']['shape'], [D1])
+        self.assertEqual(len(manifest['shards']), num_shards)
+        self.assertEqual(
+            sum([s['num_items'] for s in manifest['shards']]), N)
+
+        with sh.ShardedFileReader(f) as reader:
+            self.assertEqual(len(reader), N)
+            for i, data in enumerate(reader):
+                self.assertTrue((data['value'] == i).all())
+
+        # Pattern lookup ignores the manifest.
+        f2 = sh.ShardedFile.from_pattern_read(
+            os.path.abspath('test3-*'))
+        self.assertEqual(f2.num_shards, num_shards)
+
+        # Stale manifest falls back to scanning the shards.
+        manifest['shards'][0]['size'] += 1
+        with open(f.get_manifest_fname(), 'w') as fh:
+            json.dump(manifest, fh)
+        self.assertTrue(sh._load_manifest(f) is None)
+        with sh.ShardedFileReader(f) as reader:
+            self.assertEqual(len(reader), N)
+
+        # Rebuild from the shards.
+        sh.build_manifest(f)
+        self.assertEqual(sh._load_manifest(f)['num_items'], N)
+
+        _remove_files(f)
+
+        pass
+
+    def test_key_index(self):
+        N = 100
+        num_shards = 10
+
+        f = sh.ShardedFile('test4', num_shards=num_shards)
+
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'value': np.zeros((2, 3)) + i},
+                             key='img_{:d}.jpg'.format(N - i))
+
+        keys_fname, locs_fname = f.get_key_index_fnames()
+        self.assertTrue(os.path.exists(keys_fname))
+        self.assertTrue(os.path.exists(locs_fname))
+
+        with sh.ShardedFileReader(f) as reader:
+            self.assertTrue('img_5.jpg' in reader)
+            self.assertFalse('img_500.jpg' in reader)
+            self.assertFalse(5 in reader)
+            self.assertTrue(isinstance(reader._key_index, sh.SortedKeyIndex))
+            self.assertEqual(len(reader.keys()), N)
+            for i in xrange(N):
+                data = reader['img_{:d}.jpg'.format(N - i)]
+                self.assertTrue((data['value'] == i).all())
+            self.assertTrue(reader['img_500.jpg'] is None)
+
+        # Missing key index falls back to the shards that may hold a key.
+        os.remove(keys_fname)
+        with sh.ShardedFileReader(f) as reader:
+            self.assertTrue((reader['img_7.jpg']['value'] == N - 7).all())
+            self.assertTrue(reader._key_index is None)
+            self.assertEqual(len(reader._shard_key_indices), 1)
+            self.assertTrue(isinstance(reader._get_key_index(),
+                                       sh.HashedKeyIndex))
+
+            # Clones sharing the hashed index check keys in their own shards.
+            stats = reader._handles.get_stats()
+            clones = [reader._clone(max_open_files=2) for i in xrange(2)]
+            errors = []
+
+            def lookup(clone, offset):
+                try:
+                    for i in xrange(offset, N, 2):
+                        key = 'img_{:d}.jpg'.format(N - i)
+                        self.assertTrue(key in clone)
+                        self.assertTrue((clone[key]['value'] == i).all())
+                except Exception as e:
+                    errors.append(e)
+
+            threads = [threading.Thread(target=lookup, args=(clones[i], i))
+                       for i in xrange(2)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertEqual(errors, [])
+            self.assertEqual(reader._handles.get_stats(), stats)
+            for clone in clones:
+                self.assertTrue(clone._handles.get_stats()['misses'] > 0)
+                clone._handles.close()
+
+        sh.build_key_index(f)
+        with sh.ShardedFileReader(f) as reader:
+            self.assertTrue((reader['img_7.jpg']['value'] == N - 7).all())
+            self.assertTrue(isinstance(reader._key_index, sh.SortedKeyIndex))
+
+        _remove_files(f)
+
+        pass
+
+    def test_read_range(self):
+        N = 100
+        num_shards = 7
+
+        f = sh.ShardedFile('test5', num_shards=num_shards)
+
+        # Variable length field, item i has i % 4 + 1 rows.
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({
+                    'var': np.zeros((i % 4 + 1, 3)) + i,
+                    'fixed': np.zeros((2,)) - i,
+                    'scalar': i
+                })
+
+        with sh.ShardedFileReader(f) as reader:
+            for i, data in enumerate(reader):
+                self.assertEqual(data['var'].shape[-1], 3)
+                self.assertEqual(data['var'].size, (i % 4 + 1) * 3)
+                self.assertTrue((data['var'] == i).all())
+                self.assertTrue((data['fixed'] == -i).all())
+                self.assertEqual(data['scalar'], i)
+            self.assertEqual(i, N - 1)
+
+        with sh.ShardedFileReader(f, batch_size=6) as reader:
+            count = 0
+            for items in reader:
+                for data in items:
+                    self.assertTrue((data['var'] == count).all())
+                    self.assertEqual(data['scalar'], count)
+                    count += 1
+            self.assertEqual(count, N)
+
+        with sh.ShardedFileReader(f) as reader:
+            for pos in [0, 14, 15, 16, 57, N - 1]:
+                reader.seek(pos)
+                self.assertEqual(reader.read()['scalar'], pos)
+
+            # Seeking to the end gives an exhausted reader.
+            self.assertEqual(list(reader.seek(N)), [])
+            with reader.partition(1, 3) as part:
+                self.assertEqual(list(part.seek(len(part))), [])
+                self.assertEqual(part.seek(0).read()['scalar'], part._start)
+
+        _remove_files(f)
+
+        pass
+
+    def test_read_keys_batch(self):
+        N = 100
+        num_shards = 10
+
+        f = sh.ShardedFile('test6', num_shards=num_shards)
+
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'value': np.zeros((i % 3 + 1, 2)) + i,
+                              'index': i}, key='k{:d}'.format(i))
+
+        keys = ['k{:d}'.format(i) for i in [57, 3, 4, 5, 99, 3, 0, 58]]
+        keys.append('missing')
+        with sh.ShardedFileReader(f) as reader:
+            first = reader.read()
+            results = reader.read_keys(keys)
+            for key, data in zip(keys[:-1], results[:-1]):
+                self.assertEqual('k{:d}'.format(data['index']), key)
+                self.assertTrue((data['value'] == data['index']).all())
+            self.assertTrue(results[-1] is None)
+
+            # Sequential position is kept.
+            self.assertEqual(first['index'], 0)
+            self.assertEqual(reader.read()['index'], 1)
+
+        _remove_files(f)
+
+        pass
+
+    def test_handle_cache(self):
+        N = 100
+        num_shards = 10
+
+        f = sh.ShardedFile('test7', num_shards=num_shards)
+
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'value': np.zeros((i % 3 + 1)) + i}, key=i)
+
+        with sh.ShardedFileReader(f, max_open_files=3) as reader:
+            # Keys 0, 50, 99 live in three different shards.
+            for i in [0, 50, 99, 0, 50, 99]:
+                self.assertTrue((reader[i]['value'] == i).all())
+            stats = reader.get_handle_stats()
+            self.assertEqual(stats['misses'], 3)
+            self.assertEqual(stats['hits'], 3)
+            self.assertEqual(stats['evictions'], 0)
+
+            for i in [30, 0]:
+                self.assertTrue((reader[i]['value'] == i).all())
+            stats = reader.get_handle_stats()
+            self.assertEqual(stats['misses'], 5)
+            self.assertEqual(stats['evictions'], 2)
+            self.assertEqual(stats['open'], 3)
+
+            # Sequential scan is not affected by the pool.
+            reader.seek(0)
+            for i in xrange(N):
+                self.assertEqual(reader.read()['value'].flat[0], i)
+        self.assertEqual(reader.get_handle_stats()['open'], 0)
+
+        _remove_files(f)
+
+        pass
+
+    def test_prefetch(self):
+        N = 100
+        num_shards = 7
+
+        f = sh.ShardedFile('test8', num_shards=num_shards)
+
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'value': np.zeros((i % 3 + 1)) + i, 'index': i})
+
+        with sh.ShardedFileReader(f, batch_size=4, prefetch=3) as reader:
+            indices = []
+            for items in reader:
+                indices.extend([data['index'] for data in items])
+            self.assertEqual(indices, range(N))
+
+            # Seek while prefetching.
+            reader.seek(10)
+            items = reader.next()
+            self.assertEqual(items[0]['index'], 10)
+            reader.seek(50)
+            indices = []
+            for items in reader:
+                indices.extend([data['index'] for data in items])
+            self.assertEqual(indices, range(50, N))
+
+        with sh.ShardedFileReader(f, prefetch=2) as reader:
+            for i, data in enumerate(reader):
+                self.assertEqual(data['index'], i)
+                if i == 20:
+                    break
+            self.assertEqual(reader.read()['index'], 21)
+
+        _remove_files(f)
+
+        pass
+
+    def test_streaming_write(self):
+        N = 100
+        num_shards = 3
+
+        f = sh.ShardedFile('test9', num_shards=num_shards)
+
+        with sh.ShardedFileWriter(f, num_objects=N, block_size=7) as writer:
+            for i in xrange(N):
+                writer.write({
+                    'mask': np.zeros((i % 4 + 1, 5), dtype='uint8') + i,
+                    'score': float(i),
+                    'name': 'item_{:d}'.format(i)
+                }, key=i)
+
+        fh = h5py.File(f.get_fname(0), 'r')
+        self.assertTrue(fh['mask'].chunks is not None)
+        self.assertTrue(fh['mask'].maxshape[0] is None)
+        fh.close()
+
+        with sh.ShardedFileReader(f) as reader:
+            for i, data in enumerate(reader):
+                self.assertEqual(data['mask'].size, (i % 4 + 1) * 5)
+                self.assertTrue((data['mask'] == i).all())
+                self.assertEqual(data['score'], i)
+                self.assertEqual(data['name'], 'item_{:d}'.format(i))
+            self.assertEqual(i, N - 1)
+            self.assertTrue((reader[77]['mask'] == 77).all())
+
+        _remove_files(f)
+
+        # Ragged field with no rows in the first block.
+        lengths = [0] * 4 + [i % 3 for i in xrange(4, 12)]
+        opts = {'boxes': {'compression': 'gzip'}}
+        for use_write_many in [False, True]:
+            f = sh.ShardedFile('test9', num_shards=1)
+            with sh.ShardedFileWriter(f, num_objects=12, block_size=4,
+                                      field_options=opts) as writer:
+                if use_write_many:
+                    for start in xrange(0, 12, 4):
+                        writer.write_many({
+                            'index': np.arange(start, start + 4),
+                            'boxes': (np.concatenate(
+                                [np.zeros((lengths[i], 4)) + i
+                                 for i in xrange(start, start + 4)]),
+                                lengths[start: start + 4])
+                        })
+                else:
+                    for i in xrange(12):
+                        writer.write({'index': i,
+                                      'boxes': np.zeros((lengths[i], 4)) + i})
+
+            fh = h5py.File(f.get_fname(0), 'r')
+            self.assertTrue(fh['boxes'].maxshape[0] is None)
+            self.assertEqual(fh['boxes'].compression, 'gzip')
+            fh.close()
+
+            with sh.ShardedFileReader(f) as reader:
+                for i, data in enumerate(reader):
+                    self.assertEqual(data['index'], i)
+                    self.assertEqual(data['boxes'].size, lengths[i] * 4)
+                    self.assertTrue((data['boxes'] == i).all())
+                self.assertEqual(i, 11)
+
+            _remove_files(f)
+
+        pass
+
+    def test_parallel_write(self):
+        N = 103
+        num_shards = 9
+
+        f = sh.ShardedFile('test10', num_shards=num_shards)
+        sh.ParallelShardedFileWriter(f, N, num_workers=4).run(_produce)
+
+        self.assertEqual(sh._load_manifest(f)['num_items'], N)
+        with sh.ShardedFileReader(f) as reader:
+            self.assertEqual(len(reader), N)
+            for i, data in enumerate(reader):
+                self.assertEqual(data['index'], i)
+                self.assertTrue((data['value'] == i).all())
+            for i in [0, 50, N - 1]:
+                self.assertEqual(reader['k{:d}'.format(i)]['index'], i)
+            self.assertTrue(isinstance(reader._key_index, sh.SortedKeyIndex))
+
+        _remove_files(f)
+
+        pass
+
+    def test_fields(self):
+        N = 50
+        num_shards = 5
+
+        f = sh.ShardedFile('test11', num_shards=num_shards)
+
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'feature': np.zeros((i % 3 + 1, 8)) + i,
+                              'scores': np.zeros((i % 3 + 1)) + i,
+                              'index': i}, key=i)
+
+        with sh.ShardedFileReader(f, fields=['scores', 'index']) as reader:
+            for i, data in enumerate(reader):
+                self.assertEqual(sorted(data.keys()), ['index', 'scores'])
+                self.assertTrue((data['scores'] == i).all())
+            self.assertFalse('feature' in reader._handle.sep)
+
+            data = reader.read_key(7, fields=['feature'])
+            self.assertEqual(data.keys(), ['feature'])
+            self.assertTrue((data['feature'] == 7).all())
+
+            items = reader.read_keys([3, 40], fields=['index'])
+            self.assertEqual([d['index'] for d in items], [3, 40])
+
+            reader.seek(0)
+            self.assertRaises(Exception, reader.read, 1, ['missing'])
+
+        _remove_files(f)
+
+        pass
+
+    def test_field_options(self):
+        N = 40
+        num_shards = 2
+        opts = {
+            'mask': {'compression': 'gzip', 'compression_opts': 4,
+                     'shuffle': True},
+            'feature': {'compression': 'lzf', 'chunks': 8}
+        }
+
+        for block_size in [None, 16]:
+            f = sh.ShardedFile('test12', num_shards=num_shards)
+            with sh.ShardedFileWriter(f, num_objects=N, block_size=block_size,
+                                      field_options=opts) as writer:
+                for i in xrange(N):
+                    writer.write({
+                        'mask': np.zeros((32, 32), dtype='uint8') + (i % 2),
+                        'feature': np.zeros((3, 6), dtype='float32') + i,
+                        'index': i
+                    })
+
+            fh = h5py.File(f.get_fname(0), 'r')
+            self.assertEqual(fh['mask'].compression, 'gzip')
+            self.assertTrue(fh['mask'].shuffle)
+            self.assertEqual(fh['feature'].compression, 'lzf')
+            self.assertEqual(fh['feature'].chunks, (8, 6))
+            self.assertTrue(fh['index'].compression is None)
+            fh.close()
+
+            fields = sh._load_manifest(f)['fields']
+            self.assertEqual(fields['mask']['compression'], 'gzip')
+            self.assertEqual(fields['feature']['chunks'], [8, 6])
+
+            with sh.ShardedFileReader(f) as reader:
+                for i, data in enumerate(reader):
+                    self.assertTrue((data['mask'] == i % 2).all())
+                    self.assertTrue((data['feature'] == i).all())
+
+            _remove_files(f)
+
+        self.assertRaises(Exception, sh.ShardedFileWriter, f, N,
+                          field_options={'mask': {'level': 4}})
+
+        pass
+
+    def test_mmap(self):
+        N = 30
+        num_shards = 3
+
+        f = sh.ShardedFile('test13', num_shards=num_shards)
+        opts = {'packed': {'compression': 'gzip'}}
+        with sh.ShardedFileWriter(f, num_objects=N,
+                                  field_options=opts) as writer:
+            for i in xrange(N):
+                writer.write({'feature': np.zeros((i % 3 + 1, 4)) + i,
+                              'packed': np.zeros((2, 2)) + i,
+                              'index': i}, key=i)
+
+        with sh.ShardedFileReader(f, mmap=True, batch_size=4) as reader:
+            for items in reader:
+                for data in items:
+                    i = data['index']
+                    self.assertTrue((data['feature'] == i).all())
+                    self.assertTrue((data['packed'] == i).all())
+                    self.assertTrue(_is_mapped(data['feature']))
+                    self.assertFalse(_is_mapped(data['packed']))
+
+            data = reader.read_key(17, copy=True)
+            self.assertTrue((data['feature'] == 17).all())
+            self.assertFalse(_is_mapped(data['feature']))
+            self.assertTrue(data['feature'].flags.writeable)
+        self.assertTrue((data['feature'] == 17).all())
+
+        _remove_files(f)
+
+        pass
+
+    def test_shuffle(self):
+        N = 53
+        num_shards = 4
+
+        f = sh.ShardedFile('test14', num_shards=num_shards)
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'index': i})
+
+        with sh.ShardedFileReader(f) as reader:
+            shuffled = sh.ShuffledIterator(reader, buffer_size=8, seed=3,
+                                           read_size=3)
+            epoch0 = [item['index'] for item in shuffled]
+            epoch1 = [item['index'] for item in shuffled]
+            self.assertEqual(sorted(epoch0), range(N))
+            self.assertEqual(sorted(epoch1), range(N))
+            self.assertNotEqual(epoch0, range(N))
+            self.assertNotEqual(epoch0, epoch1)
+            self.assertEqual(shuffled.get_state()['epoch'], 2)
+
+            # Resume from the middle of epoch 1.
+            shuffled = sh.ShuffledIterator(reader, buffer_size=8, seed=3,
+                                           read_size=3)
+            [item for item in shuffled]
+            for i, item in enumerate(shuffled):
+                if i == 19:
+                    state = shuffled.get_state()
+                    break
+            self.assertEqual(state['num_emitted'], 20)
+
+            resumed = sh.ShuffledIterator(reader, buffer_size=8,
+                                          read_size=3)
+            resumed.set_state(state)
+            rest = [item['index'] for item in resumed]
+            self.assertEqual(rest, epoch1[20:])
+
+        _remove_files(f)
+
+        pass
+
+    def test_partition(self):
+        N = 53
+        num_shards = 4
+
+        f = sh.ShardedFile('test15', num_shards=num_shards)
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'index': i})
+
+        def read_all(reader):
+            return [item['index'] for items in reader for item in items]
+
+        with sh.ShardedFileReader(f, batch_size=5) as reader:
+            file_index = reader._build_index()
+            for by in ['shard', 'item']:
+                for num_workers in [1, 3, 6]:
+                    indices = []
+                    for w in xrange(num_workers):
+                        part = reader.partition(w, num_workers, by=by)
+                        part_indices = read_all(part)
+                        self.assertEqual(len(part), len(part_indices))
+                        indices.extend(part_indices)
+                        part.close()
+                    self.assertEqual(indices, range(N))
+
+            # Split at shard boundaries.
+            part = reader.partition(0, 2, by='shard')
+            self.assertEqual(len(part), file_index[1])
+            self.assertEqual(part.seek(3).read()['index'], 3)
+            part.close()
+
+            # Balanced by items.
+            sizes = [len(reader.partition(w, 3, by='item'))
+                     for w in xrange(3)]
+            self.assertTrue(max(sizes) - min(sizes) <= 1)
+
+            # Prefetch and seek are limited to the part.
+            part = reader.partition(1, 2, by='item')
+            part._prefetch = 2
+            self.assertEqual(read_all(part), range(N / 2, N))
+            self.assertEqual(part.seek(0).read()['index'], N / 2)
+            part.close()
+
+        _remove_files(f)
+
+        pass
+
+    def test_read_batch(self):
+        N = 30
+        num_shards = 3
+
+        f = sh.ShardedFile('test16', num_shards=num_shards)
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'index': i,
+                              'feature': np.zeros((3, 4)) + i,
+                              'boxes': np.zeros((i % 3 + 1, 4)) + i})
+
+        with sh.ShardedFileReader(f) as reader:
+            columns = reader.read_batch(5)
+            self.assertEqual(columns['index'].tolist(), range(5))
+            self.assertEqual(columns['feature'].shape, (5, 3, 4))
+            self.assertTrue((columns['feature'][:, 0, 0] ==
+                             np.arange(5)).all())
+            values, offsets = columns['boxes']
+            self.assertEqual(offsets.tolist(), [0, 1, 3, 6, 7, 9])
+            for i in xrange(5):
+                box = values[offsets[i]: offsets[i + 1]]
+                self.assertEqual(box.shape, (i % 3 + 1, 4))
+                self.assertTrue((box == i).all())
+
+            # Read into preallocated buffers.
+            out = {'feature': np.zeros((30, 4)),
+                   'index': np.zeros((10,), dtype='int64')}
+            columns = reader.read_batch(4, fields=['feature', 'index'],
+                                        out=out)
+            self.assertEqual(columns['index'].tolist(), range(5, 9))
+            self.assertEqual(out['index'][:4].tolist(), range(5, 9))
+            self.assertTrue((out['feature'][:12, 0] ==
+                             np.arange(5, 9).repeat(3)).all())
+
+        # Iterate as columns, with prefetching.
+        with sh.ShardedFileReader(f, batch_size=4, collate=True,
+                                  prefetch=2) as reader:
+            indices = []
+            for columns in reader:
+                self.assertEqual(columns['feature'].shape,
+                                 (len(columns['index']), 3, 4))
+                indices.extend(columns['index'].tolist())
+            self.assertEqual(indices, range(N))
+
+        _remove_files(f)
+
+        # Ragged field with as many lines as items.
+        with sh.ShardedFileWriter(f, num_objects=2) as writer:
+            writer.write({'boxes': np.zeros((0, 3))})
+            writer.write({'boxes': np.ones((2, 3))})
+        with sh.ShardedFileReader(f) as reader:
+            values, offsets = reader.read_batch(2)['boxes']
+            self.assertEqual(offsets.tolist(), [0, 0, 2])
+            self.assertTrue((values == 1).all())
+
+        _remove_files(f)
+
+        pass
+
+    def test_write_many(self):
+        N = 47
+        num_shards = 4
+
+        items = [{'index': i,
+                  'feature': np.zeros((3, 4)) + i,
+                  'boxes': np.zeros((i % 3 + 1, 4)) + i}
+                 for i in xrange(N)]
+        keys = ['key_{}'.format(i) for i in xrange(N)]
+        lengths = np.array([i % 3 + 1 for i in xrange(N)])
+        columns = {
+            'index': np.arange(N),
+            'feature': np.array([item['feature'] for item in items]),
+            'boxes': (np.concatenate([item['boxes'] for item in items]),
+                      lengths)
+        }
+
+        for block_size in [None, 4]:
+            f = sh.ShardedFile('test17', num_shards=num_shards)
+            with sh.ShardedFileWriter(f, num_objects=N,
+                                      block_size=block_size) as writer:
+                for i in xrange(N):
+                    writer.write(items[i], key=keys[i])
+
+            f2 = sh.ShardedFile('test18', num_shards=num_shards)
+            with sh.ShardedFileWriter(f2, num_objects=N,
+                                      block_size=block_size) as writer:
+                line = 0
+                for start, end in [(0, 7), (7, 30), (30, 31), (31, N)]:
+                    if end == 31:
+                        # Mix with a single write.
+                        writer.write(items[start], key=keys[start])
+                        line += lengths[start]
+                        continue
+                    num_lines = lengths[start: end].sum()
+                    writer.write_many({
+                        'index': columns['index'][start: end],
+                        'feature': columns['feature'][start: end],
+                        'boxes': (columns['boxes'][0][line: line + num_lines],
+                                  lengths[start: end])
+                    }, keys=keys[start: end])
+                    line += num_lines
+
+            for shard in xrange(num_shards):
+                h = h5py.File(f.get_fname(shard), 'r')
+                h2 = h5py.File(f2.get_fname(shard), 'r')
+                self.assertEqual(sorted(h.keys()), sorted(h2.keys()))
+                for key in h.keys():
+                    self.assertEqual(h[key][:].tolist(), h2[key][:].tolist())
+                h.close()
+                h2.close()
+
+            with sh.ShardedFileReader(f2) as reader:
+                self.assertTrue((reader['key_12']['boxes'] == 12).all())
+
+            _remove_files(f)
+            _remove_files(f2)
+
+        # Small calls are appended a block at a time.
+        f = sh.ShardedFile('test17', num_shards=1)
+        with sh.ShardedFileWriter(f, num_objects=N, block_size=16) as writer:
+            num_appends = [0]
+            append_block = writer._append_block
+
+            def count_append_block():
+                num_appends[0] += 1
+                append_block()
+            writer._append_block = count_append_block
+            for start in xrange(0, N, 3):
+                end = min(N, start + 3)
+                num_lines = lengths[:end].sum() - lengths[:start].sum()
+                line = lengths[:start].sum()
+                writer.write_many({
+                    'index': columns['index'][start: end],
+                    'boxes': (columns['boxes'][0][line: line + num_lines],
+                              lengths[start: end])
+                })
+        # Blocks ending at items 18 and 33, and the rest on close.
+        self.assertEqual(num_appends[0], 3)
+        with sh.ShardedFileReader(f) as reader:
+            for i, item in enumerate(reader):
+                self.assertEqual(item['index'], i)
+                self.assertTrue((item['boxes'] == i).all())
+            self.assertEqual(i, N - 1)
+        _remove_files(f)
+
+        f = sh.ShardedFile('test17', num_shards=num_shards)
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            self.assertRaises(Exception, writer.write_many,
+                              {'index': np.arange(2)}, keys=[1, 1])
+            self.assertRaises(Exception, writer.write_many,
+                              {'index': np.arange(N + 1)})
+            self.assertRaises(Exception, writer.write_many,
+                              {'boxes': (np.zeros((5, 4)), [1, 1])})
+            writer.write_many({'index': np.arange(N)})
+        with sh.ShardedFileReader(f, batch_size=N) as reader:
+            self.assertEqual([item['index'] for items in reader
+                              for item in items], range(N))
+        _remove_files(f)
+
+        pass
+
+    def test_key_arrays(self):
+        N = 40
+        num_shards = 4
+
+        f = sh.ShardedFile('test19', num_shards=num_shards)
+        for keys, index_cls in [
+                (['img_{}.jpg'.format(i) for i in xrange(N)],
+                 sh.HashedKeyIndex),
+                ([i * 7 for i in xrange(N)], sh.SortedKeyIndex),
+                # Int keys in the first shard only.
+                ([i if i < 11 else 'a{}'.format(i) for i in xrange(N)],
+                 dict)]:
+            with sh.ShardedFileWriter(f, num_objects=N) as writer:
+                for i in xrange(N):
+                    writer.write({'index': i}, key=keys[i])
+
+            # Without sidecars the index is built from the shards.
+            for fname in f.get_sidecar_fnames():
+                if os.path.exists(fname):
+                    os.remove(fname)
+
+            with sh.ShardedFileReader(f, max_open_files=1) as reader:
+                for i in xrange(N):
+                    self.assertTrue(keys[i] in reader)
+                    self.assertEqual(reader[keys[i]]['index'], i)
+                self.assertTrue(isinstance(reader._key_index, index_cls))
+                self.assertFalse('missing' in reader)
+                self.assertFalse(-1 in reader)
+                self.assertEqual(sorted(reader.keys()), sorted(keys))
+                items = reader.read_keys(keys[::-3])
+                self.assertEqual([item['index'] for item in items],
+                                 range(N)[::-3])
+
+            _remove_files(f)
+
+        # Same hash for any string width.
+        hashes = sh._hash_keys(np.array(['ab', 'abcdef'], dtype='S10'))
+        self.assertEqual(hashes[0], sh._hash_keys(['ab'])[0])
+        self.assertNotEqual(hashes[0], hashes[1])
+
+        pass
+
+    def test_bloom(self):
+        N = 200
+        num_shards = 5
+
+        f = sh.ShardedFile('test20', num_shards=num_shards)
+        for make_key in [lambda i: 'img_{}.jpg'.format(i), lambda i: i * 3]:
+            with sh.ShardedFileWriter(f, num_objects=N) as writer:
+                for i in xrange(N):
+                    writer.write({'index': i}, key=make_key(i))
+
+            with sh.ShardedFileReader(f) as reader:
+                # Negatives are answered by the Bloom filter alone.
+                missing = [make_key(i) for i in xrange(N, N + 1000)]
+                bloom = reader._get_bloom()
+                num_false = len([k for k in missing if k in bloom])
+                self.assertTrue(num_false < 50)
+                self.assertFalse(make_key(N) in reader)
+                self.assertTrue(reader._key_index is None)
+                self.assertTrue(make_key(5) in reader)
+                self.assertEqual(reader[make_key(5)]['index'], 5)
+
+            # Without a key index sidecar, only candidate shards are read.
+            os.remove(f.get_key_index_fnames()[0])
+            with sh.ShardedFileReader(f, max_open_files=2) as reader:
+                self.assertEqual(reader[make_key(5)]['index'], 5)
+                candidates = sh._check_shard_blooms(
+                    reader._shard_bloom_bits, make_key(5))
+                stats = reader._handles.get_stats()
+                self.assertTrue(stats['misses'] <= candidates.sum())
+                self.assertEqual(stats['evictions'], 0)
+                for i in xrange(N):
+                    self.assertTrue(make_key(i) in reader)
+                self.assertEqual(reader[make_key(150)]['index'], 150)
+                self.assertFalse(make_key(N + 1) in reader)
+                self.assertTrue(reader._key_index is None)
+                self.assertEqual(len(reader._shard_key_indices), num_shards)
+                self.assertEqual(len(reader._shard_blooms), 0)
+
+            # Without the shard Bloom filter sidecar, filters are read from
+            # the shards.
+            os.remove(f.get_shard_bloom_fname())
+            with sh.ShardedFileReader(f) as reader:
+                for i in xrange(N):
+                    self.assertTrue(make_key(i) in reader)
+                self.assertTrue(reader._shard_bloom_bits is None)
+                shard_bloom = reader._get_shard_bloom(0)
+                self.assertTrue(make_key(0) in shard_bloom)
+
+            _remove_files(f)
+
+        pass
+
+    def test_item_cache(self):
+        f = sh.ShardedFile('test21', num_shards=3)
+        N = 30
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'index': i, 'value': np.zeros((4,)) + i},
+                             key='k{:d}'.format(i))
+
+        # Each item holds 8 + 32 bytes, room for 3 items.
+        cache = sh.ItemCache(max_bytes=120)
+        with sh.ShardedFileReader(f, item_cache=cache) as reader:
+            item = reader['k5']
+            self.assertEqual(reader._pos, 6)
+            item['extra'] = 1
+            item = reader['k5']
+            self.assertEqual(item['index'], 5)
+            self.assertFalse('extra' in item)
+            self.assertEqual(reader._pos, 6)
+            self.assertEqual(reader.read()['index'], 6)
+            stats = cache.get_stats()
+            self.assertEqual((stats['hits'], stats['misses']), (1, 1))
+            self.assertEqual(stats['bytes'], 40)
+
+            items = reader.read_keys(['k5', 'k20', 'k1', 'k5'])
+            self.assertEqual([item['index'] for item in items],
+                             [5, 20, 1, 5])
+            self.assertTrue((items[1]['value'] == 20).all())
+            stats = cache.get_stats()
+            self.assertEqual((stats['hits'], stats['misses']), (3, 3))
+            self.assertEqual(stats['items'], 3)
+
+            # Least recently used items are evicted.
+            reader['k9']
+            self.assertEqual(cache.get_stats()['evictions'], 1)
+            self.assertTrue(cache.get_stats()['bytes'] <= 120)
+
+            # Reads of other fields are cached separately.
+            item = reader.read_key('k9', fields=['index'])
+            self.assertEqual(item.keys(), ['index'])
+
+            # Reads by key cover the whole file from a partition.
+            part = reader.partition(0, 3, by='item')
+            self.assertEqual(part['k25']['index'], 25)
+
+        # The cache is shared by readers in several threads.
+        cache = sh.ItemCache(max_bytes=1000)
+        errors = []
+
+        def worker(reader):
+            for i in xrange(3 * N):
+                if reader['k{:d}'.format(i % N)]['index'] != i % N:
+                    errors.append(i)
+
+        with sh.ShardedFileReader(f, item_cache=cache) as reader:
+            readers = [reader.partition(i, 4, by='item') for i in xrange(4)]
+            threads = [threading.Thread(target=worker, args=(r,))
+                       for r in readers]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(errors, [])
+        stats = cache.get_stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 4 * 3 * N)
+        self.assertTrue(stats['bytes'] <= 1000)
+        self.assertEqual(stats['items'], stats['bytes'] / 40)
+
+        _remove_files(f)
+
+        pass
+
+    def test_async_reader(self):
+        f = sh.ShardedFile('test22', num_shards=3)
+        N = 30
+        with sh.ShardedFileWriter(f, num_objects=N) as writer:
+            for i in xrange(N):
+                writer.write({'index': i, 'value': np.zeros((i % 3 + 1,)) + i},
+                             key='k{:d}'.format(i))
+
+        with sh.AsyncShardedFileReader(f, num_workers=2,
+                                       batch_size=4) as reader:
+            self.assertEqual(len(reader), N)
+            self.assertEqual(reader.get('k7').result()['index'], 7)
+            self.assertTrue(reader.get('missing').result() is None)
+            items = reader.get_many(['k3', 'missing', 'k25']).result()
+            self.assertEqual(items[0]['index'], 3)
+            self.assertTrue(items[1] is None)
+            self.assertEqual(items[2]['value'].shape, (2,))
+            item = reader.get('k8', fields=['index']).result()
+            self.assertEqual(item.keys(), ['index'])
+
+            # Callbacks get the future once done.
+            done = []
+            called = threading.Event()
+
+            def callback(x):
+                done.append(x.result()['index'])
+                called.set()
+
+            future = reader.get('k9')
+            future.add_done_callback(callback)
+            called.wait(10)
+            future.add_done_callback(callback)
+            self.assertEqual(done, [9, 9])
+
+            # Batches come in file order.
+            indices = [item['index'] for items in reader for item in items]
+            self.assertEqual(indices, range(N))
+
+        # Requests queued together are read together.
+        with sh.AsyncShardedFileReader(f, num_workers=1) as reader:
+            reader.get('k0').result()
+            with reader._index_lock:
+                futures = [reader.get('k{:d}'.format(i)) for i in xrange(10)]
+                futures.append(reader.get_many(['k12', 'k11']))
+            for i in xrange(10):
+                self.assertEqual(futures[i].result()['index'], i)
+            self.assertEqual([item['index'] for item in futures[-1].result()],
+                             [12, 11])
+            self.assertEqual(reader.get_stats(), {'requests': 12, 'reads': 2})
+
+            # Concurrent read_next calls get successive batches.
+            futures = [reader.read_next() for i in xrange(N + 1)]
+            self.assertEqual([x.result() and x.result()['index']
+                              for x in futures[:N]], range(N))
+            self.assertTrue(futures[N].result() is None)
+        self.assertRaises(Exception, reader.get, 'k0')
+
+        _remove_files(f)
 
         pass
 